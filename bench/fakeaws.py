@@ -0,0 +1,143 @@
+'''in-memory stand-ins for the aws calls made by gpswatch.MessageQueue
+
+FakePool has the interface of gpstrack.aws.ClientPool. every call sleeps for
+`latency` seconds to look like a network round trip. settings rows that do not
+exist yet are created on first read with host/port pointing at `upstream`, so
+every simulated watch is proxied to the load generator's upstream stub.
+'''
+
+import asyncio
+import itertools
+import re
+
+
+class FakeClient:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def call(self, name):
+        self.pool.calls[name] = self.pool.calls.get(name, 0) + 1
+        if self.pool.latency:
+            await asyncio.sleep(self.pool.latency)
+
+
+class FakeDynamo(FakeClient):
+    def __init__(self, pool):
+        super().__init__(pool)
+        self.items = {}
+
+    @staticmethod
+    def key(key):
+        return key['device_id']['S'], key['ts']['N']
+
+    def settings(self, device_id):
+        item = self.items.get((device_id, '0'))
+        if item is None and self.pool.upstream and '_' in device_id and not device_id.startswith(('SEC_', 'TEL_', 'GPX_')):
+            host, port = self.pool.upstream
+            item = self.items[(device_id, '0')] = {
+                'device_id': {'S': device_id}, 'ts': {'N': '0'},
+                'secret': {'S': '1'}, 'host': {'S': host}, 'port': {'S': str(port)},
+            }
+        return item
+
+    async def get_item(self, TableName, Key, ConsistentRead=False):
+        await self.call('get_item')
+        device_id, ts = self.key(Key)
+        item = self.settings(device_id) if ts == '0' else self.items.get((device_id, ts))
+        return {'Item': item} if item else {}
+
+    async def put_item(self, TableName, Item):
+        await self.call('put_item')
+        self.items[self.key(Item)] = Item
+        return {}
+
+    async def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues):
+        await self.call('update_item')
+        item = self.items.setdefault(self.key(Key), dict(Key))
+        for attr, val in re.findall(r'(\w+) = (:\w+)', UpdateExpression):
+            item[attr] = ExpressionAttributeValues[val]
+        return {}
+
+    async def batch_write_item(self, RequestItems):
+        await self.call('batch_write_item')
+        for table, requests in RequestItems.items():
+            for r in requests:
+                self.items[self.key(r['PutRequest']['Item'])] = r['PutRequest']['Item']
+        return {'UnprocessedItems': {}}
+
+    async def batch_get_item(self, RequestItems):
+        await self.call('batch_get_item')
+        res = {}
+        for table, request in RequestItems.items():
+            found = [self.settings(k['device_id']['S']) if k['ts']['N'] == '0' else self.items.get(self.key(k))
+                    for k in request['Keys']]
+            res[table] = [i for i in found if i]
+        return {'Responses': res, 'UnprocessedKeys': {}}
+
+
+class FakeSNS(FakeClient):
+    async def create_topic(self, Name):
+        await self.call('create_topic')
+        return {'TopicArn': 'arn:aws:sns:local:0:%s' % Name}
+
+    async def publish(self, TopicArn, Message):
+        await self.call('publish')
+        return {'MessageId': '1'}
+
+    async def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        await self.call('publish_batch')
+        return {'Successful': [{'Id': e['Id']} for e in PublishBatchRequestEntries], 'Failed': []}
+
+
+class FakeSQS(FakeClient):
+    def __init__(self, pool):
+        super().__init__(pool)
+        self.messages = asyncio.Queue()
+        self.receipts = itertools.count()
+
+    async def create_queue(self, QueueName):
+        await self.call('create_queue')
+        return {'QueueUrl': 'local://%s' % QueueName}
+
+    async def send_message(self, QueueUrl, MessageBody):
+        await self.call('send_message')
+        self.messages.put_nowait(MessageBody)
+        return {}
+
+    async def receive_message(self, QueueUrl, AttributeNames=(), MaxNumberOfMessages=1, WaitTimeSeconds=0):
+        await self.call('receive_message')
+        try:
+            bodies = [await asyncio.wait_for(self.messages.get(), WaitTimeSeconds)]
+        except asyncio.TimeoutError:
+            return {}
+        while len(bodies) < MaxNumberOfMessages and not self.messages.empty():
+            bodies.append(self.messages.get_nowait())
+        return {'Messages': [{'Body': b, 'ReceiptHandle': str(next(self.receipts))} for b in bodies]}
+
+    async def delete_message_batch(self, QueueUrl, Entries):
+        await self.call('delete_message_batch')
+        return {'Successful': [{'Id': e['Id']} for e in Entries], 'Failed': []}
+
+
+class FakePool:
+    def __init__(self, loop=None, upstream=None, latency=0.005):
+        self.loop = loop
+        self.upstream = upstream
+        self.latency = latency
+        self.calls = {}
+        self.sns = FakeSNS(self)
+        self.dynamo = FakeDynamo(self)
+        self.sqs = FakeSQS(self)
+
+    def client(self, name):
+        return {'sns': self.sns, 'dynamodb': self.dynamo, 'sqs': self.sqs}[name]
+
+    def stats(self):
+        return {}
+
+    async def report(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        pass
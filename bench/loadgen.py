@@ -0,0 +1,415 @@
+'''load generator simulating a fleet of Q50 style watches against gpswatch.py
+
+starts gpswatch in a child process with in-memory dynamo/sns/sqs (bench.fakeaws)
+and an upstream stub in this process, then opens N watch connections that send
+LK, UD/UD2, AL and chunked TK voice frames built from the recordings in
+tests/test_baseproto.py. downlink CR commands are pushed through the push
+endpoint and answered by the simulated watches.
+
+reports connection setup latency (connect until the first LK reply came back
+through the proxy), LK/AL round trips, downlink latency and the server's CPU
+and RSS.
+
+run from the repository root, e.g.:
+    python -m bench.loadgen --watches 2000 --duration 60
+    python -m bench.loadgen --watches 2000 --workers 4
+'''
+
+import argparse
+import asyncio
+import binascii
+import collections
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+from proto import trace, transport
+from proto.message import message
+
+log = logging.getLogger('gpstrack.loadgen')
+
+COMPANY = '3G'
+PUSH_KEY = 'loadgen'
+
+
+def recorded_frames():
+    '''UD parameters and TK voice payload from the recorded watch session'''
+    from tests.test_baseproto import watch_data
+
+    frames = []
+    class collect(transport.stream):
+        def message_received(self, msg):
+            frames.append(msg)
+    collect().send(binascii.unhexlify(watch_data))
+
+    ud = next(f.params for f in frames if f.cmd == 'UD')
+    tk = next(f.params for f in frames if f.cmd == 'TK')
+    return ud, tk
+
+
+def percentiles(values):
+    if not values:
+        return 'no samples'
+    values = sorted(values)
+    pick = lambda q: values[min(int(q * len(values)), len(values) - 1)] * 1000
+    return 'n=%-7s p50=%7.1fms p90=%7.1fms p99=%7.1fms max=%7.1fms' % (
+        len(values), pick(.5), pick(.9), pick(.99), values[-1] * 1000)
+
+
+class Stats:
+    def __init__(self):
+        self.setup = []
+        self.rtt = collections.defaultdict(list)
+        self.downlink = []
+        self.frames = 0
+        self.bytes = 0
+        self.errors = 0
+
+
+class Watch(transport.stream):
+    '''one simulated watch connection'''
+
+    def __init__(self, n, args, stats, ud, tk):
+        super().__init__()
+        self.device_id = '%010d' % (6400000000 + n)
+        self.args = args
+        self.stats = stats
+        self.ud = ud
+        self.tk = tk
+        self.waiting = collections.defaultdict(collections.deque)
+        self.commands = collections.deque()
+        self.ready = asyncio.Event()
+        # goes quiet after connecting, like a watch that lost the network
+        self.silent = n < args.silent * args.watches
+
+    def frame(self, cmd, params=None):
+        return message.from_command(COMPANY, self.device_id, cmd, params).raw
+
+    def write(self, cmd, params=None, expect_reply=False):
+        raw = self.frame(cmd, params)
+        if expect_reply:
+            self.waiting[cmd].append(time.perf_counter())
+        self.writer.write(raw)
+        self.stats.frames += 1
+        self.stats.bytes += len(raw)
+
+    def message_received(self, msg):
+        now = time.perf_counter()
+        if self.waiting[msg.cmd]:
+            sent = self.waiting[msg.cmd].popleft()
+            if msg.cmd == 'LK' and not self.ready.is_set():
+                self.stats.setup.append(now - self.connect_started)
+                self.ready.set()
+            else:
+                self.stats.rtt[msg.cmd].append(now - sent)
+        elif msg.cmd == 'CR':
+            if self.commands:
+                self.stats.downlink.append(time.time() - self.commands.popleft())
+            self.write('CR')
+
+    async def read(self, reader):
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            self.send(data)
+
+    async def run(self, deadline):
+        args = self.args
+        self.connect_started = time.perf_counter()
+        reader, self.writer = await asyncio.open_connection(args.host, args.port)
+        reading = asyncio.ensure_future(self.read(reader))
+        try:
+            self.write('LK', b'0,0,100', expect_reply=True)
+            await asyncio.wait_for(self.ready.wait(), 30)
+            if self.silent:
+                await asyncio.sleep(deadline - time.time())
+
+            while time.time() < deadline:
+                await asyncio.sleep(random.expovariate(1.0 / args.interval))
+                r = random.random()
+                if r < args.tk_ratio:
+                    await self.voice()
+                elif r < args.tk_ratio + args.al_ratio:
+                    self.write('AL', self.ud, expect_reply=True)
+                elif r < args.tk_ratio + args.al_ratio + args.lk_ratio:
+                    self.write('LK', b'0,0,100', expect_reply=True)
+                else:
+                    self.write(random.choice(('UD', 'UD2')), self.ud)
+                await self.writer.drain()
+        finally:
+            reading.cancel()
+            self.writer.close()
+
+    async def voice(self):
+        '''TK frame in 1 KB pieces, like a watch uploading over a slow link'''
+        raw = self.frame('TK', self.tk)
+        self.waiting['TK'].append(time.perf_counter())
+        for i in range(0, len(raw), 1024):
+            self.writer.write(raw[i:i+1024])
+            await self.writer.drain()
+            await asyncio.sleep(0.01)
+        self.stats.frames += 1
+        self.stats.bytes += len(raw)
+
+
+async def upstream(reader, writer):
+    '''stand-in for the watch vendor's server behind the proxy'''
+    class replies(transport.stream):
+        def message_received(self, msg):
+            if msg.cmd in ('LK', 'AL', 'TK'):
+                writer.write(message.from_command(msg.company, msg.device_id, msg.cmd).raw)
+    st = replies()
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            st.send(data)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def push(args, watches, stats, deadline):
+    '''send CR commands to random online watches through the push endpoint'''
+    from gpstrack.push import sign
+
+    reader, writer = await asyncio.open_connection(args.host, args.push_port)
+    last = {} # a second CR to a watch within a second has the same id, the server rejects it as a replay
+    while time.time() < deadline:
+        await asyncio.sleep(random.expovariate(args.downlink_rate))
+        w = random.choice(watches)
+        sent = time.time()
+        if not w.ready.is_set() or last.get(w.device_id) == int(sent):
+            continue
+        last[w.device_id] = int(sent)
+        msg = message.from_command(COMPANY, w.device_id, 'CR', None, direction='server_t', ts=str(int(sent)))
+        body = json.dumps({'id': msg.identifier, 'cmd': msg.cmd, 'direction': msg.direction,
+                'sent': sent, 'item': msg.to_dynamo()}).encode()
+        w.commands.append(sent)
+        writer.write(sign(PUSH_KEY.encode(), body) + b' ' + body + b'\n')
+        if await reader.readline() != b'ok\n':
+            w.commands.pop()
+            stats.errors += 1
+    writer.close()
+
+
+def process_tree(pid):
+    pids = [pid]
+    for p in os.listdir('/proc'):
+        if p.isdigit():
+            try:
+                with open('/proc/%s/stat' % p) as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(p))
+            except (OSError, IndexError):
+                pass
+    return pids
+
+def cpu_rss(pid):
+    '''cpu seconds and rss bytes of the server process and its workers'''
+    cpu = rss = 0
+    tick = os.sysconf('SC_CLK_TCK')
+    for p in process_tree(pid):
+        try:
+            with open('/proc/%s/stat' % p) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / tick
+            rss += int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            pass
+    return cpu, rss
+
+
+async def wait_port(host, port, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            _, w = await asyncio.open_connection(host, port)
+            w.close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def main(args):
+    ud, tk = recorded_frames()
+    up = await asyncio.start_server(upstream, '127.0.0.1', 0, limit=1024*1024)
+    up_port = up.sockets[0].getsockname()[1]
+
+    tmp = tempfile.mkdtemp()
+    env = dict(os.environ,
+        GPSWATCH_PORT=str(args.port), GPSWATCH_PUSH_KEY=PUSH_KEY, GPSWATCH_PUSH_PORT=str(args.push_port),
+        GPSWATCH_HANDOVER=os.path.join(tmp, 'handover.sock'), GPSWATCH_REGISTRY=os.path.join(tmp, 'registry-%s.sock'),
+        GPSWATCH_METRICS_PORT=str(args.metrics_port),
+        LOADGEN_UPSTREAM='127.0.0.1:%s' % up_port, LOADGEN_AWS_LATENCY=str(args.aws_latency))
+    # the child runs in tmp, it imports bench and gpswatch from this tree
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([root] + [p for p in [os.environ.get('PYTHONPATH')] if p])
+    trace_file = os.path.join(tmp, 'trace.jsonl')
+    if args.trace:
+        env['GPSWATCH_TRACE_FILE'] = trace_file
+    if args.heartbeat:
+        env['GPSWATCH_HEARTBEAT'] = str(args.heartbeat)
+    server = await asyncio.create_subprocess_exec(sys.executable, '-m', 'bench.loadgen', '--serve',
+            '--workers', str(args.workers), *log_options(args), env=env, cwd=tmp,
+            stderr=open(os.path.join(tmp, 'stderr.log'), 'wb'))
+    stats = Stats()
+    try:
+        await wait_port(args.host, args.port)
+        await wait_port(args.host, args.push_port)
+        started = time.time()
+        cpu_started, _ = cpu_rss(server.pid)
+        deadline = started + args.ramp + args.duration
+
+        watches = [Watch(n, args, stats, ud, tk) for n in range(args.watches)]
+        async def start(w, delay):
+            await asyncio.sleep(delay)
+            try:
+                await w.run(deadline)
+            except (OSError, asyncio.TimeoutError):
+                stats.errors += 1
+        tasks = [asyncio.ensure_future(start(w, args.ramp * n / args.watches)) for n, w in enumerate(watches)]
+        if args.downlink_rate:
+            tasks.append(asyncio.ensure_future(push(args, watches, stats, deadline)))
+
+        peak_rss = 0
+        while time.time() < deadline:
+            await asyncio.sleep(1)
+            peak_rss = max(peak_rss, cpu_rss(server.pid)[1])
+        cpu, rss = cpu_rss(server.pid)
+        elapsed = time.time() - started
+        await asyncio.gather(*tasks, return_exceptions=True)
+        scraped = []
+        if args.metrics_port:
+            # the single process, or the first worker
+            scraped.append(await scrape(args.host, args.metrics_port + (1 if args.workers else 0)))
+    finally:
+        if server.returncode is None:
+            server.terminate()
+        await server.wait()
+        up.close()
+
+    print('watches %s, workers %s, %.0fs, %s errors' % (args.watches, args.workers, elapsed, stats.errors))
+    print('frames sent        %.0f/s, %.2f MB/s' % (stats.frames / elapsed, stats.bytes / elapsed / 1e6))
+    print('connection setup   %s' % percentiles(stats.setup))
+    for cmd in sorted(stats.rtt):
+        print('%-18s %s' % (cmd + ' round trip', percentiles(stats.rtt[cmd])))
+    print('downlink (push)    %s' % percentiles(stats.downlink))
+    print('server cpu         %.1f%% of one core' % ((cpu - cpu_started) / elapsed * 100))
+    print('server rss         %.1f MB (peak %.1f MB)' % (rss / 1e6, peak_rss / 1e6))
+    for text in scraped:
+        print('server loop lag    p50<=%ss p99<=%ss' % (bucket_quantile(text, 'gpswatch_loop_lag_seconds', .5),
+                bucket_quantile(text, 'gpswatch_loop_lag_seconds', .99)))
+        print('server parse/chunk p50<=%ss p99<=%ss' % (bucket_quantile(text, 'gpswatch_parse_seconds', .5),
+                bucket_quantile(text, 'gpswatch_parse_seconds', .99)))
+        print('settings reads     %s' % ' '.join('%s=%d' % kv for kv in
+                sorted(labelled_values(text, 'gpswatch_settings_reads').items())))
+        print('server reaped      %s' % ' '.join('%s=%d' % kv for kv in
+                sorted(labelled_values(text, 'gpswatch_reaped_connections_total').items())))
+    if args.trace:
+        traces = trace.load([trace_file])
+        print('server traces      %s, spans by stage:' % len(traces))
+        for line in trace.report(traces):
+            print('  ' + line)
+
+
+async def scrape(host, port):
+    '''text of the server's metrics endpoint'''
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+    res = await reader.read()
+    writer.close()
+    return res.split(b'\r\n\r\n', 1)[1].decode()
+
+def labelled_values(text, name):
+    '''value by the first label's value of a metric'''
+    values = {}
+    for line in text.splitlines():
+        if line.startswith(name + '{'):
+            label = line.split('="', 1)[1].split('"', 1)[0]
+            values[label] = float(line.rsplit(' ', 1)[1])
+    return values
+
+def bucket_quantile(text, name, q):
+    '''upper bound of the bucket holding the q-th value, all label sets of a histogram added up'''
+    counts = collections.OrderedDict()
+    for line in text.splitlines():
+        if line.startswith(name + '_bucket{'):
+            le = line.split('le="', 1)[1].split('"', 1)[0]
+            counts[le] = counts.get(le, 0) + int(line.rsplit(' ', 1)[1])
+    total = counts.get('+Inf', 0)
+    for le, n in counts.items():
+        if total and n >= q * total:
+            return le
+
+
+def log_options(args):
+    return ['--log-level', args.log_level] + (['--queued-logs'] if args.queued_logs else [])
+
+def serve(args):
+    '''gpswatch with in-memory aws, runs in the child process'''
+    import gpswatch
+    from bench.fakeaws import FakePool
+    from gpstrack import logs
+
+    if args.queued_logs:
+        logs.setup('gpswatch.log' if args.worker is None else 'gpswatch.%s.log' % args.worker, level=args.log_level)
+    else:
+        logging.basicConfig(level=getattr(logging, args.log_level), format=logs.FORMAT)
+        logging.getLogger().handlers[0].addFilter(logs.ContextFilter())
+
+    host, port = os.environ['LOADGEN_UPSTREAM'].split(':')
+    latency = float(os.environ['LOADGEN_AWS_LATENCY'])
+    gpswatch.ClientPool = lambda loop: FakePool(loop, upstream=(host, int(port)), latency=latency)
+    gpswatch.WORKER_COMMAND = [sys.executable, '-m', 'bench.loadgen', '--serve'] + log_options(args)
+
+    loop = asyncio.get_event_loop()
+    if args.worker is not None:
+        gpswatch.run_worker(loop, args.registry, args.worker)
+    elif args.workers:
+        gpswatch.run_supervisor(loop, args.workers)
+    else:
+        gpswatch.run_single(loop)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--watches', type=int, default=500, help='simulated watches')
+    parser.add_argument('--workers', type=int, default=0, help='gpswatch worker processes, 0 for one process')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load after the ramp up')
+    parser.add_argument('--ramp', type=float, default=5, help='seconds to open all connections')
+    parser.add_argument('--interval', type=float, default=10, help='mean seconds between frames of one watch')
+    parser.add_argument('--lk-ratio', type=float, default=0.2, help='share of LK heartbeats')
+    parser.add_argument('--al-ratio', type=float, default=0.02, help='share of AL alarms')
+    parser.add_argument('--tk-ratio', type=float, default=0.01, help='share of TK voice messages')
+    parser.add_argument('--silent', type=float, default=0, help='share of watches going quiet after connecting')
+    parser.add_argument('--heartbeat', type=float, default=0,
+            help='server GPSWATCH_HEARTBEAT, idle connections are closed after 3 of them')
+    parser.add_argument('--downlink-rate', type=float, default=5, help='pushed downlink commands per second')
+    parser.add_argument('--aws-latency', type=float, default=0.005, help='simulated aws round trip, seconds')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18001)
+    parser.add_argument('--push-port', type=int, default=18002)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--metrics-port', type=int, default=18003, help='server metrics endpoint, 0 to disable')
+    parser.add_argument('--trace', action='store_true', help='trace UD/AL frames and report the server stages')
+    parser.add_argument('--queued-logs', action='store_true',
+            help='server logs through gpstrack.logs (written by a listener thread) instead of on the loop')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--registry', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+    else:
+        asyncio.get_event_loop().run_until_complete(main(args))
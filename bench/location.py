@@ -0,0 +1,106 @@
+'''benchmark of the UD/UD2/AL location payload decoder
+
+decodes a fleet's worth of distinct UD payloads with proto.message.ld and with
+the previous split-and-arrow implementation, reading what to_dynamo() and the
+webhook read (type, lat, lon, batt, ts_num, alarm, on_wrist), and reports how
+much of one core the decoding needs at the given fleet rate.
+
+run from the repository root:  python -m bench.location --watches 10000 --interval 60
+'''
+
+import argparse
+import binascii
+import random
+import struct
+import time
+
+import arrow
+
+from proto.message import ld
+
+REPEAT = 3
+
+
+class legacy_ld:
+    '''proto.message.ld before the lazy decoder, kept for comparison'''
+
+    def __init__(self, params):
+        params = params.decode().split(',')
+        self.date, self.time = params[:2]
+        self.position = params[2:11]
+        self.gsm = params[11]
+        self.batt = params[12]
+        self.steps, self.roll, self.tstate = params[13:16]
+        self.gsm_info = params[16:]
+
+    @property
+    def alarm(self):
+        st = struct.unpack('>L', binascii.unhexlify(self.tstate))[0]
+        return ''.join(name for bit, name in {16: 'SOS', 17: 'low battery', 18: 'out fence',
+            19: 'into fence', 20: 'remove watch'}.items() if st & (1 << bit))
+
+    @property
+    def on_wrist(self):
+        return not (struct.unpack('>L', binascii.unhexlify(self.tstate))[0] & (1 << 3))
+
+    @property
+    def type(self):
+        return self.position[0]
+
+    @property
+    def lat(self):
+        return ('' if self.position[2] == 'N' else '-') + self.position[1]
+
+    @property
+    def lon(self):
+        return ('' if self.position[4] == 'E' else '-') + self.position[3]
+
+    @property
+    def ts_num(self):
+        ts = arrow.get(self.date+' '+self.time, 'DDMMYY HHmmss').timestamp
+        return ts() if callable(ts) else ts # arrow >= 1.0 made it a method
+
+
+def payload(rnd):
+    t = time.gmtime(1486038044 + rnd.randrange(86400 * 365))
+    cells = rnd.randrange(1, 8)
+    return ('%s,%s,%s,%.6f,N,%.7f,E,1.59,254.8,0.0,11,71,%d,58698,0,%08x,%d,255,250,%s,0,8.8' % (
+        time.strftime('%d%m%y', t), time.strftime('%H%M%S', t), rnd.choice('AV'),
+        rnd.uniform(55, 56), rnd.uniform(37, 38), rnd.randrange(101),
+        rnd.choice((0, 8, 0x10000, 0x100008)), cells,
+        ','.join('1604,%d,%d' % (rnd.randrange(65536), rnd.randrange(100, 150)) for i in range(cells)),
+    )).encode()
+
+
+def run(cls, payloads):
+    best = 0
+    for i in range(REPEAT):
+        started = time.perf_counter()
+        for p in payloads:
+            d = cls(p)
+            d.type, d.lat, d.lon, d.batt, d.ts_num, d.alarm, d.on_wrist
+        best = max(best, len(payloads) / (time.perf_counter() - started))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--watches', type=int, default=10000)
+    parser.add_argument('--interval', type=float, default=60, help='seconds between UD frames of one watch')
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    payloads = [payload(rnd) for i in range(args.watches)]
+    for p in payloads[:100]:
+        assert ld(p).ts_num == legacy_ld(p).ts_num and ld(p).alarm == legacy_ld(p).alarm
+
+    rate = args.watches / args.interval
+    print('fleet: %s watches, a UD every %ss = %.0f frames/s' % (args.watches, args.interval, rate))
+    print('%-8s %12s %14s' % ('impl', 'frames/s', 'core at fleet'))
+    for name, cls in (('legacy', legacy_ld), ('lazy', ld)):
+        fps = run(cls, payloads)
+        print('%-8s %12.0f %13.2f%%' % (name, fps, rate / fps * 100))
+
+
+if __name__ == '__main__':
+    main()
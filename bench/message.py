@@ -0,0 +1,58 @@
+'''micro benchmark of the per frame message path
+
+measures frames per second through proto.transport.stream parsing, the
+gpswatch direction tag and what WriteBehind.put() does with a frame: the
+identifier, the json publish body, the shard hash and to_dynamo().
+
+run from the repository root:  python -m bench.message
+'''
+
+import binascii
+import json
+import time
+
+from proto import transport
+from bench.transport import UD, frame
+
+REPEAT = 3
+FRAMES = 20000
+
+
+class pipeline(transport.stream):
+    frames = 0
+
+    def message_received(self, msg):
+        msg.direction = 'watch'
+        ident = msg.identifier
+        body = json.dumps({'id': ident, 'cmd': msg.cmd, 'direction': msg.direction})
+        binascii.crc32(ident['device_id'].encode())
+        msg.to_dynamo()
+        self.frames += 1
+
+
+def scenarios():
+    yield 'LK', frame(b'LK,58698,0,100')
+    yield 'UD', frame(UD)
+    yield 'AL', frame(b'AL,' + UD.split(b',', 1)[1])
+    yield 'TK 4KB', frame(b'TK,' + bytes(bytearray(i % 251 for i in range(4096))))
+
+
+def run(data):
+    best = 0
+    for i in range(REPEAT):
+        st = pipeline()
+        started = time.perf_counter()
+        for n in range(FRAMES):
+            st.send(data)
+        best = max(best, st.frames / (time.perf_counter() - started))
+    return best
+
+
+def main():
+    print('%-10s %12s' % ('frame', 'frames/s'))
+    for name, data in scenarios():
+        print('%-10s %12.0f' % (name, run(data)))
+
+
+if __name__ == '__main__':
+    main()
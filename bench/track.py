@@ -0,0 +1,102 @@
+'''benchmark of the /track simplification
+
+builds a synthetic multi-day track of one watch (nights at home, days at
+school, walks in between, gps jitter while standing still), runs it through
+proto.track.simplify with several settings and reports the points kept, the
+GPX size the viewer downloads and the time spent. a plain python recursive
+Douglas-Peucker is timed for comparison.
+
+run from the repository root:  python -m bench.track --days 7 --interval 180
+'''
+
+import argparse
+import gzip
+import math
+import random
+import time
+
+import numpy
+
+from proto import gpx, track
+
+REPEAT = 3
+HOME = (55.8170, 37.6250)
+PLACES = [(55.8230, 37.6410), (55.8105, 37.6120), (55.8290, 37.6005)]
+
+
+def legacy_douglas_peucker(points, tolerance):
+    '''list based recursive Douglas-Peucker on (x, y) tuples, kept for comparison'''
+    if len(points) < 3:
+        return points
+    (ax, ay), (bx, by) = points[0], points[-1]
+    chord = math.hypot(bx - ax, by - ay)
+    best, index = 0, 0
+    for i in range(1, len(points) - 1):
+        px, py = points[i][0] - ax, points[i][1] - ay
+        d = abs(px * (by - ay) - py * (bx - ax)) / chord if chord else math.hypot(px, py)
+        if d > best:
+            best, index = d, i
+    if best <= tolerance:
+        return [points[0], points[-1]]
+    return legacy_douglas_peucker(points[:index+1], tolerance)[:-1] + legacy_douglas_peucker(points[index:], tolerance)
+
+
+def synthetic(days, interval, rnd):
+    '''(lat, lon, ts) of a watch reporting every interval seconds'''
+    jitter = 15. / track.EARTH_RADIUS * 180 / math.pi
+    points = []
+    ts = 1486000000
+    for day in range(days):
+        place = PLACES[day % len(PLACES)]
+        # home until 8:00, walk 30 min, there until 15:00, walk back, home again
+        plan = [(HOME, HOME, 8*3600), (HOME, place, 1800), (place, place, 6.5*3600),
+                (place, HOME, 2400), (HOME, HOME, 24*3600 - 8*3600 - 1800 - 6.5*3600 - 2400)]
+        for (lat0, lon0), (lat1, lon1), duration in plan:
+            for t in numpy.arange(0, duration, interval):
+                k = t / duration
+                lat = lat0 + (lat1 - lat0) * k + rnd.gauss(0, jitter)
+                lon = lon0 + (lon1 - lon0) * k + rnd.gauss(0, jitter)
+                points.append(('%.6f' % lat, '%.7f' % lon, ts + int(t)))
+            ts += duration
+    return points
+
+
+def best_time(fn):
+    best = None
+    for i in range(REPEAT):
+        started = time.perf_counter()
+        res = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return res, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--interval', type=float, default=180, help='seconds between fixes')
+    args = parser.parse_args()
+
+    points = synthetic(args.days, args.interval, random.Random(1))
+    lat = [p[0] for p in points]
+    lon = [p[1] for p in points]
+
+    print('track: %s days, a fix every %ss = %s points' % (args.days, args.interval, len(points)))
+    print('%-22s %8s %10s %10s %10s' % ('settings', 'points', 'gpx KB', 'gzip KB', 'ms'))
+    for name, options in (('none', {}), ('stay=30', {'stay': 30}), ('simplify=10', {'tolerance': 10}),
+            ('simplify=25', {'tolerance': 25}), ('simplify=25 stay=30', {'tolerance': 25, 'stay': 30}),
+            ('simplify=50 stay=50', {'tolerance': 50, 'stay': 50})):
+        keep, elapsed = best_time(lambda: track.simplify(lat, lon, **options))
+        body = ''.join(gpx.chunks(points[i] for i in keep)).encode()
+        print('%-22s %8d %10.1f %10.1f %10.2f' % (name, len(keep), len(body) / 1024.,
+                len(gzip.compress(body)) / 1024., elapsed * 1000))
+
+    x, y = track.project(lat, lon)
+    xy = list(zip(x.tolist(), y.tolist()))
+    kept, elapsed = best_time(lambda: legacy_douglas_peucker(xy, 25))
+    assert kept == [xy[i] for i in numpy.flatnonzero(track.douglas_peucker(x, y, 25))]
+    print('%-22s %8d %10s %10s %10.2f' % ('legacy simplify=25', len(kept), '', '', elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
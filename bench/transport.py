@@ -0,0 +1,114 @@
+'''throughput benchmark for proto.transport.stream
+
+compares the incremental framer with the previous split-based implementation on
+UD heartbeats (one frame per segment and pipelined) and on TK voice frames
+arriving in TCP-sized segments.
+
+run from the repository root:  python -m bench.transport
+'''
+
+import binascii
+import logging
+import struct
+import time
+
+from proto import transport
+from proto.message import message
+
+log = logging.getLogger('gpstrack.proto.transport')
+
+
+class legacy_stream:
+    '''proto.transport.stream before the bytearray framer, kept for comparison'''
+
+    def __init__(self):
+        self.buffer = b''
+
+    def send(self, data):
+        log.debug('data received: %r', data)
+        self.buffer += data
+        p = self.buffer.split(b'*', 3)
+        if len(p) < 4:
+            if len(self.buffer) > 1024*1024:
+                raise transport.ProtocolException('message size limit exceeded')
+            return
+
+        company, device_id, length, msg = p
+        prefix_size = sum(len(i)+1 for i in p[:3])
+        length = struct.unpack('>H', binascii.unhexlify(length))[0]
+        company = company[1:]
+
+        if len(msg) <= length:
+            return
+
+        raw = self.buffer[:prefix_size+length+1]
+        self.buffer = msg[length+1:]
+        self.message_received(message(company, device_id, msg[:length], raw))
+
+    def message_received(self, msg):
+        return None
+
+
+REPEAT = 3
+
+def counting(cls):
+    class counter(cls):
+        frames = 0
+        def message_received(self, msg):
+            counter.frames += 1
+    return counter
+
+
+UD = (b'UD,130117,205703,V,55.816945,N,37.6242950,E,0.00,0.0,0.0,0,98,100,58698,0,00000008,'
+      b'7,255,250,1,1603,12125,143,1603,12122,150,1603,14983,140,1603,12126,134,1603,8256,133,'
+      b'1603,12123,133,1603,12121,127,0,62.8')
+
+def frame(data):
+    return b'[3G*3202613806*' + binascii.hexlify(struct.pack('>H', len(data))).upper() + b'*' + data + b']'
+
+def voice(size):
+    return frame(b'TK,' + bytes(bytearray(i % 251 for i in range(size - 3))))
+
+def segments(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+def scenarios():
+    ud = frame(UD)
+    yield 'UD, frame per segment', [ud]*20000, False
+    yield 'UD, 10 frames per segment', [ud*10]*2000, True
+    yield 'TK 8KB, 1460B segments', segments(voice(8*1024), 1460)*400, False
+    yield 'TK 60KB, 1460B segments', segments(voice(60*1024), 1460)*50, False
+
+
+def run(cls, chunks, drain):
+    st = counting(cls)()
+    st.__class__.frames = 0
+    started = time.perf_counter()
+    for c in chunks:
+        st.send(c)
+        if drain:
+            # the legacy framer hands out a single frame per call
+            n = -1
+            while n != st.frames:
+                n = st.frames
+                st.send(b'')
+    elapsed = time.perf_counter() - started
+    return elapsed, st.frames
+
+
+def main():
+    log.setLevel(logging.INFO)
+    print('%-28s %-8s %10s %12s %8s' % ('scenario', 'impl', 'MB/s', 'frames/s', 'speedup'))
+    for name, chunks, drain in scenarios():
+        size = sum(len(c) for c in chunks)
+        base = None
+        for impl, cls in (('legacy', legacy_stream), ('stream', transport.stream)):
+            elapsed, frames = min(run(cls, chunks, drain and cls is legacy_stream) for _ in range(REPEAT))
+            base = base or elapsed
+            print('%-28s %-8s %10.1f %12.0f %7.2fx' % (
+                name, impl, size / elapsed / 1e6, frames / elapsed, base / elapsed))
+
+
+if __name__ == '__main__':
+    main()
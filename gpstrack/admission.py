@@ -0,0 +1,75 @@
+import asyncio
+import collections
+import time
+
+
+class Admission:
+    '''caps how many tasks run a section at once, `async with admission:`
+
+    tasks over the limit wait in arrival order. plain futures instead of an
+    asyncio.Semaphore so an instance can be created before the loop runs.
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.waiting = collections.deque()
+        self.admitted = 0
+
+    async def __aenter__(self):
+        if self.running < self.limit and not self.waiting:
+            self.running += 1
+        else:
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiting.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.release() # admitted and cancelled at once, pass the slot on
+                else:
+                    self.waiting.remove(waiter)
+                raise
+        self.admitted += 1
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+    def release(self):
+        while self.waiting:
+            waiter = self.waiting.popleft()
+            if not waiter.done():
+                waiter.set_result(None) # the slot goes to the waiter, running stays
+                return
+        self.running -= 1
+
+
+class TokenBucket:
+    '''paces a section to `rate` per second with bursts of `burst`
+
+    take() reserves the next token and sleeps until it is due, so waiting
+    tasks go in arrival order, evenly spaced.
+    '''
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.clock = clock
+        self.tokens = self.burst
+        self.last = clock()
+        self.delayed = 0
+
+    def reserve(self):
+        '''take a token, returns the seconds until it is due'''
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        return max(-self.tokens / self.rate, 0)
+
+    async def take(self):
+        delay = self.reserve()
+        if delay:
+            self.delayed += 1
+            await asyncio.sleep(delay)
+        return delay
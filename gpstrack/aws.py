@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import os
+
+import aiobotocore
+from aiobotocore.config import AioConfig
+
+from gpstrack.metrics import REGISTRY
+
+log = logging.getLogger('gpstrack.aws')
+
+MAX_CONNECTIONS = int(os.environ.get('GPSWATCH_AWS_MAX_CONNECTIONS', 50))
+
+CALLS = REGISTRY.histogram('gpswatch_aws_call_seconds', 'aws api call latency', ('service', 'op'))
+ERRORS = REGISTRY.counter('gpswatch_aws_call_errors_total', 'failed aws api calls', ('service', 'op'))
+
+class MeteredClient:
+    '''wraps an aiobotocore client and counts API calls in flight'''
+
+    def __init__(self, pool, name, client):
+        self._pool = pool
+        self._name = name
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in self._client.meta.method_to_api_mapping:
+            return attr
+
+        pool, service = self._pool, self._name
+        key = (service, name)
+        async def call(*args, **kwargs):
+            pool.acquire(service)
+            loop = asyncio.get_event_loop()
+            started = loop.time()
+            try:
+                return await attr(*args, **kwargs)
+            except Exception:
+                ERRORS[key] += 1
+                raise
+            finally:
+                pool.release(service)
+                CALLS[key].observe(loop.time() - started)
+        return call
+
+class ClientPool:
+    '''process-wide aws clients shared by every watch connection
+
+    one session and one client per service, each client keeps a single http
+    connection pool limited by max_connections. in_flight/saturation show how
+    close every service is to that limit, calls above it wait in aiohttp.
+    '''
+
+    def __init__(self, loop, max_connections=MAX_CONNECTIONS):
+        self.loop = loop
+        self.max_connections = max_connections
+        self.session = aiobotocore.get_session(loop=loop)
+        self.config = AioConfig(max_pool_connections=max_connections)
+        self.clients = {}
+
+        self.in_flight = {}
+        self.peak = {}
+        self.saturated = {} # calls started while every connection was busy
+
+    def client(self, name):
+        if name not in self.clients:
+            log.info('creating %s client, max %s connections', name, self.max_connections)
+            client = self.session.create_client(name, region_name=os.environ['AWS_REGION'],
+                    aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+                    aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                    config=self.config)
+            self.clients[name] = MeteredClient(self, name, client)
+            self.in_flight[name] = self.peak[name] = self.saturated[name] = 0
+        return self.clients[name]
+
+    @property
+    def sns(self):
+        return self.client('sns')
+
+    @property
+    def dynamo(self):
+        return self.client('dynamodb')
+
+    @property
+    def sqs(self):
+        return self.client('sqs')
+
+    def acquire(self, service):
+        n = self.in_flight[service]
+        if n >= self.max_connections:
+            self.saturated[service] += 1
+        self.in_flight[service] = n + 1
+        if n + 1 > self.peak[service]:
+            self.peak[service] = n + 1
+
+    def release(self, service):
+        self.in_flight[service] -= 1
+
+    def saturation(self, service):
+        return self.in_flight[service] / self.max_connections
+
+    def stats(self):
+        return {
+            service: {
+                'in_flight': self.in_flight[service],
+                'peak': self.peak[service],
+                'saturated': self.saturated[service],
+                'saturation': self.saturation(service),
+            } for service in self.clients
+        }
+
+    async def report(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            for service, st in self.stats().items():
+                log.info('%s pool: in flight %s, peak %s/%s, saturated calls %s', service,
+                        st['in_flight'], st['peak'], self.max_connections, st['saturated'])
+                self.peak[service] = self.in_flight[service]
+
+    async def close(self):
+        clients, self.clients = self.clients, {}
+        for name, client in clients.items():
+            log.info('closing %s client', name)
+            await client._client.close()
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+
+log = logging.getLogger('gpstrack.batchread')
+
+BATCH_GET_SIZE = 100 # BatchGetItem limit
+
+class BatchReader:
+    '''merges concurrent reads of single keys into batch reads
+
+    get(key) waits for the coroutine fetch(keys), which returns values by key,
+    a key it does not return reads as None. a batch goes out max_delay after
+    its first key or as soon as it has max_batch keys; a key asked for twice
+    before that is fetched once.
+    '''
+
+    def __init__(self, fetch, max_batch=BATCH_GET_SIZE, max_delay=0.002):
+        self.fetch = fetch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = {}
+        self.timer = None
+        self.batches = 0
+        self.keys = 0
+
+    def get(self, key):
+        waiter = self.pending.get(key)
+        if waiter is None:
+            loop = asyncio.get_event_loop()
+            waiter = self.pending[key] = loop.create_future()
+            if len(self.pending) >= self.max_batch:
+                self.flush()
+            elif self.timer is None:
+                self.timer = loop.call_later(self.max_delay, self.flush)
+        # one reader giving up does not cancel the others
+        return asyncio.shield(waiter)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, {}
+        if batch:
+            asyncio.ensure_future(self.read(batch))
+
+    async def read(self, batch):
+        self.batches += 1
+        self.keys += len(batch)
+        try:
+            found = await self.fetch(list(batch))
+        except Exception as ex:
+            log.warning('batch read of %s keys failed', len(batch), exc_info=True)
+            for waiter in batch.values():
+                if not waiter.done():
+                    waiter.set_exception(ex)
+            return
+        for key, waiter in batch.items():
+            if not waiter.done():
+                waiter.set_result(found.get(key))
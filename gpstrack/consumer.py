@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import os
+import time
+
+from gpstrack import logs, metrics
+
+log = logging.getLogger('gpstrack.consumer')
+
+QUEUE_HIGH = int(os.environ.get('GPSWATCH_CONN_QUEUE_BYTES', 256*1024))
+
+FRAMES = metrics.REGISTRY.counter('gpswatch_frames_total', 'frames parsed', ('direction', 'cmd'))
+RECEIVED = metrics.REGISTRY.counter('gpswatch_received_bytes_total', 'bytes received', ('side',))
+PARSE = metrics.REGISTRY.histogram('gpswatch_parse_seconds', 'time in stream.send() per received chunk', ('side',),
+        buckets=(.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005, .01))
+
+class OrderedConsumer:
+    '''one consumer task per connection, frames are handled strictly in order
+
+    received chunks wait in a queue, the transport stops reading while more
+    than QUEUE_HIGH bytes are queued and resumes below half of that.
+    subclasses handle frames in process_frame().
+
+    when the connection is lost the chunks received so far are still handled,
+    `lost` tells process_frame() there is no one to answer. consumers are only
+    cancelled when the process shuts down, see cancel_consumers().
+    '''
+
+    consumers = set()
+    queued_total = 0
+    paused_total = 0
+    pauses = 0
+    frozen = False # set while connections are handed over, keeps reading paused
+
+    def start_consumer(self):
+        self.chunks = asyncio.Queue()
+        self.queued = 0
+        self.paused = False
+        self.busy = False
+        self.frames = []
+        self.lost = False
+        self.consumer = asyncio.ensure_future(self.consume())
+        OrderedConsumer.consumers.add(self.consumer)
+        self.consumer.add_done_callback(OrderedConsumer.consumers.discard)
+
+    def stop_consumer(self):
+        '''connection lost: the consumer ends after the chunks already queued'''
+        self.lost = True
+        self.chunks.put_nowait(None)
+        if self.paused:
+            OrderedConsumer.paused_total -= 1
+            self.paused = False
+
+    @classmethod
+    def cancel_consumers(cls):
+        '''process shutdown, returns what to wait for'''
+        tasks = list(cls.consumers)
+        for t in tasks:
+            t.cancel()
+        return asyncio.gather(*tasks, return_exceptions=True)
+
+    @property
+    def idle(self):
+        return not self.queued and not self.busy
+
+    def data_received(self, data):
+        # with the arrival time, the start of the trace of a frame it completes
+        self.chunks.put_nowait((data, time.time()))
+        self.queued += len(data)
+        OrderedConsumer.queued_total += len(data)
+        if not self.paused and self.queued > QUEUE_HIGH:
+            log.debug('%s bytes queued, pause reading', self.queued, extra={'context': self.context})
+            self.transport.pause_reading()
+            self.paused = True
+            OrderedConsumer.paused_total += 1
+            OrderedConsumer.pauses += 1
+
+    def message_received(self, msg):
+        FRAMES[msg.direction, msg.cmd] += 1
+        self.frames.append(msg)
+
+    async def consume(self):
+        logs.context.set(self.context)
+        loop = asyncio.get_event_loop()
+        parse = PARSE[self.side]
+        while True:
+            chunk = await self.chunks.get()
+            if chunk is None:
+                break
+            data, self.received = chunk
+            self.busy = True
+            self.queued -= len(data)
+            OrderedConsumer.queued_total -= len(data)
+            started = loop.time()
+            try:
+                self.send(data)
+            except Exception:
+                # the stream can not be resynchronized after a broken frame
+                log.exception('protocol error, closing connection')
+                self.transport.close()
+            finally:
+                frames, self.frames = self.frames, []
+                parse.observe(loop.time() - started)
+                RECEIVED[self.side] += len(data)
+
+            for msg in frames:
+                try:
+                    await self.process_frame(msg)
+                except Exception:
+                    log.exception('failed to process %s', msg.cmd)
+            self.busy = False
+
+            if self.paused and self.queued <= QUEUE_HIGH // 2 and not self.frozen and not self.transport.is_closing():
+                self.transport.resume_reading()
+                self.paused = False
+                OrderedConsumer.paused_total -= 1
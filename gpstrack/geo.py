@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+
+import aiohttp
+
+from proto import geo
+
+log = logging.getLogger('gpstrack.geo')
+
+CONCURRENCY = int(os.environ.get('GPSWATCH_GEO_CONCURRENCY', 8))
+TIMEOUT = float(os.environ.get('GPSWATCH_GEO_TIMEOUT', 5))
+BATCH_DELAY = float(os.environ.get('GPSWATCH_GEO_BATCH_DELAY', 0.02))
+
+class GeoClient:
+    '''asyncio cell tower geolocation for the server
+
+    shares the normalized keys, the answer cache and the cells table with
+    proto.geo.locator. lookups that miss the cache are collected for
+    batch_delay, deduplicated and then requested over one pooled aiohttp
+    session with at most `concurrency` requests in flight. callers asking for
+    a tower set that is already pending wait for the same future. a request
+    failing or timing out resolves to None and is not cached.
+    '''
+
+    def __init__(self, key, url=geo.GEOLOCATE_URL, concurrency=CONCURRENCY, timeout=TIMEOUT,
+            batch_delay=BATCH_DELAY, locator=None):
+        self.key = key
+        self.url = url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.batch_delay = batch_delay
+        self.locator = locator or geo.locator(fetch=None)
+        self.session = None
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.pending = {}
+        self.batch = []
+        self.flushing = None # the flush collecting self.batch
+        self.flushes = set() # flushes not done yet, close() waits for them
+
+        self.failed = 0
+        self.batches = 0
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+
+    async def close(self):
+        while self.flushes:
+            await asyncio.gather(*self.flushes)
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def lookup(self, info):
+        '''geolocation answer for a gsm_info list, None if it can not be resolved'''
+        key = geo.towers(info)
+        if key is None:
+            return None
+        answer = self.locator.cached(key)
+        if answer is not None:
+            return answer
+
+        fut = self.pending.get(key)
+        if fut is None:
+            fut = self.pending[key] = asyncio.get_event_loop().create_future()
+            self.batch.append(key)
+            if self.flushing is None:
+                self.flushing = asyncio.ensure_future(self.flush())
+                self.flushes.add(self.flushing)
+                self.flushing.add_done_callback(self.flushes.discard)
+        else:
+            self.locator.coalesced += 1
+        return await asyncio.shield(fut)
+
+    async def flush(self):
+        try:
+            await asyncio.sleep(self.batch_delay)
+            batch, self.batch = self.batch, []
+            self.batches += 1
+        finally:
+            # lookups from now on start the next batch, it does not wait for this one
+            self.flushing = None
+        await asyncio.gather(*[self.resolve(key) for key in batch])
+
+    async def resolve(self, key):
+        answer = None
+        try:
+            async with self.semaphore:
+                self.locator.requests += 1
+                async with self.session.post(self.url, params={'key': self.key}, json=geo.request_body(key)) as res:
+                    answer = self.locator.store(key, await res.json(content_type=None))
+                if not answer or 'location' not in answer:
+                    log.warning('geolocation failed: %s', answer)
+                    self.failed += 1
+                    answer = None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            log.warning('geolocation request failed: %r', e)
+            self.failed += 1
+        finally:
+            fut = self.pending.pop(key)
+            if not fut.done():
+                fut.set_result(answer)
+
+    def stats(self):
+        stats = self.locator.stats()
+        stats.update(failed=self.failed, batches=self.batches, in_flight=len(self.pending))
+        return stats
+
@@ -0,0 +1,63 @@
+import array
+import json
+import logging
+import os
+import socket
+import struct
+
+log = logging.getLogger('gpstrack.handover')
+
+MAX_FDS = 16
+
+def send(sock, state, fds=()):
+    '''send a json state with file descriptors over a blocking unix socket
+
+    the 4 byte length prefix carries the descriptors (SCM_RIGHTS), the json
+    follows. dynamo records in the state may hold bytes, they are ascii base64.
+    '''
+    data = json.dumps(state, default=lambda b: b.decode('ascii')).encode()
+    anc = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))] if fds else []
+    sock.sendmsg([struct.pack('>I', len(data))], anc)
+    sock.sendall(data)
+
+def recv(sock):
+    '''receive a state sent by send(), returns (state, fds)'''
+    fds = array.array('i')
+    header, anc, flags, addr = sock.recvmsg(4, socket.CMSG_SPACE(MAX_FDS * fds.itemsize))
+    if not header:
+        raise ConnectionError('handover connection closed')
+    for level, tp, data in anc:
+        if level == socket.SOL_SOCKET and tp == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    if flags & socket.MSG_CTRUNC:
+        raise ConnectionError('file descriptors truncated')
+
+    header += recv_exactly(sock, 4 - len(header))
+    data = recv_exactly(sock, struct.unpack('>I', header)[0])
+    return json.loads(data.decode()), list(fds)
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('handover connection closed')
+        data += chunk
+    return bytes(data)
+
+def listen(path):
+    '''non blocking unix socket for takeover requests, stale path is replaced'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock.bind(path)
+    sock.listen(1)
+    sock.setblocking(False)
+    return sock
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    return sock
@@ -0,0 +1,100 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+FORMAT = '%(asctime)s P%(process)s C%(context)s %(levelname)-8s %(name)-15s: %(message)s'
+
+# the connection a task works for, set by the task itself: every asyncio task
+# runs in a copy of its creator's context, so setting it affects nothing else
+context = contextvars.ContextVar('context', default='GLOBAL')
+
+
+class ContextFilter(logging.Filter):
+    '''adds record.context unless the call passed one in extra'''
+
+    def filter(self, record):
+        if not hasattr(record, 'context'):
+            record.context = context.get()
+        return True
+
+
+class RateLimit(logging.Filter):
+    '''token bucket over the records of a logger, `rate` per second with bursts of `burst`
+
+    the number of dropped records is added to the next record let through.
+    '''
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.clock = clock
+        self.tokens = self.burst
+        self.last = clock()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                self.dropped += 1
+                return False
+            self.tokens -= 1
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            record.msg = '%s [%s similar records dropped]' % (record.msg, dropped)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    '''one json object per line'''
+
+    def format(self, record):
+        doc = {
+            'ts': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'context': getattr(record, 'context', None),
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            doc['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            doc['exc'] = record.exc_text
+        return json.dumps(doc)
+
+
+def setup(filename, level=logging.INFO, json_output=False, payload_rate=10):
+    '''log through a queue, the handlers write in a listener thread
+
+    the event loop only formats the message and puts the record on the queue,
+    the stream and the rotating file are written by the listener. payload dumps
+    (the gpstrack.payload logger) are limited to payload_rate records/s.
+    '''
+    formatter = JsonFormatter() if json_output else logging.Formatter(FORMAT)
+    handlers = [logging.StreamHandler(), logging.handlers.TimedRotatingFileHandler(filename, when='D', backupCount=10)]
+    for h in handlers:
+        h.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(ContextFilter())
+    listener = logging.handlers.QueueListener(records, *handlers)
+
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    logging.getLogger('gpstrack.payload').addFilter(RateLimit(payload_rate))
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
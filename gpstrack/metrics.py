@@ -0,0 +1,171 @@
+import asyncio
+import bisect
+import logging
+
+log = logging.getLogger('gpstrack.metrics')
+
+class Histogram:
+    '''fixed bucket latency histogram, values are seconds'''
+
+    BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        '''upper bound of the bucket holding the q-th value, inf for the overflow bucket'''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+
+    def summary(self):
+        if not self.count:
+            return 'no samples'
+        return 'n=%s avg=%.3fs p50<=%ss p90<=%ss p99<=%ss' % (
+            self.count, self.sum / self.count, self.quantile(.5), self.quantile(.9), self.quantile(.99))
+
+
+class Counters(dict):
+    '''counter values by label values, COUNTER[key] += n on the hot path'''
+
+    def __missing__(self, key):
+        return 0
+
+class Histograms(dict):
+    '''histograms by label values, created on first use'''
+
+    def __init__(self, buckets=Histogram.BUCKETS):
+        super().__init__()
+        self.buckets = buckets
+
+    def __missing__(self, key):
+        h = self[key] = Histogram(self.buckets)
+        return h
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def labelset(names, key):
+    if not names:
+        return ''
+    values = key if isinstance(key, tuple) else (key,)
+    return '{%s}' % ','.join('%s="%s"' % (n, escape(v)) for n, v in zip(names, values))
+
+def number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    '''metrics in the prometheus text format
+
+    counters and histograms are plain dicts updated in place, nothing is
+    locked or computed until a scrape. gauges are functions called at scrape
+    time and return a number or a dict of numbers by label values.
+    '''
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        values = Counters()
+        self.metrics.append((name, help, 'counter', labels, values))
+        return values
+
+    def histogram(self, name, help, labels=(), buckets=Histogram.BUCKETS):
+        values = Histograms(buckets)
+        self.metrics.append((name, help, 'histogram', labels, values))
+        return values
+
+    def gauge(self, name, help, fn, labels=()):
+        self.metrics.append((name, help, 'gauge', labels, fn))
+
+    def render(self):
+        out = []
+        for name, help, kind, labels, values in self.metrics:
+            if kind == 'gauge':
+                try:
+                    values = values()
+                except Exception:
+                    log.exception('gauge %s failed', name)
+                    continue
+                if not isinstance(values, dict):
+                    values = {(): values}
+            out.append('# HELP %s %s' % (name, help))
+            out.append('# TYPE %s %s' % (name, kind))
+            for key, value in sorted(values.items(), key=lambda kv: str(kv[0])):
+                if kind != 'histogram':
+                    out.append('%s%s %s' % (name, labelset(labels, key), number(value)))
+                    continue
+                keys = (key if isinstance(key, tuple) else (key,)) if labels else ()
+                seen = 0
+                for bound, n in zip(value.buckets + (float('inf'),), value.counts):
+                    seen += n
+                    out.append('%s_bucket%s %s' % (name, labelset(labels + ('le',), keys + (number(bound),)), seen))
+                out.append('%s_sum%s %s' % (name, labelset(labels, key), number(value.sum)))
+                out.append('%s_count%s %s' % (name, labelset(labels, key), value.count))
+        return '\n'.join(out) + '\n'
+
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    '''GET of any path answers REGISTRY.render(), HTTP/1.0 one request per connection'''
+
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+
+    async def start(self, host, port, sock=None):
+        '''listen on host:port, or on sock, a listening socket handed over by another process'''
+        if sock is not None:
+            self.server = await asyncio.start_server(self.handle, sock=sock)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        log.info('metrics endpoint listening on %s:%s', host, port)
+        return self.server
+
+    def close(self):
+        self.server.close()
+        return self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            if request.startswith(b'GET '):
+                body = self.registry.render().encode()
+                writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                        b'Content-Length: %d\r\n\r\n' % len(body) + body)
+            else:
+                writer.write(b'HTTP/1.0 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n')
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+
+LOOP_LAG = REGISTRY.histogram('gpswatch_loop_lag_seconds', 'delay of a timer on the event loop beyond its due time',
+        buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+
+async def measure_loop_lag(interval=0.5):
+    loop = asyncio.get_event_loop()
+    lag = LOOP_LAG[()]
+    while True:
+        due = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag.observe(max(loop.time() - due, 0))
@@ -0,0 +1,79 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import time
+
+from proto.cache import ttl_cache
+
+log = logging.getLogger('gpstrack.push')
+
+MAX_CLOCK_SKEW = 60
+SEEN_SIZE = 100000
+
+def sign(key, body):
+    return hmac.new(key, body, hashlib.sha256).hexdigest().encode()
+
+class PushServer:
+    '''authenticated downlink endpoint for the webhook
+
+    every request is one line "<hex hmac-sha256 of json> <json>", the json is
+    {"id": ..., "cmd": ..., "direction": ..., "sent": unix time, "item": dynamo
+    record}. the coroutine deliver(request) returns True if the frame was
+    written to an online watch; the answer line is "ok", "offline" or "error" and the client
+    falls back to sqs for anything but "ok". an id is accepted once: a request
+    replayed while its "sent" is within the clock skew is an error.
+    '''
+
+    def __init__(self, key, deliver):
+        self.key = key.encode() if isinstance(key, str) else key
+        self.deliver = deliver
+        # ids are kept until a request sent with them is stale on either side of the skew
+        self.seen = ttl_cache(maxsize=SEEN_SIZE, ttl=2 * MAX_CLOCK_SKEW)
+
+    async def start(self, host, port, sock=None):
+        '''listen on host:port, or on sock, a listening socket handed over by another process'''
+        if sock is not None:
+            self.server = await asyncio.start_server(self.handle, sock=sock)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        log.info('push endpoint listening on %s:%s', host, port)
+        return self.server
+
+    def close(self):
+        self.server.close()
+        return self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(await self.process(line.strip()) + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            log.warning('push connection failed', exc_info=True)
+        finally:
+            writer.close()
+
+    async def process(self, line):
+        try:
+            sig, body = line.split(b' ', 1)
+            if not hmac.compare_digest(sig, sign(self.key, body)):
+                log.warning('push request with invalid signature')
+                return b'error'
+            req = json.loads(body.decode())
+            if abs(time.time() - req['sent']) > MAX_CLOCK_SKEW:
+                log.warning('stale push request: %s', req['id'])
+                return b'error'
+            ident = json.dumps(req['id'], sort_keys=True)
+            if ident in self.seen:
+                log.warning('replayed push request: %s', req['id'])
+                return b'error'
+            self.seen.set(ident, True)
+            return b'ok' if await self.deliver(req) else b'offline'
+        except Exception:
+            log.exception('failed to process push request')
+            return b'error'
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import math
+import time
+
+log = logging.getLogger('gpstrack.reaper')
+
+class IdleReaper:
+    '''finds connections nothing was received from for `timeout` seconds
+
+    a timer wheel of `tick` second slots covering the timeout, not a timer per
+    connection. a connection sits in the slot of its deadline; receiving only
+    sets conn.last_seen, the wheel is not touched. when a slot comes due every
+    connection in it is checked: one heard from since is moved to the slot of
+    its new deadline, an idle one is passed to reap(conn). reap() returns False
+    to keep a connection for another timeout (one that can not be judged
+    now), anything else counts it as reaped.
+    '''
+
+    def __init__(self, timeout, reap, tick=1., clock=time.monotonic):
+        self.timeout = timeout
+        self.reap = reap
+        self.tick = tick
+        self.clock = clock
+        self.slots = [set() for i in range(int(math.ceil(timeout / tick)) + 1)]
+        self.done = int(clock() // tick) # the last tick handled by advance()
+        self.slot = {}
+        self.reaped = 0
+
+    def add(self, conn):
+        conn.last_seen = self.clock()
+        self.schedule(conn, conn.last_seen + self.timeout)
+
+    def discard(self, conn):
+        n = self.slot.pop(conn, None)
+        if n is not None:
+            self.slots[n].discard(conn)
+
+    def schedule(self, conn, due):
+        at = max(int(math.ceil(due / self.tick)), self.done + 1)
+        n = at % len(self.slots)
+        self.slots[n].add(conn)
+        self.slot[conn] = n
+
+    def advance(self, now=None):
+        '''check the slots due by now, returns the number of connections reaped'''
+        now = self.clock() if now is None else now
+        current = int(now // self.tick)
+        reaped = 0
+        # after a stall longer than the wheel every slot is due, once
+        for t in range(max(self.done + 1, current - len(self.slots) + 1), current + 1):
+            n = t % len(self.slots)
+            due, self.slots[n] = self.slots[n], set()
+            self.done = t
+            for conn in due:
+                del self.slot[conn]
+                deadline = conn.last_seen + self.timeout
+                if deadline > now:
+                    self.schedule(conn, deadline)
+                elif self.reap(conn) is False:
+                    self.schedule(conn, now + self.timeout)
+                else:
+                    reaped += 1
+        self.done = max(self.done, current)
+        self.reaped += reaped
+        return reaped
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                self.advance()
+            except Exception:
+                log.exception('reaper failed')
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import logging
+
+log = logging.getLogger('gpstrack.registry')
+
+def encode(msg):
+    # dynamo records carry base64 blobs as bytes
+    return json.dumps(msg, default=lambda b: b.decode('ascii')).encode() + b'\n'
+
+class RegistryBroker:
+    '''device -> worker registry living in the supervisor process
+
+    workers connect over a unix socket and send newline separated json:
+    {"op": "online"|"offline", "device": id} when a watch (dis)appears and
+    {"op": "result", "seq": n, "ok": bool} to answer a delivery. deliver()
+    forwards a downlink request to the worker that owns the device as
+    {"op": "deliver", "seq": n, "req": request} and waits for the result.
+    '''
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self.owners = {}
+        self.pending = {}
+        self.seq = 0
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self.handle, self.path)
+        log.info('registry listening on %s', self.path)
+
+    def close(self):
+        self.server.close()
+        return self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line.decode())
+                op = msg['op']
+                if op == 'online':
+                    self.owners[msg['device']] = writer
+                elif op == 'offline':
+                    # the device may already have reconnected to another worker
+                    if self.owners.get(msg['device']) is writer:
+                        del self.owners[msg['device']]
+                elif op == 'result':
+                    fut = self.pending.get(msg['seq'])
+                    if fut and not fut[0].done():
+                        fut[0].set_result(msg['ok'])
+        except (ConnectionError, ValueError, KeyError):
+            log.exception('registry connection failed')
+        finally:
+            for device in [d for d, w in self.owners.items() if w is writer]:
+                del self.owners[device]
+            for fut, w in self.pending.values():
+                if w is writer and not fut.done():
+                    fut.set_result(False)
+            writer.close()
+
+    async def deliver(self, req):
+        writer = self.owners.get(req['item']['device_id']['S'])
+        if writer is None:
+            return False
+
+        self.seq += 1
+        seq = self.seq
+        fut = asyncio.get_event_loop().create_future()
+        self.pending[seq] = (fut, writer)
+        try:
+            writer.write(encode({'op': 'deliver', 'seq': seq, 'req': req}))
+            return await asyncio.wait_for(fut, self.timeout)
+        except asyncio.TimeoutError:
+            log.warning('worker did not answer delivery to %s', req['item']['device_id']['S'])
+            return False
+        finally:
+            self.pending.pop(seq, None)
+
+class RegistryClient:
+    '''worker side of the registry: announces devices, executes deliveries'''
+
+    def __init__(self, path, deliver):
+        self.path = path
+        self.deliver = deliver
+        self.writer = None
+
+    async def connect(self, devices=()):
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        for device in devices:
+            self.online(device)
+        self.task = asyncio.ensure_future(self.serve(reader))
+
+    def send(self, msg):
+        if self.writer is not None:
+            self.writer.write(encode(msg))
+
+    def online(self, device):
+        self.send({'op': 'online', 'device': device})
+
+    def offline(self, device):
+        self.send({'op': 'offline', 'device': device})
+
+    async def serve(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line.decode())
+                if msg['op'] == 'deliver':
+                    try:
+                        ok = self.deliver(msg['req'])
+                    except Exception:
+                        log.exception('delivery failed')
+                        ok = False
+                    self.send({'op': 'result', 'seq': msg['seq'], 'ok': ok})
+        finally:
+            log.error('registry connection lost')
+            self.writer.close()
+            self.writer = None
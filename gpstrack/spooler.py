@@ -0,0 +1,89 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import uuid
+
+from proto import spool
+from proto.message import message
+
+log = logging.getLogger('gpstrack.spooler')
+
+
+class Spooler:
+    '''proto.spool.directory with the file i/o on one worker thread
+
+    the framer's writes are queued in order instead of blocking the loop.
+    load() reads a finished frame back on the same thread, so it sees every
+    write queued before it, and removes the file: the record gets the payload
+    inline, the webhook can not read the server's disk.
+    '''
+
+    def __init__(self, path):
+        self.store = spool.directory(path)
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='spool')
+
+    def submit(self, fn, *args):
+        return self.executor.submit(logged, fn, *args)
+
+    def create(self, prefix):
+        return writer(self, '%s-%s' % (prefix, uuid.uuid4().hex))
+
+    def resume(self, ref, length):
+        '''continue an object another process has started writing'''
+        return writer(self, os.path.basename(ref), length)
+
+    def remove(self, ref):
+        self.submit(self.store.remove, ref)
+
+    async def load(self, msg):
+        '''a spooled message as a plain one with raw and params'''
+        raw = await asyncio.get_event_loop().run_in_executor(self.executor, self.read_frame, msg)
+        data = raw[raw.index(b'*', raw.index(b'*', raw.index(b'*') + 1) + 1) + 1:-1]
+        loaded = message(msg.company.encode(), msg.device_id.encode(), data, raw)
+        loaded.ts, loaded.trace, loaded.direction = msg.ts, msg.trace, msg.direction
+        return loaded
+
+    def read_frame(self, msg):
+        raw = b''.join(spool.frame_chunks(msg, self.store))
+        self.store.remove(msg.spool[0])
+        return raw
+
+def logged(fn, *args):
+    try:
+        return fn(*args)
+    except Exception:
+        log.exception('spool i/o failed')
+        raise
+
+class writer:
+    '''a proto.spool.writer whose calls run on the spooler's thread'''
+
+    def __init__(self, spooler, ref, length=0):
+        self.spooler = spooler
+        self.ref = ref
+        self.length = length
+        self.file = spooler.submit(spool.writer, spooler.store, ref, length)
+
+    def call(self, name, *args):
+        # the thread runs in order, the writer is created by then
+        return self.spooler.submit(lambda: getattr(self.file.result(), name)(*args))
+
+    def write(self, data):
+        self.length += len(data)
+        self.call('write', data)
+
+    def flush(self):
+        '''wait for the queued writes, e.g. before another process resumes the object'''
+        self.call('flush').result()
+
+    def close(self):
+        self.call('close')
+        return self.ref
+
+    def abort(self):
+        self.call('abort')
+
+def from_env(name):
+    path = os.environ.get(name)
+    return Spooler(path) if path else None
@@ -0,0 +1,47 @@
+import atexit
+import os
+import queue
+import threading
+
+from proto import trace
+
+
+class ThreadedCollector(trace.collector):
+    '''proto.trace.collector for the server, the file is written in a thread
+
+    span() only puts the line on a queue, like the log records of
+    gpstrack.logs. the thread writes whatever is queued at once, whole lines
+    in one write() so the files shared by workers do not interleave.
+    '''
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.lines = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name='trace', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, data):
+        self.lines.put(data)
+
+    def run(self):
+        while True:
+            lines = [self.lines.get()]
+            while not self.lines.empty():
+                lines.append(self.lines.get())
+            done = None in lines
+            data = b''.join(l for l in lines if l is not None)
+            if data:
+                os.write(self.fd, data)
+            if done:
+                return
+
+    def close(self):
+        if self.thread.is_alive():
+            self.lines.put(None)
+            self.thread.join()
+            super().close()
+
+def from_env(name):
+    path = os.environ.get(name)
+    return ThreadedCollector(path) if path else None
@@ -0,0 +1,175 @@
+import asyncio
+import binascii
+import json
+import logging
+import os
+import time
+
+from gpstrack.metrics import REGISTRY
+
+log = logging.getLogger('gpstrack.writebehind')
+
+BATCH_WRITE_SIZE = 25   # BatchWriteItem limit
+PUBLISH_BATCH_SIZE = 10 # PublishBatch limit
+
+MAX_DELAY = float(os.environ.get('GPSWATCH_WRITE_DELAY', 0.05))
+MAX_PENDING = int(os.environ.get('GPSWATCH_WRITE_PENDING', 10000))
+SHARDS = int(os.environ.get('GPSWATCH_WRITE_SHARDS', 4))
+
+STORED = REGISTRY.histogram('gpswatch_store_delay_seconds',
+        'time from WriteBehind.put() until the message is written to dynamo / published to sns', ('stage',))
+
+class WriteBehind:
+    '''collects messages from every connection and stores them in batches
+
+    messages are spread over shards by device_id, every shard has one bounded
+    queue and one flusher task. a flusher takes up to 25 messages (or whatever
+    arrived within max_delay after the first one), writes them with
+    BatchWriteItem, retries unprocessed items and then publishes them to sns
+    with PublishBatch. a shard flushes one batch at a time, so messages of one
+    device reach dynamo and sns in the order they were received.
+
+    the trace context of a traced message (see proto.trace) goes into its sns
+    body, the time it waited in the queue, the batch write and the publish
+    are recorded as spans when a tracer (a proto.trace.collector) is given.
+    '''
+
+    def __init__(self, pool, table='gpswatch', topic='gpswatch',
+            max_delay=MAX_DELAY, max_pending=MAX_PENDING, shards=SHARDS, max_retries=8, tracer=None):
+        self.pool = pool
+        self.tracer = tracer
+        self.table = table
+        self.topic = topic
+        self.topic_arn = None
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.queues = [asyncio.Queue(maxsize=max(max_pending // shards, BATCH_WRITE_SIZE)) for i in range(shards)]
+        self.tasks = []
+
+        self.written = 0
+        self.published = 0
+        self.retried = 0
+        self.dropped = 0
+
+    async def start(self):
+        self.topic_arn = (await self.pool.sns.create_topic(Name=self.topic))['TopicArn']
+        self.tasks = [asyncio.ensure_future(self.flusher(q)) for q in self.queues]
+
+    async def close(self):
+        for q in self.queues:
+            await q.join()
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    @property
+    def pending(self):
+        return sum(q.qsize() for q in self.queues)
+
+    async def put(self, msg):
+        '''queue message for storing, waits while the shard is full'''
+        ident = msg.identifier
+        doc = {'id': ident, 'cmd': msg.cmd, 'direction': msg.direction}
+        traced = None
+        if msg.trace:
+            doc['trace'] = msg.trace
+            traced = (msg.trace, time.time())
+        body = json.dumps(doc)
+        shard = binascii.crc32(ident['device_id'].encode()) % len(self.queues)
+        await self.queues[shard].put((msg.to_dynamo(), body, asyncio.get_event_loop().time(), traced))
+
+    async def flusher(self, queue):
+        loop = asyncio.get_event_loop()
+        carry = None
+        while True:
+            batch = [carry or await queue.get()]
+            deadline = loop.time() + self.max_delay
+            carry = self.take(queue, batch)
+            if carry is None and len(batch) < BATCH_WRITE_SIZE and deadline > loop.time():
+                await asyncio.sleep(deadline - loop.time())
+                carry = self.take(queue, batch)
+
+            try:
+                await self.flush(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.dropped += len(batch)
+                log.exception('failed to store %s messages', len(batch))
+            finally:
+                for i in batch:
+                    queue.task_done()
+
+    def take(self, queue, batch):
+        '''fill batch from the queue, returns an entry left for the next batch'''
+        keys = set(self.key(entry[0]) for entry in batch)
+        while len(batch) < BATCH_WRITE_SIZE and not queue.empty():
+            entry = queue.get_nowait()
+            # BatchWriteItem rejects two puts of one key, keep it for the next batch
+            if self.key(entry[0]) in keys:
+                return entry
+            keys.add(self.key(entry[0]))
+            batch.append(entry)
+
+    @staticmethod
+    def key(item):
+        return item['device_id']['S'], item['ts']['N']
+
+    async def backoff(self, attempt, what):
+        if attempt >= self.max_retries:
+            raise RuntimeError('%s: giving up after %s attempts' % (what, attempt))
+        self.retried += 1
+        await asyncio.sleep(min(0.05 * 2 ** attempt, 5))
+
+    async def flush(self, batch):
+        requests = [{'PutRequest': {'Item': item}} for item, body, queued, traced in batch]
+        tracer = self.tracer
+        started = time.time()
+        attempt = 0
+        while requests:
+            try:
+                res = await self.pool.dynamo.batch_write_item(RequestItems={self.table: requests})
+                requests = res.get('UnprocessedItems', {}).get(self.table, [])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.warning('batch write failed, attempt %s', attempt, exc_info=True)
+            if requests:
+                log.debug('%s unprocessed items, retrying', len(requests))
+                await self.backoff(attempt, 'batch write')
+                attempt += 1
+        self.written += len(batch)
+        now = asyncio.get_event_loop().time()
+        written = STORED['dynamo']
+        for item, body, queued, traced in batch:
+            written.observe(now - queued)
+            if traced and tracer:
+                tracer.span(traced[0], 'queue', traced[1], started)
+                tracer.span(traced[0], 'dynamo', started, batch=len(batch), attempts=attempt + 1)
+
+        for i in range(0, len(batch), PUBLISH_BATCH_SIZE):
+            entries = [{'Id': str(n), 'Message': body} for n, (item, body, queued, traced) in enumerate(batch[i:i+PUBLISH_BATCH_SIZE])]
+            started = time.time()
+            attempt = 0
+            while entries:
+                try:
+                    res = await self.pool.sns.publish_batch(TopicArn=self.topic_arn, PublishBatchRequestEntries=entries)
+                    failed = set(f['Id'] for f in res.get('Failed', []))
+                    self.published += len(entries) - len(failed)
+                    entries = [e for e in entries if e['Id'] in failed]
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    log.warning('publish batch failed, attempt %s', attempt, exc_info=True)
+                if entries:
+                    await self.backoff(attempt, 'publish batch')
+                    attempt += 1
+            if tracer:
+                for item, body, queued, traced in batch[i:i+PUBLISH_BATCH_SIZE]:
+                    if traced:
+                        tracer.span(traced[0], 'sns', started, attempts=attempt + 1)
+        now = asyncio.get_event_loop().time()
+        published = STORED['sns']
+        for item, body, queued, traced in batch:
+            published.observe(now - queued)
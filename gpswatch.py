@@ -1,63 +1,172 @@
-import logging.handlers
+import logging
+import argparse
 import asyncio
+import signal
+import sys
 import secrets
 import binascii
-import os
 import json
-import aiobotocore
-
-from cached_property import cached_property
-
+import os
+import decimal
+import time
+import base64
+import socket
+
+from gpstrack import handover, logs, metrics, spooler, tracing
+from gpstrack.admission import Admission, TokenBucket
+from gpstrack.aws import ClientPool
+from gpstrack.batchread import BatchReader
+from gpstrack.consumer import OrderedConsumer
+from gpstrack.geo import GeoClient
+from gpstrack.push import PushServer
+from gpstrack.reaper import IdleReaper
+from gpstrack.registry import RegistryBroker, RegistryClient
+from gpstrack.writebehind import WriteBehind
 from proto.transport import stream
 from proto.message import message
+from proto import trace
+from proto.cache import ttl_cache
 
 log = logging.getLogger('gpstrack.gpswatch')
 
+SETTINGS_CACHE_SIZE = int(os.environ.get('GPSWATCH_SETTINGS_CACHE_SIZE', 20000))
+SETTINGS_CACHE_TTL = float(os.environ.get('GPSWATCH_SETTINGS_CACHE_TTL', 60))
+SETTINGS_BATCH_DELAY = float(os.environ.get('GPSWATCH_SETTINGS_BATCH_DELAY', 0.002)) # collect settings reads for a BatchGetItem
+SQS_POLLERS = int(os.environ.get('GPSWATCH_SQS_POLLERS', 4))
+PORT = int(os.environ.get('GPSWATCH_PORT', 8001))
+UPSTREAM = ('52.28.132.157', 8001)
+WORKERS = int(os.environ.get('GPSWATCH_WORKERS', 0))
+REGISTRY_PATH = os.environ.get('GPSWATCH_REGISTRY', '/tmp/gpswatch-%s.sock')
+HANDOVER_PATH = os.environ.get('GPSWATCH_HANDOVER', '/tmp/gpswatch-handover.sock')
+PUSH_KEY = os.environ.get('GPSWATCH_PUSH_KEY')
+PUSH_HOST = os.environ.get('GPSWATCH_PUSH_HOST', '127.0.0.1') # the address the webhook reaches, plaintext
+PUSH_PORT = int(os.environ.get('GPSWATCH_PUSH_PORT', 8002))
+GOOGLE_KEY = os.environ.get('GOOGLE_KEY')
+GEO_ALARM_WAIT = float(os.environ.get('GPSWATCH_GEO_ALARM_WAIT', 0.2)) # an AL is stored without the position after that
+LOG_LEVEL = os.environ.get('GPSWATCH_LOG_LEVEL', 'INFO').upper()
+LOG_JSON = os.environ.get('GPSWATCH_LOG_JSON') == '1'
+PAYLOAD_LOG_RATE = float(os.environ.get('GPSWATCH_PAYLOAD_LOG_RATE', 10))
+METRICS_HOST = os.environ.get('GPSWATCH_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('GPSWATCH_METRICS_PORT', 8003)) # 0 disables, worker n uses port + 1 + n
+TRACER = tracing.from_env('GPSWATCH_TRACE_FILE') # spans of traced frames, see proto.trace
+TRACE_CMDS = set(os.environ.get('GPSWATCH_TRACE_CMDS', 'AL,UD,UD2').split(','))
+HEARTBEAT = float(os.environ.get('GPSWATCH_HEARTBEAT', 300)) # seconds between the LK heartbeats of a watch
+HEARTBEAT_MISSES = int(os.environ.get('GPSWATCH_HEARTBEAT_MISSES', 3)) # silent for this many heartbeats: closed, 0 never
+INIT_CONCURRENCY = int(os.environ.get('GPSWATCH_INIT_CONCURRENCY', 100)) # first LKs of new connections handled at once
+UPSTREAM_CONNECT_RATE = float(os.environ.get('GPSWATCH_UPSTREAM_CONNECT_RATE', 1000)) # per second and process, 0 unpaced
+UPSTREAM_CONNECT_BURST = int(os.environ.get('GPSWATCH_UPSTREAM_CONNECT_BURST', 100))
+
+UPSTREAM_CONNECT = metrics.REGISTRY.histogram('gpswatch_upstream_connect_seconds', 'time to connect to the upstream server')
+UPSTREAM_ERRORS = metrics.REGISTRY.counter('gpswatch_upstream_connect_errors_total', 'failed upstream connects')
+INIT_WAIT = metrics.REGISTRY.histogram('gpswatch_init_wait_seconds',
+        'time the first LK of a connection waited for admission and for an upstream connect token', ('stage',))
+REAPED = metrics.REGISTRY.counter('gpswatch_reaped_connections_total',
+        'watch connections closed by the server: idle for too long or replaced by a new one of the device', ('reason',))
+
 class MessageQueue:
-    def __init__(self, loop):
-        self.loop = loop
-        self.topic = None
-
-    def create_client(self, client):
-        aws_key_id = os.environ['AWS_ACCESS_KEY_ID']
-        aws_key_secret = os.environ['AWS_SECRET_ACCESS_KEY']
-        aws_region = os.environ['AWS_REGION']
-        session = aiobotocore.get_session(loop=self.loop)
-        return session.create_client(client, region_name=aws_region,
-                aws_secret_access_key=aws_key_secret,
-                aws_access_key_id=aws_key_id)
-
-    @cached_property
+    def __init__(self, pool):
+        self.pool = pool
+        self.writer = WriteBehind(pool, tracer=TRACER)
+        self.settings = ttl_cache(maxsize=SETTINGS_CACHE_SIZE, ttl=SETTINGS_CACHE_TTL)
+        # cache misses of concurrent connections are read together, see get_settings()
+        self.settings_reader = BatchReader(self.read_settings, max_delay=SETTINGS_BATCH_DELAY)
+        self.geo = GeoClient(GOOGLE_KEY) if GOOGLE_KEY else None
+
+    @property
     def sns(self):
-        return self.create_client('sns')
+        return self.pool.sns
 
-    @cached_property
+    @property
     def dynamo(self):
-        return self.create_client('dynamodb')
+        return self.pool.dynamo
 
-    async def send_message(self, msg):
-        if self.topic is None:
-            self.topic = await self.sns.create_topic(Name="gpswatch")
+    async def start(self):
+        await self.writer.start()
+        if self.geo:
+            await self.geo.start()
 
-        await self.dynamo.put_item(
-            TableName='gpswatch',
-            Item=msg.to_dynamo()
-        )
-
-        await self.sns.publish(
-            TopicArn=self.topic['TopicArn'],
-            Message=json.dumps({'id': msg.identifier, 'cmd': msg.cmd, 'direction': msg.direction}),
-        )
+    async def close(self):
+        await self.writer.close()
+        if self.geo:
+            await self.geo.close()
 
-    async def get_setings(self, device_id):
-        return await self.dynamo.get_item(
-            TableName='gpswatch',
-            Key={'device_id': {'S': device_id}, 'ts': {'N': '0'}},
-            ConsistentRead=True,
-        )
+    async def send_message(self, msg):
+        ld = msg.location_data
+        if self.geo and ld and ld.type == 'V':
+            # no gps fix, store the cell tower position with the record
+            started = time.time()
+            ld.gsm_location = await self.locate(msg.cmd, ld.gsm_info)
+            if msg.trace and TRACER:
+                TRACER.span(msg.trace, 'geo', started)
+        await self.writer.put(msg)
+
+    async def locate(self, cmd, gsm_info):
+        '''cell tower position, None when it can not be had (in time for an alarm)'''
+        try:
+            if cmd == 'AL':
+                # the lookup goes on and is cached, the alarm does not wait for it
+                return await asyncio.wait_for(asyncio.shield(self.geo.lookup(gsm_info)), GEO_ALARM_WAIT)
+            return await self.geo.lookup(gsm_info)
+        except asyncio.TimeoutError:
+            return None
+        except Exception:
+            log.warning('geolocation of %s failed', ','.join(gsm_info), exc_info=True)
+            return None
+
+    async def report(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            st = self.settings.stats()
+            log.info('settings cache: %s entries, %s hits, %s misses, %s evictions',
+                    st['size'], st['hits'], st['misses'], st['evictions'])
+            if self.geo:
+                log.info('geolocation: %s', self.geo.stats())
+
+    async def get_settings(self, device_id):
+        item = self.settings.get(device_id, self.settings.missing)
+        if item is self.settings.missing:
+            item = await self.settings_reader.get(device_id)
+            self.remember_settings(device_id, item)
+        return {} if item is None else {'Item': item}
+
+    def remember_settings(self, device_id, item):
+        # a device without host and port is being registered by the webhook,
+        # a cached copy would keep sending it the secret
+        if item is not None and 'host' in item and 'port' in item:
+            self.settings.set(device_id, item)
+        else:
+            self.settings.invalidate(device_id)
+
+    async def read_settings(self, device_ids):
+        '''settings rows by device_id, one consistent BatchGetItem per 100'''
+        found = await self.get_objects([(d, '0') for d in device_ids])
+        return dict((d, found.get((d, '0'))) for d in device_ids)
+
+    async def get_objects(self, keys):
+        '''consistent BatchGetItem of (device_id, ts) keys, returns items by key'''
+        # dynamo returns numbers in canonical form, match them as decimals
+        wanted = dict(((d, decimal.Decimal(ts)), (d, ts)) for d, ts in keys)
+        keys = list(set(wanted.values()))
+        found = {}
+        for i in range(0, len(keys), 100):
+            request = {'gpswatch': {
+                'Keys': [{'device_id': {'S': d}, 'ts': {'N': ts}} for d, ts in keys[i:i+100]],
+                'ConsistentRead': True,
+            }}
+            attempt = 0
+            while request:
+                res = await self.dynamo.batch_get_item(RequestItems=request)
+                for item in res['Responses'].get('gpswatch', []):
+                    key = (item['device_id']['S'], decimal.Decimal(item['ts']['N']))
+                    found[wanted.get(key, key)] = item
+                request = res.get('UnprocessedKeys')
+                if request:
+                    await asyncio.sleep(min(0.05 * 2 ** attempt, 1))
+                    attempt += 1
+        return found
 
     async def update_settings(self, device_id, key, value):
-        return await self.dynamo.update_item(
+        res = await self.dynamo.update_item(
             TableName='gpswatch',
             Key={'device_id': {'S': device_id}, 'ts': {'N': '0'}},
             UpdateExpression="SET %s = :val"%key,
@@ -65,15 +174,25 @@ class MessageQueue:
                 ":val": value
             },
         )
+        item = self.settings.get(device_id, count=False)
+        if item is None:
+            self.settings.invalidate(device_id)
+        else:
+            item = dict(item, **{key: value})
+            item.setdefault('device_id', {'S': device_id})
+            self.remember_settings(device_id, item)
+        return res
+
+class GPSWatchClientProtocol(OrderedConsumer, asyncio.Protocol, stream):
+    side = 'server'
 
-class GPSWatchClientProtocol(asyncio.Protocol, stream):
     def __init__(self, server, loop):
         self.server = server
         self.loop = loop
         self.context = 'S'+self.server.context[1:]
         self.transport = None
         self.commands = []
-        self.queue = MessageQueue(loop)
+        self.queue = server.queue
         self.last_msg = None
         super().__init__()
 
@@ -81,49 +200,52 @@ class GPSWatchClientProtocol(asyncio.Protocol, stream):
         self.peername = transport.get_extra_info('peername')
         log.info('Connection to server made: %s', self.peername, extra={'context': self.context})
         self.transport = transport
+        self.start_consumer()
 
         cmds = self.commands
         self.command = []
         for c in cmds:
             asyncio.ensure_future(self.msg_from_watch(c))
 
-    def data_received(self, data):
-        asyncio.ensure_future(self.process_data(data))
-
-    @asyncio.coroutine
-    def process_data(self, data):
-        asyncio.Task.current_task().context = self.context
-        self.send(data)
-
-    @asyncio.coroutine
-    def msg_from_watch(self, msg):
-        asyncio.Task.current_task().context = self.context
+    async def msg_from_watch(self, msg):
+        logs.context.set(self.context)
         if self.transport:
             self.transport.write(msg.raw)
         else:
             self.commands.append(msg)
-        yield from self.queue.send_message(msg)
+        await self.queue.send_message(msg)
 
     def message_received(self, msg):
         msg.direction = 'server'
-        if self.server:
-            asyncio.ensure_future(self.server.msg_from_server(msg))
+        super().message_received(msg)
+
+    async def process_frame(self, msg):
+        await self.server.msg_from_server(msg)
 
     def connection_lost(self, exc):
         log.info('connection to server lost', extra={'context': self.context})
+        self.stop_consumer() # frames already received still reach the queue through the server side
         self.server.transport.close()
-        self.server = None
 
  
-class GPSWatchServerProtocol(asyncio.Protocol, stream):
+class GPSWatchServerProtocol(OrderedConsumer, asyncio.Protocol, stream):
     '''handle connection from watches, proxies it to original server and push to queue'''
 
+    side = 'watch'
     online = {}
-
-    def __init__(self, loop, server_host_port = ('127.0.0.1', 8001)):
+    connections = set()
+    registry = None # RegistryClient when running as a worker of the supervisor
+    spool_store = spooler.from_env('GPSWATCH_SPOOL_DIR') # large TK uploads, see proto.transport
+    # half-open connections of watches that lost the network are closed after missed heartbeats
+    reaper = IdleReaper(HEARTBEAT * HEARTBEAT_MISSES, lambda conn: conn.reap_idle()) if HEARTBEAT_MISSES else None
+    # a reconnect storm: settings reads, secret probes and upstream connects of first LKs are limited
+    admission = Admission(INIT_CONCURRENCY)
+    connect_pacing = TokenBucket(UPSTREAM_CONNECT_RATE, UPSTREAM_CONNECT_BURST) if UPSTREAM_CONNECT_RATE else None
+
+    def __init__(self, loop, queue, server_host_port = ('127.0.0.1', 8001)):
         try:
             self.loop = loop
-            self.queue = MessageQueue(loop)
+            self.queue = queue
             self.server_host_port = server_host_port
         except:
             log.exception('init failed')
@@ -131,15 +253,33 @@ class GPSWatchServerProtocol(asyncio.Protocol, stream):
         
         self.last_msg = None
         self.device_id = None
+        self.client = None
+        self.handed_over = False
+        self.context = 'W'+'{:#010x}'.format(binascii.crc32(str(id(self)).encode()))[2:].upper()
         super().__init__()
 
     def connection_made(self, transport):
         self.peername = transport.get_extra_info('peername')
-        self.context = 'W'+'{:#010x}'.format(binascii.crc32(str(id(self)).encode()))[2:].upper()
         
         log.info('Incoming connection from %s', self.peername, extra={'context': self.context})
         self.transport = transport
-        self.client = None
+        self.start_consumer()
+        GPSWatchServerProtocol.connections.add(self)
+        if self.reaper:
+            self.reaper.add(self)
+
+    def data_received(self, data):
+        self.last_seen = time.monotonic() # on the reaper's clock
+        super().data_received(data)
+
+    def reap_idle(self):
+        '''close the connection for the reaper, False while it can not be judged'''
+        if self.frozen or not self.idle:
+            return False
+        log.info('nothing received for %ss, closing', self.reaper.timeout, extra={'context': self.context})
+        REAPED['idle'] += 1
+        # abort: a dead peer never acknowledges what close() would wait to flush
+        self.transport.abort()
 
 
     '''
@@ -154,66 +294,144 @@ class GPSWatchServerProtocol(asyncio.Protocol, stream):
 
     def connection_lost(self, exc):
         log.info('connection to watches lost', extra={'context': self.context})
+        GPSWatchServerProtocol.connections.discard(self)
+        if self.reaper:
+            self.reaper.discard(self)
+        self.stop_consumer()
+        if not self.handed_over:
+            self.abort_spool() # otherwise the new process continues it
 
         if self.device_id:
             if GPSWatchServerProtocol.online[self.device_id] == self:
                 GPSWatchServerProtocol.online.pop(self.device_id)
+                if self.registry and not self.handed_over:
+                    self.registry.offline(self.device_id)
 
-        if self.client.transport:
+        if self.client and self.client.transport:
             self.client.transport.close()
         self.client = None
 
-    def data_received(self, data):
-        asyncio.ensure_future(self.process_data(data))
+    def handover_state(self):
+        '''connection state and sockets for a new process, see take_over()'''
+        state = {
+            'context': self.context,
+            'device_id': self.device_id,
+            'buffer': base64.b64encode(self.buffer).decode(),
+            'last_msg': self.last_msg.to_dynamo() if self.last_msg else None,
+            'spool': self.spool_state(),
+            'upstream': None,
+        }
+        fds = [self.transport.get_extra_info('socket').fileno()]
+        if self.client and self.client.transport:
+            state['upstream'] = {'buffer': base64.b64encode(self.client.buffer).decode()}
+            fds.append(self.client.transport.get_extra_info('socket').fileno())
+        return state, fds
+
+    @classmethod
+    async def restore(cls, loop, queue, state, fds):
+        '''resume a connection handed over by the previous process'''
+        self = cls(loop, queue, server_host_port=UPSTREAM)
+        self.context = state['context']
+        self.buffer = bytearray(base64.b64decode(state['buffer']))
+        if state['last_msg']:
+            self.last_msg = message.from_dynamo(state['last_msg'])
+        if state.get('spool'):
+            self.resume_spool(state['spool'])
+        if state['upstream']:
+            # queued in client.commands until its socket is attached below
+            self.client = GPSWatchClientProtocol(self, loop)
+            self.client.buffer = bytearray(base64.b64decode(state['upstream']['buffer']))
+
+        self.device_id = state['device_id']
+        if self.device_id:
+            GPSWatchServerProtocol.online[self.device_id] = self
+            if self.registry:
+                self.registry.online(self.device_id)
 
-    @asyncio.coroutine
-    def process_data(self, data):
-        asyncio.Task.current_task().context = self.context
-        self.send(data)
+        await loop.connect_accepted_socket(lambda: self, socket.socket(fileno=fds[0]))
+        if self.client:
+            await loop.connect_accepted_socket(lambda: self.client, socket.socket(fileno=fds[1]))
+        return self
 
-    @asyncio.coroutine
-    def msg_from_server(self, msg):
-        asyncio.Task.current_task().context = self.context
-        self.send_message(msg)
-        yield from self.queue.send_message(msg)
+    async def msg_from_server(self, msg):
+        logs.context.set(self.context)
+        if not self.transport.is_closing():
+            self.send_message(msg)
+        await self.queue.send_message(msg)
 
     async def msg_from_watch(self, msg):
-        asyncio.Task.current_task().context = self.context
-        if self.client is None:
+        logs.context.set(self.context)
+        if self.client is None and not self.lost:
             log.debug('initialize connection to server')
             self.device_id = msg.identifier['device_id']
-            
-            GPSWatchServerProtocol.online[self.device_id] = self
+
+            old = GPSWatchServerProtocol.online.get(self.device_id)
+            if old is not self:
+                GPSWatchServerProtocol.online[self.device_id] = self
+                if self.registry:
+                    self.registry.online(self.device_id)
+                if old is not None:
+                    # the device reconnected, the old connection is dead even if no one told us
+                    log.info('device reconnected, closing its previous connection', extra={'context': old.context})
+                    REAPED['replaced'] += 1
+                    old.transport.abort()
 
             if msg.cmd != 'LK':
                 log.warning('connection is not ready, skip message')
                 return
-            settings = await self.queue.get_setings(msg.identifier['device_id'])
-            log.debug(settings)
-
-            if not 'Item' in settings:
-                log.debug('no settings found, initialize new device')
-                while True:
-                    sc = secrets.randbelow(10000000000)
-                    if not 'Item' in await self.queue.get_settings('SEC_%s'%sc):
-                        break
-
-                await self.queue.update_settings(msg.identifier['device_id'], 'secret', {'S': str(sc)})
-                settings['Item'] = {'secret': {'S': str(sc)}}
-
-            if not 'host' in settings['Item'] or not 'port' in settings['Item']:
-                log.debug('no host and port configured')
-                sc = settings['Item']['secret']['S']
-                await self.queue.update_settings('SEC_%s'%sc, 'ref_device_id', {'S': msg.identifier['device_id']})
-                sc_msg = message.from_command(msg.company, msg.device_id, 'MESSAGE', binascii.hexlify(sc.encode('utf-16-be')))
-                log.debug('sending message with secret code: %s'%sc)
-                self.transport.write(sc_msg.raw)
-            else:
-                self.client = GPSWatchClientProtocol(self, self.loop)
-                await self.loop.create_connection(lambda: self.client, settings['Item']['host']['S'], settings['Item']['port']['S'])
-
+            started = self.loop.time()
+            async with self.admission:
+                INIT_WAIT['admission'].observe(self.loop.time() - started)
+                upstream = await self.initialize(msg)
+            if upstream:
+                await self.connect_upstream(*upstream)
+
+        if self.lost:
+            # the watch is gone: nothing to forward, what it sent is still stored
+            if self.client and self.client.transport:
+                self.client.transport.close() # connected while the watch went away
+            await self.queue.send_message(msg)
+            return
         await self.client.msg_from_watch(msg)
 
+    async def initialize(self, msg):
+        '''first LK of a connection: settings and a secret for a new device, returns the upstream (host, port)'''
+        settings = await self.queue.get_settings(msg.identifier['device_id'])
+        log.debug('settings: %s', settings)
+
+        if not 'Item' in settings:
+            log.debug('no settings found, initialize new device')
+            while True:
+                sc = secrets.randbelow(10000000000)
+                if not 'Item' in await self.queue.get_settings('SEC_%s'%sc):
+                    break
+
+            await self.queue.update_settings(msg.identifier['device_id'], 'secret', {'S': str(sc)})
+            settings['Item'] = {'secret': {'S': str(sc)}}
+
+        if not 'host' in settings['Item'] or not 'port' in settings['Item']:
+            log.debug('no host and port configured')
+            sc = settings['Item']['secret']['S']
+            await self.queue.update_settings('SEC_%s'%sc, 'ref_device_id', {'S': msg.identifier['device_id']})
+            sc_msg = message.from_command(msg.company, msg.device_id, 'MESSAGE', binascii.hexlify(sc.encode('utf-16-be')))
+            log.debug('sending message with secret code: %s'%sc)
+            self.transport.write(sc_msg.raw)
+        else:
+            return settings['Item']['host']['S'], settings['Item']['port']['S']
+
+    async def connect_upstream(self, host, port):
+        '''paced by the token bucket, outside the admission: waiting for it holds no settings read'''
+        if self.connect_pacing:
+            INIT_WAIT['connect'].observe(await self.connect_pacing.take())
+        self.client = GPSWatchClientProtocol(self, self.loop)
+        started = self.loop.time()
+        try:
+            await self.loop.create_connection(lambda: self.client, host, port)
+        except OSError:
+            UPSTREAM_ERRORS[()] += 1
+            raise
+        UPSTREAM_CONNECT[()].observe(self.loop.time() - started)
+
     def send_message(self, msg):
         self.last_msg = msg
         self.transport.write(msg.raw)
@@ -223,81 +441,435 @@ class GPSWatchServerProtocol(asyncio.Protocol, stream):
         if self.last_msg and self.last_msg.cmd == msg.cmd: #link reply
             msg.payload = json.dumps(self.last_msg.identifier)
             self.last_msg = None
-        asyncio.ensure_future(self.msg_from_watch(msg))
+        if TRACER and msg.cmd in TRACE_CMDS:
+            msg.trace = trace.context(self.received)
+            TRACER.span(msg.trace, 'parse', self.received, cmd=msg.cmd, device_id=msg.identifier['device_id'])
+        super().message_received(msg)
 
-async def process_gpswatch_queue(loop):
-    queue = MessageQueue(loop)
+    async def process_frame(self, msg):
+        if msg.spool:
+            # received without growing the buffer, stored and forwarded as a plain frame
+            msg = await self.spool_store.load(msg)
+        await self.msg_from_watch(msg)
 
-    sqs = queue.create_client('sqs')
-    dynamo = queue.create_client('dynamodb')
+DOWNLINK_LATENCY = metrics.REGISTRY.histogram('gpswatch_downlink_latency_seconds',
+        'time from the webhook sending a command until it is written to the watch', ('path',))
 
-    q = await sqs.create_queue(QueueName='gpswatch-queue')
+def deliver_downlink(req):
+    '''write command record to the watch connection, False if it is not online here
+
+    req is {"item": dynamo record, "sent": unix time or None, "path": "sqs"|"push"}
+    '''
+    w_msg = req['item']
+    conn = GPSWatchServerProtocol.online.get(w_msg['device_id']['S'])
+    if conn is None:
+        return False
 
+    conn.send_message(message.from_dynamo(w_msg))
+    if req.get('sent') is not None:
+        DOWNLINK_LATENCY[req['path']].observe(max(time.time() - req['sent'], 0))
+    return True
+
+async def deliver_local(req):
+    return deliver_downlink(req)
+
+async def report_connections(interval=60):
     while True:
-        messages = await sqs.receive_message(QueueUrl=q['QueueUrl'], AttributeNames=['All'], WaitTimeSeconds=20)
-        for m in messages.get('Messages', []):
-            msg = json.loads(m['Body'])
-
-            w_msg = await dynamo.get_item(
-				TableName='gpswatch',
-				Key={'device_id': {'S': msg['id']['device_id']}, 'ts': {'N': msg['id']['ts']}},
-				ConsistentRead=True,
-			)
-            
-            w_msg = w_msg.get('Item')
-
-            if not w_msg:
-                log.info('No record found: %s'%msg)
-                continue
-            
-            if not msg['id']['device_id'] in GPSWatchServerProtocol.online:
-                log.info('No device online: %s'%msg['id']['device_id'])
+        await asyncio.sleep(interval)
+        log.info('%s connections, %s devices online, %s bytes queued, %s paused (%s pauses so far), %s reaped',
+                len(GPSWatchServerProtocol.connections), len(GPSWatchServerProtocol.online),
+                OrderedConsumer.queued_total, OrderedConsumer.paused_total, OrderedConsumer.pauses,
+                sum(REAPED.values()))
+
+async def report_downlink(interval=60):
+    while True:
+        await asyncio.sleep(interval)
+        for path, h in DOWNLINK_LATENCY.items():
+            log.info('downlink latency via %s: %s', path, h.summary())
+
+def register_gauges(pool, queue=None):
+    '''scrape time metrics of this process, see gpstrack.metrics'''
+    r = metrics.REGISTRY
+    r.gauge('gpswatch_connections', 'watch connections', lambda: len(GPSWatchServerProtocol.connections))
+    r.gauge('gpswatch_devices_online', 'devices online in this process', lambda: len(GPSWatchServerProtocol.online))
+    r.gauge('gpswatch_queued_bytes', 'received bytes waiting for the connection consumers', lambda: OrderedConsumer.queued_total)
+    r.gauge('gpswatch_paused_connections', 'connections not read because of queued bytes', lambda: OrderedConsumer.paused_total)
+    r.gauge('gpswatch_read_pauses', 'times reading was paused so far', lambda: OrderedConsumer.pauses)
+    r.gauge('gpswatch_buffer_bytes', 'partial frames held in connection buffers', buffer_sizes, ('side',))
+    r.gauge('gpswatch_write_buffer_bytes', 'bytes waiting in transport write buffers', write_buffer_sizes, ('side',))
+    admission = GPSWatchServerProtocol.admission
+    r.gauge('gpswatch_init_connections', 'first LKs being handled and waiting for admission',
+            lambda: {'running': admission.running, 'waiting': len(admission.waiting)}, ('state',))
+    pacing = GPSWatchServerProtocol.connect_pacing
+    if pacing:
+        r.gauge('gpswatch_upstream_connects_delayed', 'upstream connects paced by the token bucket so far', lambda: pacing.delayed)
+    r.gauge('gpswatch_aws_in_flight', 'aws api calls in flight',
+            lambda: dict((service, st['in_flight']) for service, st in pool.stats().items()), ('service',))
+    r.gauge('gpswatch_aws_saturated_calls', 'aws api calls started while every pooled connection was busy',
+            lambda: dict((service, st['saturated']) for service, st in pool.stats().items()), ('service',))
+    if queue is not None:
+        w = queue.writer
+        r.gauge('gpswatch_store_pending', 'messages waiting for the write behind', lambda: w.pending)
+        r.gauge('gpswatch_store_messages', 'messages handled by the write behind so far',
+                lambda: {'written': w.written, 'published': w.published, 'retried': w.retried, 'dropped': w.dropped},
+                ('result',))
+        r.gauge('gpswatch_settings_cache', 'settings cache size and counts so far', queue.settings.stats, ('stat',))
+        reader = queue.settings_reader
+        r.gauge('gpswatch_settings_reads', 'settings cache misses read so far and the batch reads they took',
+                lambda: {'keys': reader.keys, 'batches': reader.batches}, ('count',))
+
+def buffer_sizes():
+    sizes = {'watch': 0, 'server': 0}
+    for c in GPSWatchServerProtocol.connections:
+        sizes['watch'] += len(c.buffer)
+        if c.client:
+            sizes['server'] += len(c.client.buffer)
+    return sizes
+
+def write_buffer_sizes():
+    sizes = {'watch': 0, 'server': 0}
+    for c in GPSWatchServerProtocol.connections:
+        sizes['watch'] += c.transport.get_write_buffer_size()
+        if c.client and c.client.transport:
+            sizes['server'] += c.client.transport.get_write_buffer_size()
+    return sizes
+
+def start_metrics(loop, pool, queue=None, port=METRICS_PORT, sock=None):
+    '''the metrics endpoint and the loop lag probe, returns what to stop
+
+    sock is the listening socket taken over from the previous process. the
+    endpoint is not worth dying for: when the port is busy the process serves
+    without it.
+    '''
+    if not port:
+        return None, []
+    register_gauges(pool, queue)
+    server = metrics.MetricsServer()
+    try:
+        loop.run_until_complete(server.start(METRICS_HOST, port, sock=sock))
+    except OSError:
+        log.exception('no metrics endpoint, can not listen on %s:%s', METRICS_HOST, port)
+        server = None
+    return server, [asyncio.ensure_future(metrics.measure_loop_lag(), loop=loop)]
+
+async def process_gpswatch_queue(queue, deliver=deliver_local, pollers=SQS_POLLERS):
+    q = await queue.pool.sqs.create_queue(QueueName='gpswatch-queue')
+    await asyncio.gather(*[poll_gpswatch_queue(queue, q['QueueUrl'], deliver) for i in range(pollers)])
+
+async def poll_gpswatch_queue(queue, url, deliver):
+    sqs = queue.pool.sqs
+
+    while True:
+        try:
+            messages = await sqs.receive_message(QueueUrl=url, AttributeNames=['All'],
+                    MaxNumberOfMessages=10, WaitTimeSeconds=20)
+            messages = [(m, json.loads(m['Body'])) for m in messages.get('Messages', [])]
+            if not messages:
                 continue
 
-            d_msg = message.from_dynamo(w_msg)
-            GPSWatchServerProtocol.online[msg['id']['device_id']].send_message(d_msg)
+            records = await queue.get_objects([(msg['id']['device_id'], msg['id']['ts']) for m, msg in messages])
 
-            await sqs.delete_message(QueueUrl=q['QueueUrl'], ReceiptHandle=m['ReceiptHandle'])
+            delivered = []
+            for m, msg in messages:
+                w_msg = records.get((msg['id']['device_id'], msg['id']['ts']))
 
-if __name__ == '__main__':
+                if not w_msg:
+                    log.info('No record found: %s'%msg)
+                    continue
 
-    # configure logging to support execution context
-    loop = None
-    class ContextLogRecord(logging.LogRecord):
-        def __init__(self, *args, **kwargs):
-            super().__init__(*args, **kwargs)
-            
-            task = asyncio.Task.current_task(loop) if loop else None
-            context =  getattr(task, 'context', None)
-            if context:
-                self.context = context
-
-    class ContextFormatter(logging.Formatter):
-        def format(self, record):
-            if not hasattr(record, 'context'):
-                record.context = 'GLOBAL'
-            return super().format(record)
-
-    logging.setLogRecordFactory(ContextLogRecord)
-    logger = logging.getLogger()
-    handler = logging.StreamHandler()
-    handler.setFormatter(ContextFormatter('%(asctime)s P%(process)s C%(context)s %(levelname)-8s %(name)-15s: %(message)s'))
-    logger.addHandler(handler)
-    handler2 = logging.handlers.TimedRotatingFileHandler('gpswatch.log', when='D', backupCount=10)
-    handler2.setFormatter(ContextFormatter('%(asctime)s P%(process)s C%(context)s %(levelname)-8s %(name)-15s: %(message)s'))
-    logger.addHandler(handler2)
-    logger.setLevel(logging.DEBUG)
+                if not await deliver({'item': w_msg, 'sent': msg.get('sent'), 'path': 'sqs'}):
+                    log.info('No device online: %s'%msg['id']['device_id'])
+                    continue
 
-    loop = asyncio.get_event_loop()
-    coro = loop.create_server(lambda: GPSWatchServerProtocol(loop, server_host_port=('52.28.132.157', 8001)), '0.0.0.0', 8001)
-    asyncio.ensure_future(process_gpswatch_queue(loop), loop=loop)
-    server = loop.run_until_complete(coro)
+                delivered.append({'Id': str(len(delivered)), 'ReceiptHandle': m['ReceiptHandle']})
 
+            if delivered:
+                res = await sqs.delete_message_batch(QueueUrl=url, Entries=delivered)
+                for f in res.get('Failed', []):
+                    log.warning('failed to delete message: %s', f)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('failed to process queue messages')
+            await asyncio.sleep(1)
+
+def serve_watches(loop, queue, reuse_port=False):
+    coro = loop.create_server(lambda: GPSWatchServerProtocol(loop, queue, server_host_port=UPSTREAM),
+            '0.0.0.0', PORT, reuse_port=reuse_port)
+    return loop.run_until_complete(coro)
+
+def run(loop, stop):
+    '''run the loop until interrupted, then run the coroutines from stop() in order'''
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
+    for coro in stop():
+        loop.run_until_complete(coro)
+    loop.stop()
+
+async def cancel(tasks):
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def close_server(server):
+    server.close()
+    await server.wait_closed()
 
+async def hand_over(loop, server, sock, services):
+    '''pass the listening sockets and every watch connection to a new process
+
+    services are the other servers of the process by name, their listening
+    sockets go along, so the new process does not have to bind ports this
+    one still holds.
+    '''
+    conns = list(GPSWatchServerProtocol.connections)
+    log.info('handing over %s connections', len(conns))
+    transports = [t for c in conns for t in (c.transport, c.client and c.client.transport) if t]
+    OrderedConsumer.frozen = True
+    for t in transports:
+        t.pause_reading()
+
+    # let queued frames reach the upstream and the replies reach the watches
+    deadline = loop.time() + 5
+    await asyncio.sleep(0.1)
+    consumers = conns + [c.client for c in conns if c.client and c.client.transport]
+    while (any(t.get_write_buffer_size() for t in transports) or not all(c.idle for c in consumers)) \
+            and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+
+    sock.setblocking(True)
+    try:
+        services = dict((name, s) for name, s in services.items() if s is not None)
+        handover.send(sock, {'listen': len(server.sockets),
+                'services': dict((name, len(s.sockets)) for name, s in sorted(services.items()))},
+                [s.fileno() for s in server.sockets] +
+                [l.fileno() for name, s in sorted(services.items()) for l in s.sockets])
+        for c in conns:
+            if c.transport.is_closing():
+                continue
+            handover.send(sock, *c.handover_state())
+            c.handed_over = True
+        handover.send(sock, {'done': True})
+    except OSError:
+        log.exception('handover failed, keep serving')
+        for c in conns:
+            c.handed_over = False
+        OrderedConsumer.frozen = False
+        for t in transports:
+            t.resume_reading()
+        return
+    finally:
+        sock.close()
+
+    # the new process holds duplicates of the sockets, closing ours keeps them open
+    for s in services.values():
+        s.close() # the new process answers from now on
+    for c in conns:
+        if c.handed_over:
+            c.transport.abort()
     loop.stop()
 
+def take_over(loop, queue, listeners):
+    '''ask a running process for its sockets, returns the server or None
+
+    the listening sockets of the other services are put in listeners by name.
+    '''
+    try:
+        sock = handover.connect(HANDOVER_PATH)
+    except OSError:
+        log.info('no process to take over from')
+        return None
+
+    with sock:
+        state, fds = handover.recv(sock)
+        listening = [socket.socket(fileno=fd) for fd in fds]
+        at = state['listen']
+        for name, n in sorted(state.get('services', {}).items()):
+            listeners[name] = listening[at]
+            at += n
+        server = loop.run_until_complete(loop.create_server(
+            lambda: GPSWatchServerProtocol(loop, queue, server_host_port=UPSTREAM), sock=listening[0]))
+
+        n = 0
+        while True:
+            state, fds = handover.recv(sock)
+            if state.get('done'):
+                break
+            loop.run_until_complete(GPSWatchServerProtocol.restore(loop, queue, state, fds))
+            n += 1
+
+    log.info('took over %s connections', n)
+    return server
+
+def accept_handover(loop, server, services):
+    listener = handover.listen(HANDOVER_PATH)
+
+    def on_request():
+        sock, addr = listener.accept()
+        loop.remove_reader(listener.fileno())
+        listener.close()
+        os.unlink(HANDOVER_PATH)
+        asyncio.ensure_future(hand_over(loop, server, sock, services))
+    loop.add_reader(listener.fileno(), on_request)
+
+def run_single(loop, takeover=False):
+    '''everything in one process: watches, downlink queue and push endpoint'''
+    pool = ClientPool(loop)
+    queue = MessageQueue(pool)
+    loop.run_until_complete(queue.start())
+    listeners = {}
+    server = (takeover and take_over(loop, queue, listeners)) or serve_watches(loop, queue)
+    tasks = [
+        asyncio.ensure_future(process_gpswatch_queue(queue), loop=loop),
+        asyncio.ensure_future(pool.report(), loop=loop),
+        asyncio.ensure_future(queue.report(), loop=loop),
+        asyncio.ensure_future(report_downlink(), loop=loop),
+        asyncio.ensure_future(report_connections(), loop=loop),
+    ]
+    if GPSWatchServerProtocol.reaper:
+        tasks.append(asyncio.ensure_future(GPSWatchServerProtocol.reaper.run(), loop=loop))
+
+    metrics_server, metrics_tasks = start_metrics(loop, pool, queue, sock=listeners.get('metrics'))
+    tasks += metrics_tasks
+
+    push = None
+    if PUSH_KEY:
+        push = PushServer(PUSH_KEY, lambda req: deliver_local(dict(req, path='push')))
+        try:
+            loop.run_until_complete(push.start(PUSH_HOST, PUSH_PORT, sock=listeners.get('push')))
+        except OSError:
+            # the webhook falls back to sqs, downlink frames still get through
+            log.exception('no push endpoint, can not listen on port %s', PUSH_PORT)
+            push = None
+
+    accept_handover(loop, server, {'metrics': metrics_server and metrics_server.server,
+            'push': push and push.server})
+
+    def stop():
+        if push:
+            yield push.close()
+        if metrics_server:
+            yield metrics_server.close()
+        yield close_server(server)
+        yield cancel(tasks)
+        # watches stay connected until the process exits, their consumers stop here
+        yield OrderedConsumer.cancel_consumers()
+        yield queue.close()
+        yield pool.close()
+
+    run(loop, stop)
+
+WORKER_COMMAND = [sys.executable, os.path.abspath(__file__)]
+
+async def supervise_worker(n, registry, procs):
+    while True:
+        proc = await asyncio.create_subprocess_exec(*WORKER_COMMAND + ['--worker', str(n), '--registry', registry])
+        procs[n] = proc
+        log.info('worker %s started, pid %s', n, proc.pid)
+        code = await proc.wait()
+        log.error('worker %s (pid %s) exited with %s, restarting', n, proc.pid, code)
+        await asyncio.sleep(1)
+
+async def stop_workers(procs):
+    for proc in procs.values():
+        if proc.returncode is None:
+            proc.terminate()
+    for proc in procs.values():
+        await proc.wait()
+
+def run_supervisor(loop, workers):
+    '''fork workers sharing the port via SO_REUSEPORT, route downlink to the owning worker'''
+    registry = REGISTRY_PATH%os.getpid()
+    if os.path.exists(registry):
+        os.unlink(registry)
+    broker = RegistryBroker(registry)
+    loop.run_until_complete(broker.start())
+
+    pool = ClientPool(loop)
+    queue = MessageQueue(pool)
+    procs = {}
+    tasks = [asyncio.ensure_future(supervise_worker(n, registry, procs), loop=loop) for n in range(workers)]
+    tasks += [
+        asyncio.ensure_future(process_gpswatch_queue(queue, deliver=broker.deliver), loop=loop),
+        asyncio.ensure_future(pool.report(), loop=loop),
+    ]
+
+    metrics_server, metrics_tasks = start_metrics(loop, pool)
+    tasks += metrics_tasks
+
+    push = None
+    if PUSH_KEY:
+        push = PushServer(PUSH_KEY, lambda req: broker.deliver(dict(req, path='push')))
+        loop.run_until_complete(push.start(PUSH_HOST, PUSH_PORT))
+
+    def stop():
+        if push:
+            yield push.close()
+        if metrics_server:
+            yield metrics_server.close()
+        yield cancel(tasks)
+        yield stop_workers(procs)
+        yield broker.close()
+        yield pool.close()
+        os.unlink(registry)
+
+    run(loop, stop)
+
+def run_worker(loop, registry, n):
+    '''serve watches on the shared port, downlink arrives through the registry'''
+    pool = ClientPool(loop)
+    queue = MessageQueue(pool)
+    loop.run_until_complete(queue.start())
+
+    client = RegistryClient(registry, deliver_downlink)
+    GPSWatchServerProtocol.registry = client
+    loop.run_until_complete(client.connect())
+    server = serve_watches(loop, queue, reuse_port=True)
+    tasks = [
+        asyncio.ensure_future(pool.report(), loop=loop),
+        asyncio.ensure_future(queue.report(), loop=loop),
+        asyncio.ensure_future(report_downlink(), loop=loop),
+        asyncio.ensure_future(report_connections(), loop=loop),
+    ]
+    if GPSWatchServerProtocol.reaper:
+        tasks.append(asyncio.ensure_future(GPSWatchServerProtocol.reaper.run(), loop=loop))
+    metrics_server, metrics_tasks = start_metrics(loop, pool, queue, port=METRICS_PORT and METRICS_PORT + 1 + n)
+    tasks += metrics_tasks
+    # the supervisor is gone, let it start a new generation of workers
+    client.task.add_done_callback(lambda t: loop.stop())
+
+    def stop():
+        if metrics_server:
+            yield metrics_server.close()
+        yield close_server(server)
+        yield cancel(tasks)
+        # watches stay connected until the process exits, their consumers stop here
+        yield OrderedConsumer.cancel_consumers()
+        yield queue.close()
+        yield pool.close()
+
+    run(loop, stop)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='gps watch proxy server')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+            help='number of worker processes sharing the port, 0 to serve in this process')
+    parser.add_argument('--takeover', action='store_true',
+            help='take the port and live connections over from a running process')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--registry', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logs.setup('gpswatch.log' if args.worker is None else 'gpswatch.%s.log'%args.worker,
+            level=LOG_LEVEL, json_output=LOG_JSON, payload_rate=PAYLOAD_LOG_RATE)
 
+    loop = asyncio.get_event_loop()
+    if args.worker is not None:
+        run_worker(loop, args.registry, args.worker)
+    elif args.workers:
+        run_supervisor(loop, args.workers)
+    else:
+        run_single(loop, takeover=args.takeover)
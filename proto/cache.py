@@ -0,0 +1,60 @@
+import time
+
+from collections import OrderedDict
+
+
+class ttl_cache(object):
+    '''small LRU cache with per-entry expiration
+
+    shared by the asyncio server and the lambda webhook, so it is plain python
+    without locking. values are stored as is, callers must not mutate them.
+    '''
+
+    missing = object()
+
+    def __init__(self, maxsize=1024, ttl=60, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return self.get(key, self.missing, count=False) is not self.missing
+
+    def get(self, key, default=None, count=True):
+        entry = self.data.pop(key, None)
+        if entry is None or entry[0] < self.clock():
+            if count:
+                self.misses += 1
+            return default
+        self.data[key] = entry # most recently used goes last
+        if count:
+            self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        self.data.pop(key, None)
+        self.data[key] = (self.clock() + (self.ttl if ttl is None else ttl), value)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
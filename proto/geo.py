@@ -0,0 +1,159 @@
+import json
+import os
+import threading
+
+import requests
+
+from .cache import ttl_cache
+
+GEOLOCATE_URL = 'https://www.googleapis.com/geolocation/v1/geolocate'
+SIGNAL_STEP = 10
+CACHE_SIZE = int(os.environ.get('GEO_CACHE_SIZE', 4096))
+CACHE_TTL = float(os.environ.get('GEO_CACHE_TTL', 7 * 24 * 3600))
+CELLS_SIZE = int(os.environ.get('GEO_CELLS_SIZE', 65536))
+CELLS_TTL = float(os.environ.get('GEO_CELLS_TTL', 30 * 24 * 3600))
+
+
+def towers(info):
+    '''normalized cache key of the tower set in a UD gsm_info list
+
+    info is bsn, bst, mcc, mnc, then lac, cellid, signal for every tower.
+    the key is (mcc, mnc, ((lac, cellid, signal), ...)) with sorted towers and
+    the signal rounded to SIGNAL_STEP, None when there are no towers.
+    '''
+    bsn, bst, mcc, mnc = info[:4]
+    cells = []
+    for i in range(int(bsn)):
+        lac, cellid, ss = info[4+i*3: 4+3+i*3]
+        cells.append((int(lac), int(cellid), int(round(int(ss) / float(SIGNAL_STEP))) * SIGNAL_STEP))
+    if not cells:
+        return None
+    return int(mcc), int(mnc), tuple(sorted(cells))
+
+def request_body(key):
+    mcc, mnc, cells = key
+    return {'cellTowers': [
+        {
+            "cellId": cellid,
+            "locationAreaCode": lac,
+            "mobileCountryCode": mcc,
+            "mobileNetworkCode": mnc,
+            "age": 0,
+            "signalStrength": ss,
+        } for lac, cellid, ss in cells
+    ]}
+
+def google_geolocate(body):
+    res = requests.post(
+        GEOLOCATE_URL,
+        params={'key': os.environ['GOOGLE_KEY']},
+        headers={'Content-Type': 'application/json'},
+        data=json.dumps(body),
+    )
+    return res.json()
+
+
+class cells(object):
+    '''per cell positions learned from previous answers
+
+    every answer is credited to all towers of its set, a cell's position is
+    the mean of the answers it took part in. a tower set whose cells are all
+    known is estimated locally as the signal weighted mean of the cells.
+    '''
+
+    def __init__(self, maxsize=CELLS_SIZE, ttl=CELLS_TTL):
+        self.table = ttl_cache(maxsize, ttl)
+
+    def learn(self, key, answer):
+        mcc, mnc, towers = key
+        loc = answer['location']
+        for lac, cellid, ss in towers:
+            cell = (mcc, mnc, lac, cellid)
+            lat, lng, accuracy, n = self.table.get(cell, (0., 0., 0., 0), count=False)
+            self.table.set(cell, (lat + loc['lat'], lng + loc['lng'], max(accuracy, answer.get('accuracy', 0)), n + 1))
+
+    def estimate(self, key):
+        mcc, mnc, towers = key
+        lat = lng = weights = accuracy = 0.
+        for lac, cellid, ss in towers:
+            known = self.table.get((mcc, mnc, lac, cellid))
+            if known is None:
+                return None
+            w = max(ss, 1)
+            lat += known[0] / known[3] * w
+            lng += known[1] / known[3] * w
+            accuracy = max(accuracy, known[2])
+            weights += w
+        return {'location': {'lat': lat / weights, 'lng': lng / weights}, 'accuracy': accuracy, 'estimated': True}
+
+
+class locator(object):
+    '''cached cell tower geolocation
+
+    answers are cached per normalized tower set (LRU with ttl), tower sets made
+    of known cells are estimated from the cells table without a request, and
+    concurrent lookups of the same set wait for one request (single flight).
+    fetch(body) does the request and returns the decoded json answer.
+    '''
+
+    def __init__(self, fetch=google_geolocate, maxsize=CACHE_SIZE, ttl=CACHE_TTL, cells_table=None, timeout=30):
+        self.fetch = fetch
+        self.cache = ttl_cache(maxsize, ttl)
+        self.cells = cells_table or cells()
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.requests = 0
+        self.estimated = 0
+        self.coalesced = 0
+
+    def lookup(self, info):
+        key = towers(info)
+        if key is None:
+            return None
+        answer = self.cached(key)
+        if answer is not None:
+            return answer
+
+        with self.lock:
+            done = self.inflight.get(key)
+            if done is None:
+                self.inflight[key] = threading.Event()
+        if done is not None:
+            self.coalesced += 1
+            done.wait(self.timeout)
+            answer = self.cache.get(key, count=False)
+            if answer is not None:
+                return answer
+
+        try:
+            self.requests += 1
+            return self.store(key, self.fetch(request_body(key)))
+        finally:
+            if done is None:
+                with self.lock:
+                    self.inflight.pop(key).set()
+
+    def cached(self, key):
+        '''cached or estimated answer, None if a request is needed'''
+        answer = self.cache.get(key)
+        if answer is None:
+            answer = self.cells.estimate(key)
+            if answer is not None:
+                self.estimated += 1
+        return answer
+
+    def store(self, key, answer):
+        # errors are returned to the caller but not remembered
+        if answer and 'location' in answer:
+            self.cache.set(key, answer)
+            self.cells.learn(key, answer)
+        return answer
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats.update(requests=self.requests, estimated=self.estimated, coalesced=self.coalesced,
+                cells=len(self.cells.table))
+        return stats
+
+default = locator()
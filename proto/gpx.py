@@ -0,0 +1,29 @@
+import time
+
+HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+          '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="gpswatch">\n'
+          '<trk>\n<trkseg>\n')
+TRAILER = '</trkseg>\n</trk>\n</gpx>\n'
+POINT = '<trkpt lat="%s" lon="%s"><time>%s</time></trkpt>\n'
+BATCH = 512
+
+
+def format_time(ts):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(int(float(ts))))
+
+def chunks(points, batch=BATCH):
+    '''a one segment GPX 1.1 track as text pieces, written while points arrive
+
+    points is an iterable of (lat, lon, ts) with lat/lon as decimal strings and
+    ts in unix seconds. nothing but the current batch of points is held.
+    '''
+    yield HEADER
+    out = []
+    for lat, lon, ts in points:
+        out.append(POINT % (lat, lon, format_time(ts)))
+        if len(out) >= batch:
+            yield ''.join(out)
+            out = []
+    if out:
+        yield ''.join(out)
+    yield TRAILER
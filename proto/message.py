@@ -1,15 +1,31 @@
 import binascii
 import json
-import requests
 import ast
-import arrow
 import struct
 import six
 import os
-from cached_property import cached_property
+import time
+import datetime
 
+from . import geo
 
-class tstate:
+missing = object()
+
+
+class tstate(object):
+    '''terminal state bitfield, decoded once
+
+    check bit: & (1 << N)
+     0 - low battery
+     1 - out of fence state
+     2 - Into the fence state
+     3 - watch state
+    16 - SOS alarm
+    17 - low battery alarm
+    18 - out fence alarm
+    19 - into fence alarm
+    20 - remove watch alarm
+    '''
     ALBITS = {
             16: 'SOS',
             17: 'low battery',
@@ -17,102 +33,159 @@ class tstate:
             19: 'into fence',
             20: 'remove watch',
     }
+    ALARMS = sorted(ALBITS.items())
+
+    __slots__ = ('st', 'bits', 'alarm', 'on_wrist')
+
     def __init__(self, st):
         self.st = st
+        self.bits = bits = int(st, 16)
+        self.alarm = ''.join(name for bit, name in self.ALARMS if bits & (1 << bit))
+        self.on_wrist = not (bits & (1 << 3))
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+def epoch(date, time):
+    '''DDMMYY, HHmmss (utc) -> unix time, two digit years follow arrow: 69-99 are 19xx'''
+    if len(date) != 6 or len(time) != 6:
+        raise ValueError('invalid time %s %s' % (date, time))
+    yy = int(date[4:6])
+    days = datetime.date(1900 + yy if yy > 68 else 2000 + yy, int(date[2:4]), int(date[0:2])).toordinal()
+    hh, mm, ss = int(time[0:2]), int(time[2:4]), int(time[4:6])
+    if hh > 23 or mm > 59 or ss > 59:
+        raise ValueError('invalid time %s %s' % (date, time))
+    return (days - EPOCH_ORDINAL) * 86400 + hh * 3600 + mm * 60 + ss
+
+def _field(n):
+    return property(lambda self: self.fields[n].decode())
+
+class ld(object):
+    '''UD/UD2/AL location payload, fields are decoded on access
+
+    date, time, position[9], gsm, batt, steps, roll, tstate, gsm_info...
+    the raw params are split once, on first access, and the variable length
+    gsm_info tail is only split when it is asked for.
+    '''
+
+    __slots__ = ('params', '_fields', '_state', '_ts_num', '_gsm_location')
+
+    def __init__(self, params):
+        self.params = params
+        self._fields = None
+        self._state = None
+        self._ts_num = None
+        self._gsm_location = missing
 
     @property
-    def alarm(self):
-        tstate = struct.unpack('>L', binascii.unhexlify(self.st))[0]
-        al = []
-        for b in self.ALBITS:
-            if (tstate & (1 << b)):
-                al.append(self.ALBITS[b])
-        return ''.join(al)
+    def fields(self):
+        if self._fields is None:
+            self._fields = self.params.split(b',', 16)
+        return self._fields
+
+    date = _field(0)
+    time = _field(1)
+    type = _field(2)
+    gsm = _field(11)
+    batt = _field(12)
+    steps = _field(13)
+    roll = _field(14)
+    tstate = _field(15)
 
     @property
-    def on_wrist(self):
-        return not (struct.unpack('>L', binascii.unhexlify(self.st))[0] & (1 << 3))
+    def position(self):
+        return [f.decode() for f in self.fields[2:11]]
+
+    @property
+    def gsm_info(self):
+        return self.fields[16].decode().split(',') if len(self.fields) > 16 else []
+
+    @property
+    def state(self):
+        if self._state is None:
+            self._state = tstate(self.tstate)
+        return self._state
 
-class ld:
-    def __init__(self, params):
-        params = params.decode().split(',')
-        self.date, self.time = params[:2]
-        self.position = params[2:11]
-        self.gsm = params[11]
-        self.batt = params[12]
-        self.steps, self.roll, self.tstate = params[13:16]
-        self.gsm_info = params[16:]
-    
-        # tstate: struct.unpack('>L', binascii.unhexlify(tstate))
-        # check bit: & (1 << N)
-        #  0 - low battery
-        #  1 - out of fence state
-        #  2 - Into the fence state
-        #  3 - watch state
-        # 16 - SOS alarm
-        # 17 - low battery alarm
-        # 18 - out fence alarm
-        # 19 - into fence alarm
-        # 20 - remove watch alarm
-   
     @property
     def alarm(self):
-        return tstate(self.tstate).alarm
+        return self.state.alarm
 
     @property
     def on_wrist(self):
-        return tstate(self.tstate).on_wrist
+        return self.state.on_wrist
 
     @staticmethod
     def gsm_location_from_info(info):
         if not 'GOOGLE_KEY' in os.environ: return None
+        return geo.default.lookup(info)
 
-        sts = []
-        bsn, bst, mcc, mnc = info[:4]
-        for i in range(int(bsn)):
-            lac, cellid, ss = info[4+i*3: 4+3+i*3]
-            sts.append(
-				{
-					  "cellId": cellid,
-					  "locationAreaCode": lac,
-					  "mobileCountryCode": mcc,
-					  "mobileNetworkCode": mnc,
-					  "age": 0,
-					  "signalStrength": ss,
-				}
-			)
-        data = {'cellTowers': sts}
-
-        res = requests.post(
-            'https://www.googleapis.com/geolocation/v1/geolocate', 
-            params={'key': os.environ['GOOGLE_KEY']},
-            headers={'Content-Type': 'application/json'},
-            data = json.dumps(data)
-        ) 
-
-        return res.json()
-
-
-    @cached_property
+    @property
     def gsm_location(self):
-        return self.gsm_location_from_info(self.gsm_info)
+        if self._gsm_location is missing:
+            self._gsm_location = self.gsm_location_from_info(self.gsm_info)
+        return self._gsm_location
 
-    @cached_property
+    @gsm_location.setter
+    def gsm_location(self, answer):
+        self._gsm_location = answer
+
+    @property
     def lat(self):
-        return ('' if self.position[2] == 'N' else '-') + self.position[1]
+        f = self.fields
+        return ('' if f[4] == b'N' else '-') + f[3].decode()
 
-    @cached_property
+    @property
     def lon(self):
-        return ('' if self.position[4] == 'E' else '-') + self.position[3]
+        f = self.fields
+        return ('' if f[6] == b'E' else '-') + f[5].decode()
 
-    @cached_property
+    @property
     def ts_num(self):
-        return arrow.get(self.date+' '+self.time, 'DDMMYY HHmmss').timestamp
+        if self._ts_num is None:
+            f = self.fields
+            self._ts_num = epoch(f[0], f[1])
+        return self._ts_num
 
 def chunkstring(string, length):
     return (string[0+i:length+i] for i in range(0, len(string), length))
 
+# binary payloads (TK voice) escape the frame's special bytes as 0x7d 0x01..0x05
+ESCAPES = {b'\x01': b'\x7d', b'\x02': b'\x5b', b'\x03': b'\x5d', b'\x04': b'\x2c', b'\x05': b'\x2a'}
+
+def unescape(data):
+    '''undo the payload escaping in one pass'''
+    parts = data.split(b'\x7d')
+    out = [parts[0]]
+    for p in parts[1:]:
+        c = ESCAPES.get(p[:1])
+        out.append(b'\x7d' + p if c is None else c + p[1:])
+    return b''.join(out)
+
+# the crc32 input format is part of the stored row keys, the python2 backport
+# rendered bytes params with a leading b so that it matches python3 repr()
+CRC32_FORMAT = '%s.%s.%s.%s.%s'
+CRC32_FORMAT_PARAMS = "%s.%s.%s.b%s.%s" if six.PY2 else CRC32_FORMAT
+CRC32_FORMAT_SPOOL = '%s.%s.%s.spool:%s.%s'
+
+# sparse global secondary index (device_id, fix_ts) of the gps fixes: only
+# UD/UD2 rows with an 'A' fix carry fix_ts, so a track reads nothing else
+FIX_INDEX = 'fix'
+FIX_INDEX_KEY = 'fix_ts'
+
 class message(object):
+    '''one protocol frame
+
+    slotted, one is created per frame. identifier (and so crc32) is computed on
+    first use and kept until direction changes, the other key fields are only
+    set by the constructors. the cached dict is shared, do not mutate it.
+
+    a large payload received into a spool (see proto.spool) has params and raw
+    set to None and spool set to (ref, length) until the server loads it.
+    trace is the proto.trace context of a traced frame.
+    '''
+
+    __slots__ = ('raw', 'data', 'device_id', 'company', 'cmd', 'params', 'ts', 'payload', 'spool', 'trace',
+            '_direction', '_identifier', '_location_data')
+
     def __init__(self, company, device_id, data, raw):
         self.raw = raw        
         self.data = data
@@ -120,8 +193,27 @@ class message(object):
         self.company = company.decode()
         c = data.split(b',', 1)
         self.cmd, self.params = c[0].decode(), (None if len(c) == 1 else c[1])
-        self.ts = arrow.utcnow().timestamp
+        self.ts = int(time.time())
         self.payload = None
+        self.spool = None
+        self.trace = None
+        self.direction = None
+        self._location_data = missing
+
+    @classmethod
+    def from_spool(cls, company, device_id, cmd, ref, length):
+        msg = cls(company, device_id, cmd, None)
+        msg.spool = (ref, length)
+        return msg
+
+    @property
+    def direction(self):
+        return self._direction
+
+    @direction.setter
+    def direction(self, direction):
+        self._direction = direction
+        self._identifier = None
 
     def to_dynamo(self):
         ident = self.identifier
@@ -137,6 +229,9 @@ class message(object):
             except UnicodeDecodeError:
                 event['data_raw'] = {'B': binascii.b2a_base64(self.params)}
 
+        if self.spool:
+            event['spool'] = {'M': {'ref': {'S': self.spool[0]}, 'length': {'N': str(self.spool[1])}}}
+
         if self.payload:
             event['payload'] = {'S': self.payload}
 
@@ -145,11 +240,21 @@ class message(object):
         if ld:
             event['location'] = {'M': {
                 'ts': {'N': str(ld.ts_num)},
-                'type': {'S': ld.position[0]},
+                'type': {'S': ld.type},
                 'lat': {'N': ld.lat},
                 'lon': {'N': ld.lon},
                 'batt': {'N': ld.batt},
             }}
+            if ld.type == 'A' and self.cmd in ('UD', 'UD2'):
+                event[FIX_INDEX_KEY] = {'N': ident['ts']}
+            # resolved by the server for fixes without gps, never looked up here
+            gsm = ld._gsm_location
+            if ld.type == 'V' and gsm is not missing and gsm and 'location' in gsm:
+                event['location']['M']['lbs'] = {'M': {
+                    'lat': {'N': str(gsm['location']['lat'])},
+                    'lon': {'N': str(gsm['location']['lng'])},
+                    'accuracy': {'N': str(gsm.get('accuracy', 0))},
+                }}
 
         return event
 
@@ -163,6 +268,7 @@ class message(object):
             params = binascii.a2b_base64(data['data_raw']['B'])
         else:
             params = None
+        spool = data.get('spool')
 
         company, device_id = data['device_id']['S'].split('_', 2)
         msg = cls.from_command(
@@ -170,7 +276,8 @@ class message(object):
             data['cmd']['S'], 
             params = params,
             direction = data['direction']['S'],
-            ts = data['ts']['N'].split('.')[0]
+            ts = data['ts']['N'].split('.')[0],
+            spool = (spool['M']['ref']['S'], int(spool['M']['length']['N'])) if spool else None,
         )
 
         assert data['ts']['N'] == msg.identifier['ts'], 'in db: %s, expected %s'%(data['ts'], msg.identifier)
@@ -179,10 +286,12 @@ class message(object):
 
     @property
     def identifier(self):
-        return {
-            'ts': ('%s.%s'%(str(self.ts), self.crc32())).rstrip('0'), 
-            'device_id': '%s_%s'%(self.company, self.device_id)
-        }
+        if self._identifier is None:
+            self._identifier = {
+                'ts': ('%s.%s'%(str(self.ts), self.crc32())).rstrip('0'), 
+                'device_id': '%s_%s'%(self.company, self.device_id)
+            }
+        return self._identifier
 
     def to_json(self):
         return {
@@ -193,22 +302,25 @@ class message(object):
         }
 
     @classmethod
-    def from_command(cls, company, device_id, cmd, params=None, direction=None, ts=None, payload=None):
+    def from_command(cls, company, device_id, cmd, params=None, direction=None, ts=None, payload=None, spool=None):
         msg = cls.__new__(cls)
         msg.company = company
         msg.device_id = device_id
         msg.cmd = cmd
         msg.params = params.encode() if params is not None and not isinstance(params, bytes) else params
-        msg.ts = arrow.utcnow().timestamp if ts is None else ts
+        msg.ts = int(time.time()) if ts is None else ts
         msg.data = cmd.encode('ascii') + (b',%s'%msg.params if msg.params else b'')
-        msg.raw = b'[%s*%s*%s*%s]'%(
+        msg.raw = None if spool else b'[%s*%s*%s*%s]'%(
             company.encode('ascii'), 
             device_id.encode('ascii'),
             binascii.hexlify(struct.pack('>H', len(msg.data))).upper(),
             msg.data
         )
         msg.payload = payload
+        msg.spool = spool
+        msg.trace = None
         msg.direction = direction
+        msg._location_data = missing
         return msg
 
     @classmethod
@@ -229,18 +341,23 @@ class message(object):
         msg.ts = msg_st['ts']
         msg.direction = msg_st['from']
         msg.payload = None
+        msg.spool = None
+        msg.trace = None
         msg.raw = data
+        msg._location_data = missing
         return msg
 
-    @cached_property
+    @property
     def location_data(self):
-        if self.cmd not in ('UD', 'UD2', 'AL'): return None
-        return ld(self.params)
-    
+        if self._location_data is missing:
+            self._location_data = ld(self.params) if self.cmd in ('UD', 'UD2', 'AL') and self.params else None
+        return self._location_data
+
     def crc32(self):
         '''this code is so strange because of need to remain compatible with old data in database'''
         
-        fstr = "%s.%s.%s.b%s.%s" if six.PY2 and self.params is not None else '%s.%s.%s.%s.%s'  #some compatibility fixes with python2.7 backport
-        print ((fstr%(self.company, self.device_id, self.cmd, repr(self.params), self.direction)).encode())
+        if self.spool:
+            return binascii.crc32((CRC32_FORMAT_SPOOL%(self.company, self.device_id, self.cmd, self.spool[0], self.direction)).encode()) & 0xffffffff
+        fstr = CRC32_FORMAT_PARAMS if self.params is not None else CRC32_FORMAT
         return binascii.crc32((fstr%(self.company, self.device_id, self.cmd, repr(self.params), self.direction)).encode()) & 0xffffffff
 
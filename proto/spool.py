@@ -0,0 +1,101 @@
+import binascii
+import os
+import struct
+import uuid
+
+from .message import unescape
+
+CHUNK_SIZE = 64*1024
+
+
+class directory(object):
+    '''spool for large frame payloads, a local directory standing in for an
+    object store
+
+    the server writes a payload while it arrives instead of buffering it and
+    reads the frame back once it is complete (see gpstrack.spooler), records
+    carry the payload inline. readers open an object by ref as a stream, the
+    webhook only for records holding a ref, with SPOOL_DIR on the same store.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def create(self, prefix):
+        return writer(self, '%s-%s' % (prefix, uuid.uuid4().hex))
+
+    def resume(self, ref, length):
+        '''continue an object another process has started writing'''
+        return writer(self, os.path.basename(ref), length)
+
+    def open(self, ref):
+        return open(os.path.join(self.path, os.path.basename(ref)), 'rb')
+
+    def remove(self, ref):
+        try:
+            os.unlink(os.path.join(self.path, os.path.basename(ref)))
+        except OSError:
+            pass
+
+class writer(object):
+    '''an object being written, visible to readers only after close()'''
+
+    def __init__(self, store, ref, length=0):
+        self.ref = ref
+        self.length = length
+        self.final = os.path.join(store.path, ref)
+        self.part = self.final + '.part'
+        self.file = open(self.part, 'ab' if length else 'wb')
+        self.file.truncate(length)
+
+    def write(self, data):
+        self.file.write(data)
+        self.length += len(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        os.rename(self.part, self.final)
+        return self.ref
+
+    def abort(self):
+        self.file.close()
+        os.unlink(self.part)
+
+def from_env(name):
+    path = os.environ.get(name)
+    return directory(path) if path else None
+
+
+def frame_chunks(msg, store, size=CHUNK_SIZE):
+    '''the wire frame of a spooled message, in pieces of at most size bytes'''
+    ref, length = msg.spool
+    data_len = len(msg.cmd) + 1 + length
+    yield b'[%s*%s*%s*%s,' % (msg.company.encode('ascii'), msg.device_id.encode('ascii'),
+            binascii.hexlify(struct.pack('>H', data_len)).upper(), msg.cmd.encode('ascii'))
+    with store.open(ref) as f:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                break
+            yield chunk
+    yield b']'
+
+def unescape_stream(src, dst, size=CHUNK_SIZE):
+    '''proto.message.unescape from file to file without holding the payload'''
+    carry = b''
+    while True:
+        chunk = src.read(size)
+        if not chunk:
+            break
+        data = carry + chunk
+        # an escape pair may be cut by the chunk boundary
+        carry = b'\x7d' if data[-1:] == b'\x7d' else b''
+        if carry:
+            data = data[:-1]
+        dst.write(unescape(data))
+    dst.write(carry)
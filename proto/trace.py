@@ -0,0 +1,128 @@
+'''latency tracing of a frame from the watch to telegram
+
+a trace context is created when the server parses an uplink frame and travels
+with the message: in memory through the server, in the sns body next to
+id/cmd/direction to the webhook. every stage appends spans (trace id, name,
+wall clock start and end) to a local collector file, one json object per line.
+the files of the server and the webhook are merged by trace id and reported
+per stage with
+
+    python -m proto.trace [--cmd AL] server-trace.jsonl webhook-trace.jsonl
+
+shared by the server and the webhook.
+'''
+
+import argparse
+import json
+import os
+import time
+import uuid
+
+
+def context(start=None):
+    '''a new trace, start is the wall clock time the frame arrived'''
+    return {'trace': uuid.uuid4().hex[:16], 'start': time.time() if start is None else start}
+
+
+class collector(object):
+    '''appends spans to a file
+
+    every span is one write() to a file opened for appending, so the workers
+    of the server (or concurrent lambda threads) sharing it do not interleave.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def span(self, ctx, name, start, end=None, **attrs):
+        attrs.update(trace=ctx['trace'], name=name, start=start, end=time.time() if end is None else end)
+        self.write((json.dumps(attrs, sort_keys=True) + '\n').encode('utf-8'))
+
+    def write(self, data):
+        os.write(self.fd, data)
+
+    def wrap(self, ctx, name, fn):
+        '''fn emitting a span of every call'''
+        def traced(*args, **kwargs):
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.span(ctx, name, start)
+        return traced
+
+    def close(self):
+        os.close(self.fd)
+
+def from_env(name):
+    path = os.environ.get(name)
+    return collector(path) if path else None
+
+
+def load(paths):
+    '''spans of the files by trace id, sorted by start'''
+    traces = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue # a line cut by a crash
+                traces.setdefault(span['trace'], []).append(span)
+    for spans in traces.values():
+        spans.sort(key=lambda s: (s['start'], s['end']))
+    return traces
+
+def stages(spans):
+    '''(stage, seconds) of one trace: every span, the wait before it and the total
+
+    the wait is the time between the end of everything before a span and its
+    start: the write-behind batching, sns delivery to the webhook and so on.
+    '''
+    first = spans[0]['start']
+    done = first
+    out = []
+    for s in spans:
+        if s['start'] > done:
+            out.append(('wait > %s' % s['name'], s['start'] - done))
+        out.append((s['name'], s['end'] - s['start']))
+        done = max(done, s['end'])
+    out.append(('total', done - first))
+    return out
+
+def percentile(values, q):
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def report(traces, cmd=None):
+    '''lines of a per stage table, stages in the order they usually happen'''
+    durations = {}
+    offsets = {}
+    for spans in traces.values():
+        if cmd and not any(s.get('cmd') == cmd for s in spans):
+            continue
+        for i, (stage, seconds) in enumerate(stages(spans)):
+            durations.setdefault(stage, []).append(seconds)
+            offsets.setdefault(stage, []).append(i)
+    order = sorted(durations, key=lambda st: (st == 'total', sorted(offsets[st])[len(offsets[st]) // 2]))
+    lines = ['%-28s %7s %9s %9s %9s %9s' % ('stage (ms)', 'n', 'p50', 'p90', 'p99', 'max')]
+    for stage in order:
+        values = sorted(durations[stage])
+        lines.append('%-28s %7d %9.1f %9.1f %9.1f %9.1f' % ((stage, len(values)) +
+                tuple(1000 * percentile(values, q) for q in (.5, .9, .99, 1))))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='per stage latency of traced frames')
+    parser.add_argument('--cmd', help='only traces of this command, e.g. AL')
+    parser.add_argument('files', nargs='+', help='collector files of the server and the webhook')
+    args = parser.parse_args()
+    traces = load(args.files)
+    print('%s traces' % len(traces))
+    for line in report(traces, args.cmd):
+        print(line)
+
+if __name__ == '__main__':
+    main()
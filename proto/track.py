@@ -0,0 +1,101 @@
+import numpy
+
+EARTH_RADIUS = 6371000.
+
+
+def project(lat, lon):
+    '''lat/lon degrees to metres on a plane tangent at the first point
+
+    equirectangular, good to well under a metre over a city sized track.
+    '''
+    lat = numpy.radians(numpy.asarray(lat, dtype=float))
+    lon = numpy.radians(numpy.asarray(lon, dtype=float))
+    if not len(lat):
+        return lat, lon
+    x = (lon - lon[0]) * numpy.cos(lat[0]) * EARTH_RADIUS
+    y = (lat - lat[0]) * EARTH_RADIUS
+    return x, y
+
+def merge_stays(x, y, radius):
+    '''keep mask dropping the inner points of stays
+
+    a stay is a run of points all within radius of the run's first point, only
+    its first (arrival) and last (departure) point are kept. the runs of steps
+    shorter than radius are found in one vector operation, only those are
+    scanned point by point (stays are sequential: each starts where the last
+    one ended), every point is looked at no more than twice.
+    '''
+    n = len(x)
+    keep = numpy.ones(n, dtype=bool)
+    if n < 3 or radius <= 0:
+        return keep
+    step = numpy.hypot(numpy.diff(x), numpy.diff(y))
+    slow = numpy.concatenate(([False], step < radius, [False]))
+    # runs of slow steps: point i belongs to a run when step i-1 is slow
+    edges = numpy.flatnonzero(slow[1:] != slow[:-1]).tolist()
+    xs, ys = x.tolist(), y.tolist()
+    r2 = radius * radius
+    for start, stop in zip(edges[::2], edges[1::2]):
+        a = start # the point the run starts at
+        while a < stop:
+            ax, ay = xs[a], ys[a]
+            b = a + 1
+            while b <= stop and (xs[b] - ax) ** 2 + (ys[b] - ay) ** 2 < r2:
+                b += 1
+            b -= 1 # last point of the stay
+            keep[a+1:b] = False
+            a = b if b > a else a + 1
+    return keep
+
+def douglas_peucker(x, y, tolerance):
+    '''keep mask of the Douglas-Peucker simplification of a polyline
+
+    the recursion is run breadth first: every pass computes the distance of
+    all points of the segments still open to their chords in one vector
+    operation and splits each segment at its farthest point, so a track costs
+    one pass per recursion level instead of one per segment. the result is the
+    same as the recursive form's, ties go to the first point.
+    '''
+    n = len(x)
+    keep = numpy.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    if tolerance <= 0:
+        keep[:] = True
+        return keep
+    x, y = numpy.asarray(x, dtype=float), numpy.asarray(y, dtype=float)
+    pending = numpy.arange(1, n - 1) # points of the segments that may still split
+    while len(pending):
+        kept = numpy.flatnonzero(keep)
+        seg = numpy.searchsorted(kept, pending) - 1 # segment i runs from kept[i] to kept[i+1]
+        a, b = kept[seg], kept[seg + 1]
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        px, py = x[pending] - x[a], y[pending] - y[a]
+        chord = numpy.hypot(dx, dy)
+        # a segment looping back to its start measures the distance to it
+        d = numpy.where(chord > 0, numpy.abs(px * dy - py * dx) / numpy.where(chord > 0, chord, 1),
+                numpy.hypot(px, py))
+        starts = numpy.flatnonzero(numpy.concatenate(([True], seg[1:] != seg[:-1])))
+        sizes = numpy.diff(numpy.append(starts, len(d)))
+        farthest = numpy.maximum.reduceat(d, starts)
+        split = numpy.repeat(farthest > tolerance, sizes)
+        # the first point at the maximum of every segment that splits
+        at = numpy.flatnonzero(split & (d == numpy.repeat(farthest, sizes)))
+        first = numpy.ones(len(at), dtype=bool)
+        first[1:] = seg[at[1:]] != seg[at[:-1]]
+        keep[pending[at[first]]] = True
+        pending = pending[split & ~keep[pending]]
+    return keep
+
+def simplify(lat, lon, tolerance=0, stay=0):
+    '''indices of the points to keep of a track in time order
+
+    stays within `stay` metres are merged first, then the rest is simplified
+    with Douglas-Peucker at `tolerance` metres. 0 disables a stage; the first
+    and the last point are always kept.
+    '''
+    x, y = project(lat, lon)
+    idx = numpy.flatnonzero(merge_stays(x, y, stay))
+    idx = idx[douglas_peucker(x[idx], y[idx], tolerance)]
+    return idx
@@ -4,39 +4,154 @@ import logging
 from .message import message
 
 log = logging.getLogger('gpstrack.proto.transport')
+payload_log = logging.getLogger('gpstrack.payload') # raw data dumps, see gpstrack.logs
+
+PAYLOAD_LOG_BYTES = 64 # how much of a chunk is dumped
+
+MAX_MESSAGE_SIZE = 1024*1024
+SPOOL_MIN = 8*1024          # frames from this size on may go to the spool
+SPOOL_CMDS = (b'TK',)
 
 class ProtocolException(Exception): pass
 
 class stream:
+    '''incremental framer for "[company*device_id*LLLL*data]" frames
+
+    incoming chunks are appended to one bytearray; a read cursor marks the start
+    of the current frame and a scan cursor marks how far we have already looked
+    for the header separators, so each byte is inspected only once no matter how
+    many chunks a frame is split into. every complete frame in the buffer is
+    delivered on a single call.
+
+    with a spool store set (see proto.spool), the payload of a large TK frame
+    is written to the store as it arrives instead of being kept in the buffer,
+    and the frame is delivered as a message with spool = (ref, length).
+    '''
+
+    spool_store = None
+
     def __init__(self):
-        self.buffer = b''
-    
+        self.buffer = bytearray()
+        self._pos = 0       # start of the current (incomplete) frame
+        self._scan = 0      # next offset to look for a header '*'
+        self._stars = ()    # offsets of header separators found so far
+        self._end = None    # offset of the closing ']' once the header is parsed
+        self._spool = None  # (writer, company, device_id, cmd, payload bytes still expected)
+
     def send(self, data):
-        log.debug('data received: %r', data)
-        self.buffer += data
-        p = self.buffer.split(b'*', 3)
-        if len(p) < 4:
-            if len(self.buffer) > 1024*1024:
-                raise ProtocolException('message size limit exceeded')
-            return
-
-        company, device_id, length, msg = p
-        prefix_size = sum(len(i)+1 for i in p[:3])
-        length = struct.unpack('>H', binascii.unhexlify(length))[0]
-
-        if company[:1] != b'[':
-            raise ProtocolException('invalid message start, expected "[", got "%r"'%company[:1])
-        company = company[1:]
-
-        if len(msg) <= length:
-            return #need to wait remain message
-
-        raw = self.buffer[:prefix_size+length+1]
-        self.buffer = msg[length+1:]
-        if msg[length:length+1] != b']':
-            raise ProtocolException('invalid message end, expected "]", got "%r"'%msg[length])
-
-        self.message_received(message(company, device_id, msg[:length], raw))
+        if payload_log.isEnabledFor(logging.DEBUG):
+            payload_log.debug('data received: %s bytes %r%s', len(data), bytes(data[:PAYLOAD_LOG_BYTES]),
+                    '...' if len(data) > PAYLOAD_LOG_BYTES else '')
+        if self._spool is not None:
+            data = self._spool_data(data)
+            if not data:
+                return
+        buf = self.buffer
+        buf += data
+        pos, scan, stars, end = self._pos, self._scan, self._stars, self._end
+        try:
+            while True:
+                if end is None:
+                    while len(stars) < 3:
+                        s = buf.find(b'*', scan)
+                        if s == -1:
+                            scan = len(buf)
+                            if scan - pos > MAX_MESSAGE_SIZE:
+                                raise ProtocolException('message size limit exceeded')
+                            return
+                        stars += (s,)
+                        scan = s + 1
+
+                    if buf[pos] != 0x5b: # '['
+                        raise ProtocolException('invalid message start, expected "[", got "%r"'%bytes(buf[pos:pos+1]))
+                    end = stars[2] + 1 + struct.unpack('>H', binascii.unhexlify(buf[stars[1]+1:stars[2]]))[0]
+
+                spool = self.spool_store is not None and end - pos >= SPOOL_MIN
+                if len(buf) <= end:
+                    if spool and self._spool_start(buf, pos, stars, end, len(buf)):
+                        pos = scan = len(buf)
+                        stars, end = (), None
+                    return #need to wait remain message
+
+                if buf[end] != 0x5d: # ']'
+                    raise ProtocolException('invalid message end, expected "]", got "%r"'%bytes(buf[end:end+1]))
+
+                if spool and self._spool_start(buf, pos, stars, end, end):
+                    pos = scan = end + 1
+                    stars, end = (), None
+                    self._spool_data(b']')
+                    continue
+
+                # the frame is copied out exactly once; header fields and data
+                # are sliced from that immutable copy while the buffer is reused
+                s1, s2, s3 = stars[0]-pos, stars[1]-pos, stars[2]-pos
+                raw = bytes(buf[pos:end+1])
+                msg = message(raw[1:s1], raw[s1+1:s2], raw[s3+1:-1], raw)
+
+                pos = scan = end + 1
+                stars, end = (), None
+                self.message_received(msg)
+        finally:
+            if pos:
+                # deleting from the front of a bytearray only moves its start offset
+                del buf[:pos]
+                scan -= pos
+                if stars:
+                    stars = tuple(s - pos for s in stars)
+                if end is not None:
+                    end -= pos
+                pos = 0
+            self._pos, self._scan, self._stars, self._end = pos, scan, stars, end
+
+    def _spool_start(self, buf, pos, stars, end, stop):
+        comma = buf.find(b',', stars[2] + 1, stars[2] + 8)
+        if comma == -1 or bytes(buf[stars[2]+1:comma]) not in SPOOL_CMDS:
+            return False
+        company, device_id = bytes(buf[pos+1:stars[0]]), bytes(buf[stars[0]+1:stars[1]])
+        cmd = bytes(buf[stars[2]+1:comma])
+        writer = self.spool_store.create('%s_%s' % (company.decode(), device_id.decode()))
+        writer.write(bytes(buf[comma+1:stop]))
+        self._spool = (writer, company, device_id, cmd, end - stop)
+        return True
+
+    def _spool_data(self, data):
+        '''payload bytes go to the spool, returns what follows the frame'''
+        writer, company, device_id, cmd, remaining = self._spool
+        if remaining:
+            n = min(remaining, len(data))
+            writer.write(bytes(data[:n]))
+            data = data[n:]
+            self._spool = (writer, company, device_id, cmd, remaining - n)
+            if not data:
+                return None
+        if data[:1] != b']':
+            self.abort_spool()
+            raise ProtocolException('invalid message end, expected "]", got "%r"'%bytes(data[:1]))
+        self._spool = None
+        length = writer.length
+        self.message_received(message.from_spool(company, device_id, cmd, writer.close(), length))
+        return data[1:]
+
+    def spool_state(self):
+        '''an unfinished spooled frame as a json-able dict, None if there is none'''
+        if self._spool is None:
+            return None
+        writer, company, device_id, cmd, remaining = self._spool
+        writer.flush()
+        return {'ref': writer.ref, 'length': writer.length, 'company': company.decode(),
+                'device_id': device_id.decode(), 'cmd': cmd.decode(), 'remaining': remaining}
+
+    def resume_spool(self, state):
+        '''continue a frame from spool_state() of another stream'''
+        writer = self.spool_store.resume(state['ref'], state['length'])
+        self._spool = (writer, state['company'].encode(), state['device_id'].encode(),
+                state['cmd'].encode(), state['remaining'])
+
+    def abort_spool(self):
+        '''drop a partially received spooled frame, e.g. when the connection is lost'''
+        if self._spool is not None:
+            self._spool[0].abort()
+            self._spool = None
 
     def message_received(self, msg):
         return None
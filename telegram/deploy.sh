@@ -6,4 +6,7 @@ apex deploy  \
     -s "GOOGLE_KEY=$GOOGLE_KEY" \
     -s "BOT_KEY=$TELEGRAM_BOT_KEY" \
     -s "YANDEX_SPEECHKIT_KEY=$YANDEX_SPEECHKIT_KEY" \
+    -s "PUSH_ADDR=$GPSWATCH_PUSH_ADDR" \
+    -s "PUSH_KEY=$GPSWATCH_PUSH_KEY" \
+    -s "FIX_INDEX_SINCE=$GPSWATCH_FIX_INDEX_SINCE" \
     $*
@@ -0,0 +1,108 @@
+# -- coding: utf-8 --
+'''creates the fix index of the gpswatch table and backfills fix_ts
+
+the /track endpoint reads gps fixes from the sparse global secondary index
+"fix" (device_id, fix_ts) once FIX_INDEX_SINCE is set, see
+functions/webhook/handlers/http. deploy the server writing fix_ts first, then
+
+    python fix_index.py [--backfill]
+
+creates the index and waits until it is active. --backfill also sets fix_ts
+on the older UD/UD2 rows with a gps fix (a scan of the whole table). the last
+line printed is the FIX_INDEX_SINCE to deploy the webhook with:
+
+    GPSWATCH_FIX_INDEX_SINCE=<value> ./deploy.sh
+
+credentials and region are taken from the usual AWS_* variables.
+'''
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import botocore.session
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'functions', 'webhook'))
+import proto.message
+
+TABLE = 'gpswatch'
+
+
+def create_index(dynamo):
+    table = dynamo.describe_table(TableName=TABLE)['Table']
+    if any(i['IndexName'] == proto.message.FIX_INDEX for i in table.get('GlobalSecondaryIndexes', [])):
+        print('index %s exists' % proto.message.FIX_INDEX)
+        return
+    index = {
+        'IndexName': proto.message.FIX_INDEX,
+        'KeySchema': [
+            {'AttributeName': 'device_id', 'KeyType': 'HASH'},
+            {'AttributeName': proto.message.FIX_INDEX_KEY, 'KeyType': 'RANGE'},
+        ],
+        'Projection': {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': ['location']},
+    }
+    throughput = table.get('ProvisionedThroughput', {})
+    if table.get('BillingModeSummary', {}).get('BillingMode') != 'PAY_PER_REQUEST':
+        index['ProvisionedThroughput'] = {
+            'ReadCapacityUnits': throughput['ReadCapacityUnits'],
+            'WriteCapacityUnits': throughput['WriteCapacityUnits'],
+        }
+    dynamo.update_table(
+        TableName=TABLE,
+        AttributeDefinitions=[
+            {'AttributeName': 'device_id', 'AttributeType': 'S'},
+            {'AttributeName': proto.message.FIX_INDEX_KEY, 'AttributeType': 'N'},
+        ],
+        GlobalSecondaryIndexUpdates=[{'Create': index}])
+    print('creating index %s' % proto.message.FIX_INDEX)
+
+def wait_active(dynamo):
+    while True:
+        table = dynamo.describe_table(TableName=TABLE)['Table']
+        status = [i['IndexStatus'] for i in table.get('GlobalSecondaryIndexes', [])
+                if i['IndexName'] == proto.message.FIX_INDEX]
+        if status == ['ACTIVE']:
+            return
+        print('index %s: %s' % (proto.message.FIX_INDEX, status))
+        time.sleep(30)
+
+def backfill(dynamo):
+    '''fix_ts of the UD/UD2 rows with a gps fix that have none, as proto.message writes it'''
+    n = 0
+    for page in dynamo.get_paginator('scan').paginate(
+                TableName=TABLE,
+                ProjectionExpression='device_id, ts',
+                FilterExpression='begins_with(cmd, :cmd) AND #ll.#type = :a AND attribute_not_exists(#fix)',
+                ExpressionAttributeNames={'#ll': 'location', '#type': 'type', '#fix': proto.message.FIX_INDEX_KEY},
+                ExpressionAttributeValues={':cmd': {'S': 'UD'}, ':a': {'S': 'A'}}):
+        for r in page['Items']:
+            dynamo.update_item(
+                TableName=TABLE,
+                Key={'device_id': r['device_id'], 'ts': r['ts']},
+                UpdateExpression='SET #fix = :ts',
+                ConditionExpression='attribute_exists(ts)',
+                ExpressionAttributeNames={'#fix': proto.message.FIX_INDEX_KEY},
+                ExpressionAttributeValues={':ts': r['ts']})
+            n += 1
+    print('backfilled %s rows' % n)
+
+def main():
+    parser = argparse.ArgumentParser(description='create the fix index of the gpswatch table')
+    parser.add_argument('--backfill', action='store_true', help='set fix_ts on the rows written before')
+    args = parser.parse_args()
+
+    # rows written from now on carry fix_ts, the server writing them is deployed
+    since = int(time.time())
+    dynamo = botocore.session.get_session().create_client('dynamodb')
+    create_index(dynamo)
+    wait_active(dynamo)
+    if args.backfill:
+        backfill(dynamo)
+        since = 0
+    print('FIX_INDEX_SINCE=%s' % since)
+
+if __name__ == '__main__':
+    main()
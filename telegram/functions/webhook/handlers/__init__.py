@@ -1,5 +1,5 @@
 # -- coding: utf-8 --
 
-import sns
-import http
-import telegram
+from . import sns
+from . import http
+from . import telegram
@@ -1,37 +1,44 @@
 # -- coding: utf-8 --
 
+import base64
 import os
-import arrow
-import gpxpy.gpx
+import time
 
-from .. import utils
+from email.utils import formatdate, mktime_tz, parsedate_tz
 
-TPL = open(os.path.join(os.path.split(__file__)[0], 'route.html')).read()
+from six.moves.urllib.parse import urlencode
 
-def handler(event, context):
-    track_id = event['params']['path']['track-id']
+import proto.cache
+import proto.gpx
+import proto.message
+import proto.track
 
-    sec, tp = track_id.split('.')
-    if tp == 'html':
-        return {'body': TPL%('https://tracker.dimonb.com/%s.gpx'%sec)}
+from .. import utils
+from . import cache
 
-    dynamo = utils.DynamoHelper()
+TPL = open(os.path.join(os.path.split(__file__)[0], 'route.html')).read()
 
-    s = dynamo.get_settings('GPX_%s'%sec)
-    device_id = s['device']['S']
-    f = s['f']['N']
-    t = s['t']['N']
+# rows written before this time have no fix_ts and are not in the fix index,
+# they are read from the table with a filter. unset until the index exists
+# (see telegram/fix_index.py), everything is read with the filter then; 0
+# once the table is backfilled.
+FIX_INDEX_SINCE = os.environ.get('FIX_INDEX_SINCE') or None
 
-    gpx = gpxpy.gpx.GPX()
-    gpx_track = gpxpy.gpx.GPXTrack()
-    gpx.tracks.append(gpx_track)
+# /<secret>.gpx?simplify=<metres>&stay=<metres>, see proto.track.simplify()
+SIMPLIFY_OPTIONS = ('simplify', 'stay')
+SIMPLIFY_MAX = 1000.
 
-    gpx_segment = gpxpy.gpx.GPXTrackSegment()
-    gpx_track.segments.append(gpx_segment)
+# GPX_<secret> records are never changed, once fixes up to t have arrived
+# the track of a secret is final and its document is cached
+SETTLE = float(os.environ.get('GPX_SETTLE', 300))
+GZIP = os.environ.get('GPX_GZIP') == '1' # needs binary support in the api gateway
+CACHE = cache.from_env()
+WINDOWS = proto.cache.ttl_cache(maxsize=1024, ttl=24*3600)
 
+def legacy_fixes(dynamo, device_id, f, t):
     for r in dynamo.query(
                 Select= 'SPECIFIC_ATTRIBUTES',
-                ProjectionExpression = '#ll',
+                ProjectionExpression = '#ll, #fix',
                 KeyConditionExpression = 'device_id = :device_id AND ts BETWEEN :f AND :t',
                 FilterExpression = 'begins_with(cmd, :cmd)',
                 ExpressionAttributeValues = {
@@ -42,10 +49,133 @@ def handler(event, context):
                 },
                 ExpressionAttributeNames = {
                     '#ll': 'location',
+                    '#fix': proto.message.FIX_INDEX_KEY,
+                }):
+        # fixes from FIX_INDEX_SINCE on are read from the index
+        fix = r.get(proto.message.FIX_INDEX_KEY)
+        if fix is None or FIX_INDEX_SINCE is None or float(fix['N']) < float(FIX_INDEX_SINCE):
+            yield r['location']['M']
+
+def indexed_fixes(dynamo, device_id, f, t):
+    for r in dynamo.query(
+                IndexName = proto.message.FIX_INDEX,
+                Select= 'SPECIFIC_ATTRIBUTES',
+                ProjectionExpression = '#ll',
+                KeyConditionExpression = 'device_id = :device_id AND #fix BETWEEN :f AND :t',
+                ExpressionAttributeValues = {
+                    ':device_id': {'S': device_id},
+                    ':f': {'N': f},
+                    ':t': {'N': t},
+                },
+                ExpressionAttributeNames = {
+                    '#ll': 'location',
+                    '#fix': proto.message.FIX_INDEX_KEY,
                 }):
-        loc = r['location']['M']
-        if loc['type']['S'] == 'A':
-            gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(loc['lat']['N'], loc['lon']['N'], time=arrow.get(loc['ts']['N']).to('Europe/Moscow')))
+        yield r['location']['M']
+
+def track_points(dynamo, device_id, f, t):
+    '''(lat, lon, ts) of the gps fixes received between f and t, in order'''
+    if FIX_INDEX_SINCE is None or float(f) < float(FIX_INDEX_SINCE):
+        legacy_t = t if FIX_INDEX_SINCE is None else min(t, FIX_INDEX_SINCE, key=float)
+        for loc in legacy_fixes(dynamo, device_id, f, legacy_t):
+            if loc['type']['S'] == 'A':
+                yield loc['lat']['N'], loc['lon']['N'], loc['ts']['N']
+        if FIX_INDEX_SINCE is None:
+            return
+        f = FIX_INDEX_SINCE
+    if float(f) <= float(t):
+        for loc in indexed_fixes(dynamo, device_id, f, t):
+            yield loc['lat']['N'], loc['lon']['N'], loc['ts']['N']
+
+def simplify_options(event):
+    '''the simplification options of the track url, ignoring invalid values'''
+    qs = event['params'].get('querystring') or {}
+    options = {}
+    for name in SIMPLIFY_OPTIONS:
+        try:
+            value = min(float(qs.get(name, 0)), SIMPLIFY_MAX)
+        except ValueError:
+            continue
+        if value > 0:
+            options[name] = value
+    return options
+
+def simplified(points, simplify=0, stay=0):
+    points = list(points)
+    keep = proto.track.simplify([p[0] for p in points], [p[1] for p in points], tolerance=simplify, stay=stay)
+    return [points[i] for i in keep]
+
+def track_window(sec):
+    '''(device_id, f, t) of a track secret, final ones are remembered'''
+    window = WINDOWS.get(sec)
+    if window is None:
+        s = utils.DynamoHelper().get_settings('GPX_%s'%sec)
+        window = s['device']['S'], s['f']['N'], s['t']['N']
+        if final(window):
+            WINDOWS.set(sec, window)
+    return window
+
+def final(window):
+    return float(window[2]) + SETTLE < time.time()
+
+def header(event, name, default=None):
+    for k, v in (event['params'].get('header') or {}).items():
+        if k.lower() == name.lower():
+            return v
+    return default
+
+def not_modified(event, etag, modified):
+    etags = header(event, 'If-None-Match')
+    if etags is not None:
+        tags = set(t.strip() for t in etags.split(','))
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+    since = header(event, 'If-Modified-Since')
+    if since is not None:
+        since = parsedate_tz(since)
+        return since is not None and mktime_tz(since) >= modified
+    return False
+
+def respond(event, entry, cacheable):
+    gz = GZIP and 'gzip' in header(event, 'Accept-Encoding', '')
+    headers = {
+        'Content-Type': 'application/gpx+xml',
+        # the identity and the gzip body are different representations
+        'ETag': entry.gz_etag if gz else entry.etag,
+        'Last-Modified': formatdate(entry.modified, usegmt=True),
+        'Cache-Control': 'public, max-age=86400' if cacheable else 'no-cache',
+    }
+    if GZIP:
+        headers['Vary'] = 'Accept-Encoding'
+    if not_modified(event, headers['ETag'], entry.modified):
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+    if gz:
+        headers['Content-Encoding'] = 'gzip'
+        return {'statusCode': 200, 'headers': headers, 'body': base64.b64encode(entry.gz), 'isBase64Encoded': True}
+    return {'statusCode': 200, 'headers': headers, 'body': entry.body}
+
+def handler(event, context):
+    track_id = event['params']['path']['track-id']
+    options = simplify_options(event)
+
+    sec, tp = track_id.split('.')
+    if tp == 'html':
+        query = '?' + urlencode(sorted(options.items())) if options else ''
+        return {'body': TPL%('https://tracker.dimonb.com/%s.gpx%s'%(sec, query))}
+
+    window = track_window(sec)
+    key = '%s:%s:%s:%s' % ((sec,) + window[1:] + (urlencode(sorted(options.items())),))
+    cacheable = CACHE is not None and final(window)
+    entry = CACHE.get(key) if cacheable else None
+    if entry is None:
+        device_id, f, t = window
+        points = track_points(utils.DynamoHelper(), device_id, f, t)
+        if options:
+            points = simplified(points, **options)
 
-    return {'body': gpx.to_xml()}
+        # the lambda integration sends the body in one piece, the document is
+        # still written page by page as the query returns without a gpx object tree
+        entry = cache.Entry.build(''.join(proto.gpx.chunks(points)))
+        if cacheable:
+            CACHE.put(key, entry)
 
+    return respond(event, entry, cacheable)
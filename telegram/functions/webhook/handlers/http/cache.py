@@ -0,0 +1,121 @@
+# -- coding: utf-8 --
+
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+import uuid
+
+log = logging.getLogger('webhook.handlers.http.cache')
+
+CACHE_DIR = os.environ.get('GPX_CACHE_DIR', '/tmp/gpx-cache')
+CACHE_ENTRIES = int(os.environ.get('GPX_CACHE_ENTRIES', 256))
+
+
+def compress(data):
+    out = io.BytesIO()
+    # mtime=0 so the same document always compresses to the same bytes
+    with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+def decompress(data):
+    with gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb') as f:
+        return f.read()
+
+
+class Entry(object):
+    '''a generated document: gzip body, etag of the plain body and generation time
+
+    the gzip representation has an etag of its own, gz_etag.
+    '''
+
+    def __init__(self, gz, etag, modified):
+        self.gz = gz
+        self.etag = etag
+        self.modified = modified
+        self._body = None
+
+    @classmethod
+    def build(cls, body):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        entry = cls(compress(body), '"%s"' % hashlib.sha1(body).hexdigest()[:20], int(time.time()))
+        entry._body = body
+        return entry
+
+    @property
+    def gz_etag(self):
+        return self.etag[:-1] + '-gzip"'
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = decompress(self.gz)
+        return self._body
+
+
+class TrackCache(object):
+    '''generated track documents in a directory, a local stand-in for an object store
+
+    in the lambda it is /tmp, kept for as long as the container is warm. an
+    entry is a gzip file with the metadata in a json file next to it, both
+    written under a temporary name and renamed. the oldest entries are removed
+    once there are more than `entries`.
+    '''
+
+    def __init__(self, path=CACHE_DIR, entries=CACHE_ENTRIES):
+        self.path = path
+        self.entries = entries
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def name(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        name = self.name(key)
+        try:
+            with open(name + '.json') as f:
+                meta = json.load(f)
+            with open(name + '.gz', 'rb') as f:
+                gz = f.read()
+        except (IOError, OSError, ValueError):
+            return None
+        if meta.get('key') != key:
+            return None
+        return Entry(gz, meta['etag'], meta['modified'])
+
+    def put(self, key, entry):
+        name = self.name(key)
+        tmp = '%s.%s' % (name, uuid.uuid4().hex)
+        try:
+            with open(tmp + '.gz', 'wb') as f:
+                f.write(entry.gz)
+            with open(tmp + '.json', 'w') as f:
+                json.dump({'key': key, 'etag': entry.etag, 'modified': entry.modified}, f)
+            # the body goes first, a reader finding the metadata finds the body
+            os.rename(tmp + '.gz', name + '.gz')
+            os.rename(tmp + '.json', name + '.json')
+        except (IOError, OSError):
+            log.warning('can not store %s', key, exc_info=True)
+            return
+        self.expire()
+
+    def expire(self):
+        names = [os.path.join(self.path, n) for n in os.listdir(self.path) if n.endswith('.json')]
+        if len(names) <= self.entries:
+            return
+        names.sort(key=lambda n: os.path.getmtime(n))
+        for n in names[:len(names) - self.entries]:
+            for suffix in ('.json', '.gz'):
+                try:
+                    os.unlink(n[:-len('.json')] + suffix)
+                except OSError:
+                    pass
+
+def from_env():
+    return TrackCache() if CACHE_DIR else None
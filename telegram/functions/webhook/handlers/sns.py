@@ -1,16 +1,24 @@
 # -- coding: utf-8 -- 
 
+import io
 import json
-import utils
 import requests
-import StringIO
 import ffmpy
 import uuid
 import subprocess
 import logging
 import os
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
 
 import proto.message
+import proto.spool
+import proto.trace
+
+from . import utils
 
 import xml.etree.ElementTree as ET
 
@@ -29,30 +37,31 @@ def find_reply_message(w_msg):
     return did['message_id']
 
 
-def on_voice_message(chat_id, message):
-    data = message.params
-    m = [
-        ('7d01', '7d'),
-        ('7d02', '5b'),
-        ('7d03', '5d'),
-        ('7d04', '2c'),
-        ('7d05', '2a')]
-    
-    for k, v in reversed(m):
-        data = data.replace(k.decode('hex'), v.decode('hex'))
-
-    ff = ffmpy.FFmpeg(
-            inputs={'pipe:0': '-f amr'},
-            outputs={'pipe:1': '-f opus'}
-    )
-    opus, stderr = ff.run(input_data=data, stdout=subprocess.PIPE)
+VOICE_CAPTION = 'Message from watch'
 
-    ff = ffmpy.FFmpeg(
-            inputs={'pipe:0': '-f amr'},
-            outputs={'pipe:1': '-f wav'}
-    )
-    wav, stderr = ff.run(input_data=data, stdout=subprocess.PIPE)
+SPOOL = proto.spool.from_env('SPOOL_DIR')
+TRACER = proto.trace.from_env('TRACE_FILE')
+
+def convert_voice(amr=None, path=None):
+    '''one ffmpeg run: amr bytes or an amr file in, (opus, wav) out; wav goes through a temp file'''
+    with tempfile.NamedTemporaryFile(suffix='.wav') as wav:
+        ff = ffmpy.FFmpeg(
+                global_options='-y',
+                inputs={path or 'pipe:0': '-f amr'},
+                outputs=OrderedDict([('pipe:1', '-f opus'), (wav.name, '-f wav')]),
+        )
+        opus, stderr = ff.run(input_data=amr, stdout=subprocess.PIPE)
+        return opus, wav.read()
 
+def convert_spooled_voice(ref):
+    '''convert_voice() of a spooled payload, unescaped into a temp file chunk by chunk'''
+    with tempfile.NamedTemporaryFile(suffix='.amr') as amr:
+        with SPOOL.open(ref) as src:
+            proto.spool.unescape_stream(src, amr)
+        amr.flush()
+        return convert_voice(path=amr.name)
+
+def recognize(wav):
     res = requests.post(
         'https://asr.yandex.net/asr_xml',
         params = {
@@ -63,92 +72,144 @@ def on_voice_message(chat_id, message):
             'Content-Type': 'audio/x-wav'
         }, data = wav)
 
-    text = 'Message from watch'
     try:
         r = ET.fromstring(res.text.encode('utf-8'))
         if r.attrib['success'] == '1':
-            text = max(list(r), key=lambda x: float(x.attrib['confidence'])).text
+            return max(list(r), key=lambda x: float(x.attrib['confidence'])).text
     except:
         log.exception(res.text)
 
-    utils.bot.sendVoice(chat_id, StringIO.StringIO(opus), caption=text)
+def on_voice_message(chat_id, message):
+    if message.spool and not SPOOL:
+        # a reference to the server's spool, the payload is not here
+        log.error('spooled voice message %s can not be read', message.spool[0])
+        utils.bot.sendMessage(chat_id, 'voice message from watch is not available')
+        return
+    if message.spool:
+        opus, wav = convert_spooled_voice(message.spool[0])
+    else:
+        opus, wav = convert_voice(proto.message.unescape(message.params))
+
+    # the voice note goes out while speech recognition runs, the caption follows
+    text = []
+    asr = threading.Thread(target=lambda: text.append(recognize(wav)))
+    asr.start()
+    try:
+        sent = utils.bot.sendVoice(chat_id, io.BytesIO(opus), caption=VOICE_CAPTION)
+    finally:
+        asr.join()
 
-def on_new_location(chat_id, msg):
-    dynamo = utils.DynamoHelper()
+    if text and text[0]:
+        utils.bot.editMessageCaption((chat_id, sent['message_id']), caption=text[0])
 
-    ld = msg.location_data
+def send_reply(chat_id, text, w_msg):
+    utils.bot.sendMessage(chat_id, text, reply_to_message_id=find_reply_message(w_msg))
 
-    settings = dynamo.get_settings(msg.identifier['device_id'])
+def on_new_locations(outbox, chat_id, device_id, settings, fixes):
+    '''one settings update for all fixes of a device in this invocation
 
-    if not proto.message.tstate(settings['tstate']['S']).on_wrist and ld.on_wrist:
-        utils.bot.sendMessage(chat_id, 'alarm: watches are put on')
+    fixes are location_data of the device's UD/UD2/AL messages. the latest one
+    goes to loc/batt/ld_ts/..., ld_ts_<type> gets the latest fix of that type.
+    '''
+    dynamo = utils.DynamoHelper()
+    fixes = sorted(fixes, key=lambda ld: ld.ts_num)
+
+    on_wrist = proto.message.tstate(settings['tstate']['S']).on_wrist if 'tstate' in settings else True
+    for ld in fixes:
+        if not on_wrist and ld.on_wrist:
+            outbox.add(chat_id, utils.bot.sendMessage, chat_id, 'alarm: watches are put on')
+        on_wrist = ld.on_wrist
+
+    ld = fixes[-1]
+    by_type = dict((f.type, f) for f in fixes)
+    values = {
+        ":loc": {'M': {"lat": {'N': ld.lat}, "lon": {'N': ld.lon}}}, 
+        ":batt": {'N': ld.batt},
+        ":ld_ts": {'N': str(ld.ts_num)},
+        ":gsm_info": {'S': ','.join(ld.gsm_info)},
+        ":tstate": {'S': ld.tstate},
+    }
+    for tp, f in by_type.items():
+        values[":ld_ts_%s"%tp] = {'N': str(f.ts_num)}
 
     dynamo.update_settings(
-        msg.identifier['device_id'],
-        "SET loc = :loc, batt = :batt, ld_ts = :ld_ts, ld_ts_%s = :ld_ts, gsm_info = :gsm_info, tstate = :tstate"%(ld.position[0],),
-        {
-            ":loc": {'M': {"lat": {'N': ld.lat}, "lon": {'N': ld.lon}}}, 
-            ":batt": {'N': ld.batt},
-            ":ld_ts": {'N': str(ld.ts_num)},
-            ":gsm_info": {'S': ','.join(ld.gsm_info)},
-            ":tstate": {'S': ld.tstate},
-        },
+        device_id,
+        "SET loc = :loc, batt = :batt, ld_ts = :ld_ts, gsm_info = :gsm_info, tstate = :tstate, %s"%(
+            ', '.join('ld_ts_%s = :ld_ts_%s'%(tp, tp) for tp in sorted(by_type)),),
+        values,
     )
 
-def on_alarm(chat_id, msg):
-    utils.bot.sendMessage(
-        chat_id, 'alarm: %s'%msg.location_data.alarm,
-    )
-    utils.bot.sendLocation(chat_id, msg.location_data.lat, msg.location_data.lon)
-
-def handler(event, context):
-    for msg in event['Records']:
-        msg = json.loads(msg['Sns']['Message'])
-
-        dynamo = utils.DynamoHelper()
-
-        settings = dynamo.get_settings(msg['id']['device_id'])
-        if not settings or not settings.get('chat_id'): continue
-        chat_id = settings.get('chat_id')['S']
+def traced(ctx, name, fn):
+    '''fn recording a span of the telegram call when the record is traced'''
+    if not TRACER or not ctx:
+        return fn
+    return TRACER.wrap(ctx, 'telegram.%s'%name, fn)
 
-        w_msg = dynamo.get_object(msg['id']['device_id'], msg['id']['ts'])
-
-        if not w_msg:
-            raise RuntimeError, 'No record found: %s'%msg
+def on_alarm(outbox, chat_id, msg, ctx=None):
+    outbox.add(chat_id, traced(ctx, 'alarm', utils.bot.sendMessage), chat_id, 'alarm: %s'%msg.location_data.alarm)
+    outbox.add(chat_id, traced(ctx, 'location', utils.bot.sendLocation), chat_id, msg.location_data.lat, msg.location_data.lon)
 
+def handler(event, context):
+    '''all records of an invocation are read in batches and answered together'''
+    started = time.time()
+    dynamo = utils.DynamoHelper()
+    outbox = utils.Outbox()
+
+    records = [json.loads(r['Sns']['Message']) for r in event['Records']]
+    settings = dynamo.get_settings_many([r['id']['device_id'] for r in records])
+    records = [r for r in records if settings.get(r['id']['device_id']) and settings[r['id']['device_id']].get('chat_id')]
+
+    keys = [(r['id']['device_id'], r['id']['ts']) for r in records]
+    objects = dynamo.get_objects(keys)
+    for key in keys:
+        if key not in objects:
+            raise RuntimeError('No record found: %s'%(key,))
+
+    # trace contexts of the records, see proto.trace
+    traces = dict(((r['id']['device_id'], r['id']['ts']), r['trace']) for r in records if r.get('trace'))
+    if TRACER:
+        for ctx in traces.values():
+            TRACER.span(ctx, 'read', started, records=len(records))
+
+    locations = {}
+    for device_id, ts in keys:
+        chat_id = settings[device_id]['chat_id']['S']
+        w_msg = objects[(device_id, ts)]
         m = proto.message.message.from_dynamo(w_msg)
 
         ld = m.location_data
         if ld:
             log.debug('setting new location: %s, %s; bat=%s'%(ld.lat, ld.lon, ld.batt))
+            ctx = traces.get((device_id, ts))
             if m.cmd == 'AL':
-                on_alarm(chat_id, m)
-            on_new_location(chat_id, m)
+                on_alarm(outbox, chat_id, m, ctx)
+            chat_id, fixes, ctxs = locations.setdefault(device_id, (chat_id, [], []))
+            fixes.append(ld)
+            if ctx and TRACER:
+                ctxs.append(ctx)
         elif m.cmd == 'LK':
             log.debug('confirm online status')
         elif m.cmd in ('TKQ2', 'TKQ'):
             log.debug('some strange statuses: %s'%m.to_json())
         elif m.cmd == 'CR':
-            utils.bot.sendMessage(
-                chat_id, 'pong' if m.direction == 'watch' else 'ping',
-                reply_to_message_id=find_reply_message(w_msg)
-            )
+            outbox.add(chat_id, send_reply, chat_id, 'pong' if m.direction == 'watch' else 'ping', w_msg)
         elif m.cmd == 'MESSAGE':
             if m.direction == 'watch':
-                utils.bot.sendMessage(
-                    chat_id, 'received',
-                    reply_to_message_id=find_reply_message(w_msg)
-                )
+                outbox.add(chat_id, send_reply, chat_id, 'received', w_msg)
         elif m.cmd == 'FLOWER':
             if m.direction == 'watch':
-                utils.bot.sendMessage(
-                    chat_id, 'set',
-                    reply_to_message_id=find_reply_message(w_msg)
-                )
+                outbox.add(chat_id, send_reply, chat_id, 'set', w_msg)
         elif m.cmd in ('TK', 'TK2'):
-            on_voice_message(chat_id, m)
+            outbox.add(chat_id, on_voice_message, chat_id, m)
         else:
-            utils.bot.sendMessage(
+            outbox.add(chat_id, utils.bot.sendMessage,
                 chat_id, 'event: \ndirection=%s\ncmd=%s\nparams=%s\nid=%s'%(m.direction, m.cmd, repr(m.params[:100]) if m.params else m.params, m.identifier),
             )
 
+    for device_id, (chat_id, fixes, ctxs) in locations.items():
+        updated = time.time()
+        on_new_locations(outbox, chat_id, device_id, settings[device_id], fixes)
+        for ctx in ctxs:
+            TRACER.span(ctx, 'locations', updated, fixes=len(fixes))
+
+    outbox.send()
@@ -283,12 +283,19 @@ def callback_query(event, context):
     tp, param = cq['data'].split('/', 2)
 
     settings =  utils.DynamoHelper().get_settings(param)
+    answer = 'Ok'
     if tp == 'GPS':
         pos = settings['loc']['M']
         utils.bot.sendLocation(cq['message']['chat']['id'], pos['lat']['N'], pos['lon']['N'], reply_to_message_id=cq['message']['message_id'])
     if tp == 'GSM':
         pos = proto.message.ld.gsm_location_from_info(settings['gsm_info']['S'].split(','))
-        utils.bot.sendLocation(cq['message']['chat']['id'], pos['location']['lat'], pos['location']['lng'], reply_to_message_id=cq['message']['message_id'])
+        if pos is None:
+            answer = 'No cell towers'
+        elif 'location' not in pos:
+            log.warning('gsm location failed: %s', pos)
+            answer = 'Location not found'
+        else:
+            utils.bot.sendLocation(cq['message']['chat']['id'], pos['location']['lat'], pos['location']['lng'], reply_to_message_id=cq['message']['message_id'])
 
-    utils.bot.answerCallbackQuery(query_id, text='Ok')
+    utils.bot.answerCallbackQuery(query_id, text=answer)
 
@@ -3,8 +3,23 @@
 import os
 import telepot
 import json
+import time
+import hmac
+import socket
+import decimal
+import hashlib
+import logging
+import threading
 import botocore.session
 
+import proto.cache
+
+SETTINGS_CACHE_SIZE = 1024
+SETTINGS_CACHE_TTL = 30 # settings are changed by the server and other lambda containers too
+OUTBOX_WORKERS = 8
+
+log = logging.getLogger('webhook.handlers.utils')
+
 def create_client(client):
     aws_key_id = os.environ['ACCESS_KEY_ID']
     aws_key_secret = os.environ['SECRET_ACCESS_KEY']
@@ -28,8 +43,37 @@ class SQSHelper:
     def send_message(self, msg):
         self.client.send_message(QueueUrl=self.url, MessageBody=msg)
 
+class PushHelper:
+    '''direct downlink to the gpswatch server, see gpstrack.push'''
+
+    def __init__(self):
+        self.addr = os.environ.get('PUSH_ADDR')
+        self.key = os.environ.get('PUSH_KEY')
+
+    def send_message(self, body):
+        if not self.addr or not self.key:
+            return False
+
+        body = json.dumps(body)
+        sig = hmac.new(self.key.encode(), body.encode(), hashlib.sha256).hexdigest()
+        host, port = self.addr.rsplit(':', 1)
+        try:
+            sock = socket.create_connection((host, int(port)), timeout=2)
+            try:
+                sock.sendall(('%s %s\n'%(sig, body)).encode())
+                res = sock.makefile('rb').readline().strip()
+            finally:
+                sock.close()
+        except (socket.error, socket.timeout):
+            log.warning('push to %s failed', self.addr, exc_info=True)
+            return False
+
+        log.debug('push result: %s', res)
+        return res == b'ok'
+
 class DynamoHelper:
     __dynamo = None
+    settings = proto.cache.ttl_cache(maxsize=SETTINGS_CACHE_SIZE, ttl=SETTINGS_CACHE_TTL)
     def __init__(self):
         if not DynamoHelper.__dynamo:
             DynamoHelper.__dynamo = create_client('dynamodb')
@@ -43,17 +87,67 @@ class DynamoHelper:
         )
         return res.get('Item')
 
+    def get_objects(self, keys):
+        '''consistent BatchGetItem of (device_id, ts) keys, returns items by key'''
+        # dynamo returns numbers in canonical form, match them as decimals
+        wanted = dict(((d, decimal.Decimal('%s'%ts)), (d, ts)) for d, ts in keys)
+        keys = list(set(wanted.values()))
+        found = {}
+        for i in range(0, len(keys), 100):
+            request = {'gpswatch': {
+                'Keys': [{'device_id': {'S': d}, 'ts': {'N': '%s'%ts}} for d, ts in keys[i:i+100]],
+                'ConsistentRead': True,
+            }}
+            attempt = 0
+            while request:
+                res = self.client.batch_get_item(RequestItems=request)
+                for item in res['Responses'].get('gpswatch', []):
+                    key = (item['device_id']['S'], decimal.Decimal(item['ts']['N']))
+                    found[wanted.get(key, key)] = item
+                request = res.get('UnprocessedKeys')
+                if request:
+                    time.sleep(min(0.05 * 2 ** attempt, 1))
+                    attempt += 1
+        return found
+
     def get_settings(self, key):
-        return self.get_object(key, 0)
+        res = DynamoHelper.settings.get(key, DynamoHelper.settings.missing)
+        if res is DynamoHelper.settings.missing:
+            res = self.get_object(key, 0)
+            DynamoHelper.settings.set(key, res)
+        return res
+
+    def get_settings_many(self, keys):
+        '''settings rows by device id (None for unknown ones), misses are read in one batch'''
+        res = {}
+        misses = []
+        for key in set(keys):
+            item = DynamoHelper.settings.get(key, DynamoHelper.settings.missing)
+            if item is DynamoHelper.settings.missing:
+                misses.append(key)
+            else:
+                res[key] = item
+        if misses:
+            found = self.get_objects([(key, 0) for key in misses])
+            for key in misses:
+                res[key] = found.get((key, 0))
+                DynamoHelper.settings.set(key, res[key])
+        return res
 
     
     def send_message(self, msg):
+        item = msg.to_dynamo()
         self.client.put_item(
             TableName='gpswatch',
-            Item=msg.to_dynamo()
+            Item=item
         )
-        
-        SQSHelper().send_message(json.dumps({'id': msg.identifier, 'cmd': msg.cmd, 'direction': msg.direction}))
+
+        body = {'id': msg.identifier, 'cmd': msg.cmd, 'direction': msg.direction, 'sent': time.time()}
+        if PushHelper().send_message(dict(body, item=item)):
+            return
+
+        # watch is not connected right now (or the server is unreachable), let it wait in the queue
+        SQSHelper().send_message(json.dumps(body))
 
     def update_settings(self, key, expression, values):
         self.client.update_item(
@@ -61,6 +155,7 @@ class DynamoHelper:
             Key={'device_id': {'S': key}, 'ts': {'N': '0'}},
             UpdateExpression=expression,
             ExpressionAttributeValues=values)
+        DynamoHelper.settings.invalidate(key)
 
 
     def active_devices(self, user_id):
@@ -83,4 +178,51 @@ class DynamoHelper:
                 break
 
 
+class Outbox:
+    '''telegram calls of one invocation
+
+    calls for one chat run in the order they were added, different chats are
+    served concurrently by up to `workers` threads. send() waits for all of
+    them and raises the first error after everything else was sent.
+    '''
+
+    def __init__(self, workers=OUTBOX_WORKERS):
+        self.workers = workers
+        self.chats = {}
+        self.order = []
+
+    def add(self, chat_id, fn, *args, **kwargs):
+        if chat_id not in self.chats:
+            self.chats[chat_id] = []
+            self.order.append(chat_id)
+        self.chats[chat_id].append((fn, args, kwargs))
+
+    def send(self):
+        pending = list(self.order)
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    calls = self.chats[pending.pop(0)]
+                for fn, args, kwargs in calls:
+                    try:
+                        fn(*args, **kwargs)
+                    except Exception as ex:
+                        log.exception('telegram call failed')
+                        errors.append(ex)
+
+        threads = [threading.Thread(target=worker) for i in range(min(self.workers, len(pending)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.chats, self.order = {}, []
+        if errors:
+            raise errors[0]
+
+
 bot = telepot.Bot(os.environ['BOT_KEY'])
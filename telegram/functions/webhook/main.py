@@ -3,6 +3,7 @@
 
 import logging
 import handlers
+import proto.geo
 
 
 log = logging.getLogger('webhook.main')
@@ -11,7 +12,14 @@ log = logging.getLogger('webhook.main')
 def handler(event, context):
     log.debug('event: %s', event)
     log.debug('context: %s', context)
-    
+
+    try:
+        return dispatch(event, context)
+    finally:
+        log.debug('settings cache: %s', handlers.utils.DynamoHelper.settings.stats())
+        log.debug('geolocation cache: %s', proto.geo.default.stats())
+
+def dispatch(event, context):
     if 'message' in event:
         return handlers.telegram.handler(event, context)
 
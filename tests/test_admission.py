@@ -0,0 +1,65 @@
+import asyncio
+
+from gpstrack.admission import Admission, TokenBucket
+from gpstrack.batchread import BatchReader
+
+def test_admission():
+    admission = Admission(2)
+    running = []
+    peak = []
+
+    async def task(n):
+        async with admission:
+            running.append(n)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(n)
+        return n
+
+    async def main():
+        tasks = [asyncio.ensure_future(task(n)) for n in range(6)]
+        await asyncio.sleep(0)
+        tasks[3].cancel() # cancelled while waiting
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    loop = asyncio.new_event_loop()
+    res = loop.run_until_complete(main())
+    loop.close()
+    assert max(peak) == 2
+    assert [r for r in res if isinstance(r, int)] == [0, 1, 2, 4, 5]
+    assert admission.admitted == 5
+    assert admission.running == 0 and not admission.waiting
+
+def test_token_bucket():
+    now = [0.]
+    bucket = TokenBucket(10, burst=2, clock=lambda: now[0])
+    assert [bucket.reserve() for i in range(4)] == [0, 0, 0.1, 0.2]
+    now[0] = 1.
+    assert bucket.reserve() == 0 # refilled, up to burst
+
+def test_batch_reader():
+    batches = []
+
+    async def fetch(keys):
+        batches.append(sorted(keys))
+        await asyncio.sleep(0)
+        if 'bad' in keys:
+            raise RuntimeError('throttled')
+        return dict((k, k.upper()) for k in keys if k != 'missing')
+
+    reader = BatchReader(fetch, max_batch=3, max_delay=0.005)
+
+    async def main():
+        first = await asyncio.gather(*[reader.get(k) for k in ('a', 'b', 'a', 'c', 'd', 'missing')])
+        try:
+            await reader.get('bad')
+        except RuntimeError as ex:
+            return first, str(ex)
+
+    loop = asyncio.new_event_loop()
+    res = loop.run_until_complete(main())
+    loop.close()
+    assert res == (['A', 'B', 'A', 'C', 'D', None], 'throttled')
+    # full at three keys, the rest after max_delay, a key asked for twice is read once
+    assert batches == [['a', 'b', 'c'], ['d', 'missing'], ['bad']]
+    assert reader.keys == 6 and reader.batches == 3
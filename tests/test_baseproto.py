@@ -28,6 +28,28 @@ def test_transport():
         if data:
             stream.send(binascii.unhexlify(data))
 
+def test_transport_pipelined():
+    data = binascii.unhexlify(watch_data)
+
+    class sstream(transport.stream):
+        def __init__(self):
+            super(sstream, self).__init__()
+            self.received = []
+
+        def message_received(self, message):
+            self.received.append(message.raw)
+
+    stream = sstream()
+    stream.send(data)
+    assert len(stream.received) == 3
+    assert b''.join(stream.received) == data
+    assert len(stream.buffer) == 0
+
+    bytewise = sstream()
+    for i in range(len(data)):
+        bytewise.send(data[i:i+1])
+    assert bytewise.received == stream.received
+
 def test_limits():
     stream = transport.stream()
     with tools.assert_raises(transport.ProtocolException):
@@ -88,3 +110,127 @@ watch_data = '5b33472a333230323631333830362a303043442a55442c3133303131372c323035
     +'5b33472a333230323631333830362a303043422a55442c3133303131372c3230353932372c562c35352e3831363934352c4e2c33372e363234323935302c452c302e30302c302e302c302e302c302c35322c3130302c35383639382c302c30303030303030382c372c302c3235302c312c313630332c31323132362c3133392c313630332c31323132322c3134342c313630332c31323132332c3134322c313630332c31343938332c3133342c313630332c34323139342c3132382c313630332c383235362c3132362c313630332c31323132312c3132352c302c36322e385d'
 
 
+
+def test_identifier():
+    from proto import message
+    cmd = message.message.from_command('3G', '6401623106', 'FLOWER', '20', ts='1486372772', direction='server_t')
+    ident = cmd.identifier
+    assert cmd.identifier is ident
+    assert ident == {'ts': '1486372772.1145225125', 'device_id': '3G_6401623106'}
+
+    cmd.direction = 'server'
+    assert cmd.identifier is not ident
+    assert cmd.identifier['ts'] == '1486372772.%s' % cmd.crc32()
+    assert cmd.crc32() != message.message.from_command('3G', '6401623106', 'FLOWER', '20', ts='1486372772', direction='server_t').crc32()
+
+    msg = message.message(b'3G', b'6401623106', b'LK', b'[3G*6401623106*0002*LK]')
+    assert msg.params is None and msg.direction is None and msg.location_data is None
+    assert isinstance(msg.ts, int)
+    with tools.assert_raises(AttributeError):
+        msg.extra = 1
+
+def test_location():
+    from proto import message
+    ud = b'020217,122044,A,55.830853,N,37.6171733,E,1.59,254.8,0.0,11,71,79,58698,0,00100008,7,255,250,1,1604,51815,134,1604,51812,136,0,8.8'
+    ld = message.ld(ud)
+    assert ld.ts_num == 1486038044 # as stored by the arrow based decoder
+    assert (ld.type, ld.lat, ld.lon, ld.batt, ld.tstate) == ('A', '55.830853', '37.6171733', '79', '00100008')
+    assert ld.position == ['A', '55.830853', 'N', '37.6171733', 'E', '1.59', '254.8', '0.0', '11']
+    assert ld.gsm_info == ['7', '255', '250', '1', '1604', '51815', '134', '1604', '51812', '136', '0', '8.8']
+    assert ld.alarm == 'remove watch' and not ld.on_wrist
+
+    st = message.tstate('001f0000')
+    assert st.alarm == 'SOSlow batteryout fenceinto fenceremove watch' and st.on_wrist
+
+    assert message.epoch(b'311299', b'235959') == 946684799
+    assert message.epoch('010170', '000000') == 0
+    for date, time in (('320117', '000000'), ('010117', '240000'), ('0101', '000000')):
+        with tools.assert_raises(ValueError):
+            message.epoch(date, time)
+
+def test_lbs_location():
+    from proto import message
+    ud = '020217,122044,V,55.830853,N,37.6171733,E,1.59,254.8,0.0,11,71,79,58698,0,00000008,1,255,250,1,1604,51815,134,0,8.8'
+    msg = message.message.from_command('3G', '6401623106', 'UD', ud, ts='1486038045', direction='watch')
+    assert 'lbs' not in msg.to_dynamo()['location']['M']
+
+    msg.location_data.gsm_location = {'location': {'lat': 55.83, 'lng': 37.62}, 'accuracy': 550}
+    assert msg.to_dynamo()['location']['M']['lbs'] == {'M': {
+        'lat': {'N': '55.83'}, 'lon': {'N': '37.62'}, 'accuracy': {'N': '550'}}}
+
+def test_unescape():
+    from proto import message
+    assert message.unescape(b'a}\x01b}\x02}\x03}\x04}\x05') == b'a}b[],*'
+    assert message.unescape(b'}\x06}') == b'}\x06}'
+    assert message.unescape(b'}\x01\x05') == b'}\x05'
+
+def test_transport_spool():
+    import io
+    import tempfile
+    from proto import spool
+
+    data = binascii.unhexlify(watch_data)
+    plain = []
+    class pstream(transport.stream):
+        def message_received(self, message):
+            plain.append(message)
+    pstream().send(data)
+    tk = [m for m in plain if m.cmd == 'TK'][0]
+    assert len(tk.raw) >= transport.SPOOL_MIN
+
+    store = spool.directory(tempfile.mkdtemp())
+    for size in (len(data), 1000, 1):
+        received = []
+        class sstream(transport.stream):
+            spool_store = store
+            def message_received(self, message):
+                received.append(message)
+
+        st = sstream()
+        for i in range(0, len(data), size):
+            st.send(data[i:i+size])
+        assert len(st.buffer) == 0
+        assert [m.cmd for m in received] == [m.cmd for m in plain]
+
+        msg = [m for m in received if m.cmd == 'TK'][0]
+        assert msg.raw is None and msg.params is None
+        ref, length = msg.spool
+        assert length == len(tk.params)
+        with store.open(ref) as f:
+            assert f.read() == tk.params
+        assert b''.join(spool.frame_chunks(msg, store, size=4096)) == tk.raw
+
+        msg.direction = 'watch'
+        restored = message_from_dynamo(msg.to_dynamo())
+        assert restored.spool == msg.spool and restored.identifier == msg.identifier
+
+    # a frame being spooled continues in another stream, as after a handover
+    received = []
+    cut = data.index(b'*TK,') + 5000
+    first, second = sstream(), sstream()
+    first.send(data[:cut])
+    state = json.loads(json.dumps(first.spool_state()))
+    second.resume_spool(state)
+    second.send(data[cut:])
+    msg = [m for m in received if m.cmd == 'TK'][0]
+    with store.open(msg.spool[0]) as f:
+        assert f.read() == tk.params
+
+    out = io.BytesIO()
+    with store.open(ref) as f:
+        spool.unescape_stream(f, out, size=7)
+    from proto import message
+    assert out.getvalue() == message.unescape(tk.params)
+
+def message_from_dynamo(item):
+    from proto import message
+    return message.message.from_dynamo(item)
+
+def test_fix_index():
+    from proto import message
+    ud = '020217,122044,%s,55.830853,N,37.6171733,E,1.59,254.8,0.0,11,71,79,58698,0,00000000,0,0,8.8'
+    msg = message.message.from_command('3G', '6401623106', 'UD', ud % 'A', ts='1486038045', direction='watch')
+    assert msg.to_dynamo()[message.FIX_INDEX_KEY] == {'N': msg.identifier['ts']}
+    for cmd, fix in (('UD', 'V'), ('AL', 'A')):
+        msg = message.message.from_command('3G', '6401623106', cmd, ud % fix, ts='1486038045', direction='watch')
+        assert message.FIX_INDEX_KEY not in msg.to_dynamo()
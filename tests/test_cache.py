@@ -0,0 +1,24 @@
+from proto import cache
+
+
+def test_ttl_cache():
+    now = [1000.0]
+    c = cache.ttl_cache(maxsize=2, ttl=10, clock=lambda: now[0])
+
+    c.set('a', 1)
+    c.set('b', None)
+    assert c.get('b', c.missing) is None
+    assert c.get('a') == 1
+    assert c.get('c', c.missing) is c.missing
+
+    c.set('c', 3) # 'a' was used last, 'b' is evicted
+    assert 'b' not in c
+    assert c.get('a') == 1
+
+    now[0] += 11
+    assert c.get('a') is None
+
+    c.set('a', 1)
+    c.invalidate('a')
+    assert 'a' not in c
+    assert c.stats() == {'size': 1, 'hits': 3, 'misses': 2, 'evictions': 1}
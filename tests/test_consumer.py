@@ -0,0 +1,79 @@
+import asyncio
+
+from gpstrack.consumer import OrderedConsumer
+from proto import transport
+from proto.message import message
+
+
+class Transport:
+    def __init__(self):
+        self.closing = False
+
+    def is_closing(self):
+        return self.closing
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+
+class Conn(OrderedConsumer, transport.stream):
+    side = 'watch'
+    context = 'W1'
+
+    def __init__(self, geo):
+        super().__init__()
+        self.transport = Transport()
+        self.geo = geo
+        self.stored = []
+
+    def message_received(self, msg):
+        msg.direction = 'watch'
+        super().message_received(msg)
+
+    async def process_frame(self, msg):
+        # like MessageQueue.send_message waiting for a geolocation lookup
+        await self.geo
+        self.stored.append((msg.cmd, self.lost))
+
+
+def test_frames_stored_after_connection_lost():
+    async def main():
+        geo = asyncio.get_event_loop().create_future()
+        conn = Conn(geo)
+        conn.start_consumer()
+        conn.data_received(message.from_command('3G', '6401623106', 'AL', 'x').raw)
+        conn.data_received(message.from_command('3G', '6401623106', 'UD', 'y').raw)
+        await asyncio.sleep(0)
+        assert conn.busy # AL is waiting for the lookup
+
+        conn.transport.closing = True
+        conn.stop_consumer()
+        await asyncio.sleep(0.01)
+        assert not conn.consumer.done()
+        geo.set_result(None)
+        await asyncio.wait_for(conn.consumer, 1)
+        return conn
+
+    loop = asyncio.new_event_loop()
+    conn = loop.run_until_complete(main())
+    loop.close()
+    assert conn.stored == [('AL', True), ('UD', True)]
+    assert not OrderedConsumer.consumers
+
+
+def test_cancel_consumers():
+    async def main():
+        conn = Conn(asyncio.get_event_loop().create_future())
+        conn.start_consumer()
+        conn.data_received(message.from_command('3G', '6401623106', 'AL', 'x').raw)
+        await asyncio.sleep(0)
+        await OrderedConsumer.cancel_consumers()
+        return conn
+
+    loop = asyncio.new_event_loop()
+    conn = loop.run_until_complete(main())
+    loop.close()
+    assert conn.consumer.cancelled() and not conn.stored
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import threading
+import time
+
+from proto import geo
+
+INFO = '7,255,250,1,1603,12125,143,1603,12122,150,1603,14983,140'.split(',')
+INFO[0] = '3'
+
+def test_towers():
+    key = geo.towers(INFO)
+    assert key == (250, 1, ((1603, 12122, 150), (1603, 12125, 140), (1603, 14983, 140)))
+    shuffled = INFO[:4] + INFO[7:10] + INFO[4:7] + INFO[10:13]
+    shuffled[-1] = '138'
+    assert geo.towers(shuffled) == key
+    assert geo.towers(['0', '255', '250', '1']) is None
+
+def test_locator():
+    bodies = []
+    def fetch(body):
+        bodies.append(body)
+        return {'location': {'lat': 55.8, 'lng': 37.6}, 'accuracy': 900}
+
+    loc = geo.locator(fetch)
+    assert loc.lookup(INFO)['location'] == {'lat': 55.8, 'lng': 37.6}
+    assert loc.lookup(INFO)['accuracy'] == 900
+    assert len(bodies) == 1
+    assert len(bodies[0]['cellTowers']) == 3
+
+    # a subset of known cells is estimated without a request
+    subset = ['2'] + INFO[1:10]
+    est = loc.lookup(subset)
+    assert est['estimated'] and abs(est['location']['lat'] - 55.8) < 1e-9
+    assert len(bodies) == 1
+
+    # errors are not cached
+    loc = geo.locator(lambda body: bodies.append(body) or {'error': {'code': 404}})
+    assert 'error' in loc.lookup(INFO)
+    loc.lookup(INFO)
+    assert len(bodies) == 3
+
+def test_single_flight():
+    calls = []
+    def fetch(body):
+        calls.append(body)
+        time.sleep(0.1)
+        return {'location': {'lat': 1., 'lng': 2.}, 'accuracy': 10}
+
+    loc = geo.locator(fetch)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(loc.lookup(INFO))) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert len(results) == 8 and all(r['location']['lat'] == 1. for r in results)
+    assert loc.stats()['coalesced'] == 7
+
+class stub_server(object):
+    '''minimal keep-alive http server answering geolocation requests'''
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.slow = {} # delay by cell id
+        self.bodies = []
+        self.connections = 0
+        self.active = 0
+        self.peak = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except asyncio.IncompleteReadError:
+                break
+            size = int([l.split(b':')[1] for l in head.lower().split(b'\r\n') if l.startswith(b'content-length')][0])
+            body = json.loads((await reader.readexactly(size)).decode())
+            self.bodies.append(body)
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            cell = body['cellTowers'][0]['cellId']
+            await asyncio.sleep(self.slow.get(cell, self.delay))
+            self.active -= 1
+            data = json.dumps({'location': {'lat': 55.0, 'lng': float(cell)}, 'accuracy': 500}).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s' % (len(data), data))
+
+def towers_info(cellid):
+    return ['1', '255', '250', '1', '1603', str(cellid), '140']
+
+def test_geo_client():
+    from gpstrack.geo import GeoClient
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    stub = stub_server()
+    server = loop.run_until_complete(asyncio.start_server(stub.handle, '127.0.0.1', 0))
+    url = 'http://127.0.0.1:%s/geolocate' % server.sockets[0].getsockname()[1]
+
+    client = GeoClient('key', url=url, concurrency=3, timeout=1, batch_delay=0.01)
+    loop.run_until_complete(client.start())
+
+    # 20 lookups of 10 tower sets: coalesced, at most 3 requests in flight
+    answers = loop.run_until_complete(asyncio.gather(*[client.lookup(towers_info(i % 10)) for i in range(20)]))
+    assert [a['location']['lng'] for a in answers] == [float(i % 10) for i in range(20)]
+    assert len(stub.bodies) == 10
+    assert stub.peak == 3 and stub.connections == 3
+    assert client.stats()['coalesced'] == 10 and client.stats()['batches'] == 1
+
+    # cached now
+    assert loop.run_until_complete(client.lookup(towers_info(3)))['location']['lng'] == 3.
+    assert len(stub.bodies) == 10
+
+    # a timeout resolves to None and is not cached
+    stub.delay = 1.2
+    assert loop.run_until_complete(client.lookup(towers_info(11))) is None
+    assert client.stats()['failed'] == 1
+    loop.run_until_complete(asyncio.sleep(0.3))
+
+    # a slow request does not hold the next batch, close() waits for it
+    stub.delay = 0.05
+    stub.slow = {12: 0.8}
+    pending = loop.create_task(client.lookup(towers_info(12)))
+    loop.run_until_complete(asyncio.sleep(0.05))
+    started = time.time()
+    assert loop.run_until_complete(client.lookup(towers_info(13)))['location']['lng'] == 13.
+    assert time.time() - started < 0.4
+    loop.run_until_complete(client.close())
+    assert pending.result()['location']['lng'] == 12.
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
@@ -0,0 +1,19 @@
+import xml.etree.ElementTree as ET
+
+from proto import gpx
+
+NS = '{http://www.topografix.com/GPX/1/1}'
+
+def test_chunks():
+    points = [('55.8%04d' % i, '37.6%04d' % i, 1486038044 + i) for i in range(1200)]
+    pieces = list(gpx.chunks(iter(points), batch=500))
+    assert len(pieces) == 5 # header, 500, 500, 200, trailer
+
+    doc = ET.fromstring(''.join(pieces).encode())
+    pts = doc.findall('%strk/%strkseg/%strkpt' % (NS, NS, NS))
+    assert [(p.get('lat'), p.get('lon')) for p in pts] == [p[:2] for p in points]
+    assert pts[0].find(NS + 'time').text == '2017-02-02T12:20:44Z'
+
+def test_empty():
+    doc = ET.fromstring(''.join(gpx.chunks([])).encode())
+    assert doc.findall('%strk/%strkseg/%strkpt' % (NS, NS, NS)) == []
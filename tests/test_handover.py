@@ -0,0 +1,26 @@
+import os
+import socket
+
+from gpstrack import handover
+
+
+def test_handover_fds():
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    r, w = os.pipe()
+    try:
+        handover.send(a, {'device_id': '3G_1', 'last_msg': {'data_raw': {'B': b'AAE=\n'}}}, [w])
+        handover.send(a, {'done': True})
+
+        state, fds = handover.recv(b)
+        assert state == {'device_id': '3G_1', 'last_msg': {'data_raw': {'B': 'AAE=\n'}}}
+        assert len(fds) == 1 and fds[0] != w
+        os.write(fds[0], b'x')
+        os.close(fds[0])
+        assert os.read(r, 1) == b'x'
+
+        assert handover.recv(b) == ({'done': True}, [])
+    finally:
+        for s in (a, b):
+            s.close()
+        os.close(r)
+        os.close(w)
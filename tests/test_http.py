@@ -0,0 +1,97 @@
+import base64
+import os
+import sys
+import tempfile
+import time
+
+from email.utils import formatdate
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'telegram', 'functions', 'webhook'))
+os.environ.setdefault('BOT_KEY', '1:x')
+
+from handlers import http
+from handlers.http import cache
+
+def request(track_id='abc.gpx', **headers):
+    return {'params': {'path': {'track-id': track_id}, 'querystring': {}, 'header': headers}}
+
+def test_conditional_get():
+    entry = cache.Entry.build('<gpx/>')
+    res = http.respond(request(), entry, True)
+    assert res['statusCode'] == 200 and res['body'] == b'<gpx/>'
+    assert res['headers']['Cache-Control'] == 'public, max-age=86400'
+    etag = res['headers']['ETag']
+
+    assert http.respond(request(**{'If-None-Match': etag}), entry, True)['statusCode'] == 304
+    assert http.respond(request(**{'if-none-match': '"x", W/' + etag}), entry, True)['statusCode'] == 304
+    assert http.respond(request(**{'If-None-Match': '"x"'}), entry, True)['statusCode'] == 200
+
+    later = formatdate(entry.modified + 10, usegmt=True)
+    earlier = formatdate(entry.modified - 10, usegmt=True)
+    assert http.respond(request(**{'If-Modified-Since': later}), entry, True)['statusCode'] == 304
+    assert http.respond(request(**{'If-Modified-Since': earlier}), entry, True)['statusCode'] == 200
+    assert http.respond(request(**{'If-Modified-Since': 'garbage'}), entry, True)['statusCode'] == 200
+    # If-None-Match wins over If-Modified-Since
+    assert http.respond(request(**{'If-None-Match': '"x"', 'If-Modified-Since': later}), entry, True)['statusCode'] == 200
+
+def test_gzip(monkeypatch):
+    monkeypatch.setattr(http, 'GZIP', True)
+    entry = cache.Entry.build('<gpx/>')
+    plain = http.respond(request(), entry, False)
+    gz = http.respond(request(**{'Accept-Encoding': 'gzip, deflate'}), entry, False)
+    assert plain['headers']['Vary'] == gz['headers']['Vary'] == 'Accept-Encoding'
+    assert gz['headers']['Content-Encoding'] == 'gzip' and gz['isBase64Encoded']
+    assert cache.decompress(base64.b64decode(gz['body'])) == b'<gpx/>'
+    assert gz['headers']['ETag'] != plain['headers']['ETag']
+
+    # an etag matches its own representation only
+    res = http.respond(request(**{'Accept-Encoding': 'gzip', 'If-None-Match': plain['headers']['ETag']}), entry, False)
+    assert res['statusCode'] == 200
+    res = http.respond(request(**{'Accept-Encoding': 'gzip', 'If-None-Match': gz['headers']['ETag']}), entry, False)
+    assert res['statusCode'] == 304
+
+def test_final_window(monkeypatch):
+    now = time.time()
+    assert http.final(('3G_1', '0', str(now - http.SETTLE - 1)))
+    assert not http.final(('3G_1', '0', str(now - http.SETTLE + 60)))
+
+    store = cache.TrackCache(tempfile.mkdtemp())
+    monkeypatch.setattr(http, 'CACHE', store)
+    monkeypatch.setattr(http.utils, 'DynamoHelper', lambda: None)
+    reads = []
+    def track_points(dynamo, device_id, f, t):
+        reads.append((f, t))
+        return [('55.8', '37.6', f)]
+    monkeypatch.setattr(http, 'track_points', track_points)
+
+    windows = {'old': ('3G_1', '1486038000', str(int(now - 3600))), 'open': ('3G_1', '1486038000', str(int(now)))}
+    monkeypatch.setattr(http, 'track_window', windows.get)
+
+    # a final window is generated once and cached
+    first = http.handler(request('old.gpx'), None)
+    second = http.handler(request('old.gpx'), None)
+    assert len(reads) == 1 and first['body'] == second['body']
+    assert second['headers']['Cache-Control'] == 'public, max-age=86400'
+
+    # fixes may still arrive for an open one
+    for i in range(2):
+        res = http.handler(request('open.gpx'), None)
+    assert len(reads) == 3 and res['headers']['Cache-Control'] == 'no-cache'
+
+def test_track_cache():
+    path = tempfile.mkdtemp()
+    store = cache.TrackCache(path, entries=2)
+    assert store.get('a') is None
+
+    for i, key in enumerate('abc'):
+        entry = cache.Entry.build('<gpx>%s</gpx>' % key)
+        store.put(key, entry)
+        # oldest first, whatever the clock resolution of the file system
+        for suffix in ('.json', '.gz'):
+            os.utime(store.name(key) + suffix, (1000 + i, 1000 + i))
+    store.expire()
+
+    assert store.get('a') is None
+    got = store.get('c')
+    assert got.body == b'<gpx>c</gpx>' and got.etag == entry.etag and got.modified == entry.modified
+    assert sorted(os.listdir(path)) == sorted(os.path.basename(store.name(k)) + s for k in 'bc' for s in ('.gz', '.json'))
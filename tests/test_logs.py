@@ -0,0 +1,57 @@
+import asyncio
+import json
+import logging
+
+from gpstrack import logs
+
+class Collect(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.addFilter(logs.ContextFilter())
+
+    def emit(self, record):
+        self.records.append(record)
+
+def test_context():
+    log = logging.getLogger('gpstrack.test.context')
+    log.propagate = False
+    h = Collect()
+    log.addHandler(h)
+
+    async def conn(name):
+        logs.context.set(name)
+        await asyncio.sleep(0)
+        log.warning('in %s', name)
+
+    async def main():
+        await asyncio.gather(conn('W1'), conn('W2'))
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(main())
+    loop.close()
+    log.warning('outside')
+    log.warning('explicit', extra={'context': 'S1'})
+    assert [(r.getMessage(), r.context) for r in h.records] == [
+        ('in W1', 'W1'), ('in W2', 'W2'), ('outside', 'GLOBAL'), ('explicit', 'S1')]
+
+def test_rate_limit():
+    now = [0.]
+    limit = logs.RateLimit(2, burst=2, clock=lambda: now[0])
+    log = logging.getLogger('gpstrack.test.rate')
+    log.propagate = False
+    h = Collect()
+    log.addHandler(h)
+    log.addFilter(limit)
+
+    for i in range(5):
+        log.warning('chunk %s', i)
+    now[0] += 1
+    log.warning('chunk %s', 5)
+    assert [r.getMessage() for r in h.records] == ['chunk 0', 'chunk 1', 'chunk 5 [3 similar records dropped]']
+
+def test_json():
+    record = logging.LogRecord('gpstrack.test', logging.INFO, __file__, 1, 'frame %s', ('UD',), None)
+    record.context = 'W1'
+    doc = json.loads(logs.JsonFormatter().format(record))
+    assert doc['message'] == 'frame UD' and doc['context'] == 'W1' and doc['level'] == 'INFO'
@@ -0,0 +1,80 @@
+import asyncio
+import socket
+
+from gpstrack import handover, metrics
+
+def test_render():
+    r = metrics.Registry()
+    frames = r.counter('frames_total', 'frames', labels=('direction', 'cmd'))
+    frames['in', 'LK'] += 2
+    frames['out', 'say "hi"'] += 1
+    delay = r.histogram('delay_seconds', 'delay', labels=('stage',), buckets=(.1, 1))
+    delay['dynamo'].observe(.05)
+    delay['dynamo'].observe(.5)
+    delay['dynamo'].observe(5)
+    r.gauge('online', 'online devices', lambda: 3)
+    r.gauge('buffers', 'buffers', lambda: {'watch': 10}, labels=('side',))
+    r.gauge('broken', 'raises', lambda: 1 / 0)
+
+    lines = r.render().splitlines()
+    assert '# TYPE frames_total counter' in lines
+    assert 'frames_total{direction="in",cmd="LK"} 2' in lines
+    assert 'frames_total{direction="out",cmd="say \\"hi\\""} 1' in lines
+    assert lines[lines.index('# TYPE delay_seconds histogram') + 1:][:5] == [
+        'delay_seconds_bucket{stage="dynamo",le="0.1"} 1',
+        'delay_seconds_bucket{stage="dynamo",le="1"} 2',
+        'delay_seconds_bucket{stage="dynamo",le="+Inf"} 3',
+        'delay_seconds_sum{stage="dynamo"} 5.55',
+        'delay_seconds_count{stage="dynamo"} 3']
+    assert 'online 3' in lines
+    assert 'buffers{side="watch"} 10' in lines
+    assert not [l for l in lines if 'broken' in l]
+
+def test_server():
+    r = metrics.Registry()
+    r.counter('hits_total', 'hits')[()] += 1
+
+    async def main():
+        server = metrics.MetricsServer(r)
+        s = await server.start('127.0.0.1', 0)
+        port = s.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+        res = await reader.read()
+        writer.close()
+        await server.close()
+        return res
+
+    loop = asyncio.new_event_loop()
+    res = loop.run_until_complete(main())
+    loop.close()
+    head, body = res.split(b'\r\n\r\n', 1)
+    assert head.startswith(b'HTTP/1.0 200')
+    assert b'hits_total 1\n' in body
+
+def test_server_handed_over():
+    r = metrics.Registry()
+    r.counter('hits_total', 'hits')[()] += 1
+
+    async def main():
+        old = metrics.MetricsServer(r)
+        s = await old.start('127.0.0.1', 0)
+        port = s.sockets[0].getsockname()[1]
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        with a, b:
+            handover.send(a, {'services': {'metrics': 1}}, [s.sockets[0].fileno()])
+            state, fds = handover.recv(b)
+        new = metrics.MetricsServer(r)
+        await new.start('127.0.0.1', port, sock=socket.socket(fileno=fds[0]))
+        await old.close() # the port stays open in the new server
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+        res = await reader.read()
+        writer.close()
+        await new.close()
+        return res
+
+    loop = asyncio.new_event_loop()
+    res = loop.run_until_complete(main())
+    loop.close()
+    assert res.startswith(b'HTTP/1.0 200')
@@ -0,0 +1,54 @@
+import asyncio
+import json
+import socket
+import time
+
+from gpstrack import push
+
+
+def test_push_process():
+    delivered = []
+    async def deliver(req):
+        delivered.append(req['id'])
+        return req['id'] != 'offline'
+    server = push.PushServer('secret', deliver)
+
+    def request(ident, key=b'secret', sent=None):
+        body = json.dumps({'id': ident, 'sent': time.time() if sent is None else sent}).encode()
+        line = push.sign(key, body) + b' ' + body
+        return loop.run_until_complete(server.process(line))
+
+    loop = asyncio.new_event_loop()
+
+    assert request('a') == b'ok'
+    assert request('offline') == b'offline'
+    assert request('b', key=b'wrong') == b'error'
+    assert request('c', sent=time.time() - 3600) == b'error'
+    assert loop.run_until_complete(server.process(b'garbage')) == b'error'
+    assert request('a') == b'error' # replayed
+    assert delivered == ['a', 'offline']
+    loop.close()
+
+def test_push_on_socket():
+    async def deliver(req):
+        return True
+    server = push.PushServer('secret', deliver)
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(8)
+    port = sock.getsockname()[1]
+
+    async def main():
+        await server.start('127.0.0.1', port, sock=sock)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        body = json.dumps({'id': 'a', 'sent': time.time()}).encode()
+        writer.write(push.sign(b'secret', body) + b' ' + body + b'\n')
+        answer = await reader.readline()
+        writer.close()
+        await asyncio.sleep(0.05) # the handler sees the end of the connection
+        await server.close()
+        return answer
+
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(main()) == b'ok\n'
+    loop.close()
@@ -0,0 +1,53 @@
+import asyncio
+
+import gpswatch
+from proto.message import message
+
+V_FIX = '020217,122044,V,55.8,N,37.6,E,1.59,254.8,0.0,11,71,79,58698,0,%s,1,255,250,1,1604,51815,134,0,8.8'
+
+class Writer:
+    def __init__(self):
+        self.put_at = {}
+
+    async def put(self, msg):
+        self.put_at[msg.cmd] = (asyncio.get_event_loop().time(), msg.location_data.gsm_location)
+
+class Geo:
+    def __init__(self, delay=0, fail=False):
+        self.delay = delay
+        self.fail = fail
+
+    async def lookup(self, info):
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise ValueError('truncated gsm_info')
+        return {'location': {'lat': 55.8, 'lng': 37.6}}
+
+def send(geo, *msgs):
+    queue = gpswatch.MessageQueue(pool=None)
+    queue.writer = Writer()
+    queue.geo = geo
+
+    async def main():
+        started = asyncio.get_event_loop().time()
+        for m in msgs:
+            await queue.send_message(m)
+        return dict((cmd, (t - started, loc)) for cmd, (t, loc) in queue.writer.put_at.items())
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+def test_lookup_failure_still_stored():
+    ud = message.from_command('3G', '1', 'UD', V_FIX % '00000008', direction='watch')
+    assert send(Geo(fail=True), ud)['UD'][1] is None
+
+def test_alarm_not_held_by_lookup():
+    al = message.from_command('3G', '1', 'AL', V_FIX % '00010000', direction='watch')
+    ud = message.from_command('3G', '1', 'UD', V_FIX % '00000008', direction='watch')
+    put = send(Geo(delay=1), al, ud)
+    assert put['AL'][0] < 0.5 and put['AL'][1] is None
+    assert put['UD'][1]['location']['lat'] == 55.8
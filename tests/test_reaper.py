@@ -0,0 +1,34 @@
+from gpstrack.reaper import IdleReaper
+
+class Conn:
+    def __init__(self, name, busy=False):
+        self.name = name
+        self.busy = busy
+
+def test_reaper():
+    now = [1000.]
+    reaped = []
+    def reap(conn):
+        if conn.busy:
+            return False
+        reaped.append((conn.name, now[0]))
+    reaper = IdleReaper(3, reap, tick=1, clock=lambda: now[0])
+
+    quiet, talking, busy, gone = Conn('quiet'), Conn('talking'), Conn('busy', busy=True), Conn('gone')
+    for c in (quiet, talking, busy, gone):
+        reaper.add(c)
+    reaper.discard(gone)
+    for i in range(8):
+        now[0] += 1
+        talking.last_seen = now[0]
+        reaper.advance()
+    assert reaped == [('quiet', 1003.)]
+    assert reaper.reaped == 1
+
+    # busy is checked again a timeout later, reaped once it is not
+    busy.busy = False
+    talking.last_seen = now[0]
+    now[0] += 10 # a stall longer than the wheel
+    assert reaper.advance() == 2
+    assert sorted(name for name, t in reaped[1:]) == ['busy', 'talking']
+    assert not any(reaper.slots)
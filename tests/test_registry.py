@@ -0,0 +1,44 @@
+import asyncio
+import os
+import tempfile
+
+from gpstrack import registry
+
+
+def test_registry_routing():
+    path = os.path.join(tempfile.mkdtemp(), 'registry.sock')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    def item(device):
+        return {'item': {'device_id': {'S': device}, 'data_raw': {'B': b'AAE=\n'}}}
+
+    async def run():
+        broker = registry.RegistryBroker(path)
+        await broker.start()
+
+        got = {'w1': [], 'w2': []}
+        w1 = registry.RegistryClient(path, lambda req: got['w1'].append(req) or True)
+        w2 = registry.RegistryClient(path, lambda req: got['w2'].append(req) or True)
+        await w1.connect(devices=['3G_1'])
+        await w2.connect()
+        w2.online('3G_2')
+        w2.online('3G_1') # watch reconnected to the second worker
+        w1.offline('3G_1') # late offline from the first one must be ignored
+        await asyncio.sleep(0.05)
+
+        results = [await broker.deliver(item(d)) for d in ('3G_1', '3G_2', '3G_3')]
+        for w in (w1, w2):
+            w.writer.close()
+        await asyncio.sleep(0.05)
+        await broker.close()
+        return got, results, broker.owners
+
+    got, results, owners = loop.run_until_complete(run())
+    loop.close()
+
+    assert results == [True, True, False]
+    assert got['w1'] == []
+    assert [r['item']['device_id']['S'] for r in got['w2']] == ['3G_1', '3G_2']
+    assert got['w2'][0]['item']['data_raw']['B'] == 'AAE=\n'
+    assert owners == {}
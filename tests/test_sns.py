@@ -0,0 +1,57 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'telegram', 'functions', 'webhook'))
+os.environ.setdefault('BOT_KEY', '1:x')
+
+from handlers import sns, utils
+from proto.message import message
+
+UD = '020217,122044,A,55.8,N,37.6,E,1.59,254.8,0.0,11,71,79,58698,0,00000008,0,0,8.8'
+AL = '020217,122050,A,55.9,N,37.7,E,1.59,254.8,0.0,11,71,78,58698,0,00010000,0,0,8.8'
+
+class FakeDynamo(object):
+    def __init__(self):
+        self.items = {}
+        self.updates = []
+
+    def put(self, item):
+        self.items[(item['device_id']['S'], item['ts']['N'])] = item
+
+    def batch_get_item(self, RequestItems):
+        keys = RequestItems['gpswatch']['Keys']
+        found = [self.items[k['device_id']['S'], k['ts']['N']] for k in keys
+                if (k['device_id']['S'], k['ts']['N']) in self.items]
+        return {'Responses': {'gpswatch': found}}
+
+    def update_item(self, **kwargs):
+        self.updates.append(kwargs)
+
+class FakeBot(object):
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name,) + args)
+
+def test_traced_records_without_tracer(monkeypatch):
+    dynamo = FakeDynamo()
+    bot = FakeBot()
+    monkeypatch.setattr(utils.DynamoHelper, '_DynamoHelper__dynamo', dynamo)
+    monkeypatch.setattr(utils, 'bot', bot)
+    monkeypatch.setattr(sns, 'TRACER', None)
+    utils.DynamoHelper.settings.clear()
+
+    dynamo.put({'device_id': {'S': '3G_1'}, 'ts': {'N': '0'}, 'chat_id': {'S': '42'}, 'tstate': {'S': '00000008'}})
+    records = []
+    for i, (cmd, params) in enumerate([('UD', UD), ('AL', AL)]):
+        m = message.from_command('3G', '1', cmd, params, direction='watch', ts=str(1486038045 + i))
+        dynamo.put(m.to_dynamo())
+        # the server traces, the webhook does not
+        body = {'id': m.identifier, 'cmd': cmd, 'trace': {'trace': 't%s' % i, 'start': 1.0}}
+        records.append({'Sns': {'Message': json.dumps(body)}})
+
+    sns.handler({'Records': records}, None)
+    assert bot.calls[:2] == [('sendMessage', '42', 'alarm: SOS'), ('sendLocation', '42', '55.9', '37.7')]
+    assert len(dynamo.updates) == 1
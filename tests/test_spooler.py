@@ -0,0 +1,57 @@
+import asyncio
+import json
+import os
+import tempfile
+
+from gpstrack.spooler import Spooler
+from proto import transport
+from proto.message import message
+
+def frames():
+    tk = message.from_command('3G', '1', 'TK', bytes(range(256)) * 40)
+    lk = message.from_command('3G', '1', 'LK', '1,2,3')
+    return tk, lk.raw + tk.raw + lk.raw
+
+def test_spooler_load():
+    tk, data = frames()
+    path = tempfile.mkdtemp()
+    store = Spooler(path)
+    received = []
+    class sstream(transport.stream):
+        spool_store = store
+        def message_received(self, msg):
+            received.append(msg)
+
+    st = sstream()
+    for i in range(0, len(data), 1000):
+        st.send(data[i:i+1000])
+    assert [m.cmd for m in received] == ['LK', 'TK', 'LK']
+    assert received[1].spool and len(st.buffer) == 0
+
+    loop = asyncio.new_event_loop()
+    loaded = loop.run_until_complete(store.load(received[1]))
+    loop.close()
+    assert loaded.raw == tk.raw and loaded.params == tk.params and loaded.spool is None
+    assert os.listdir(path) == [] # the payload lives in the record now
+
+def test_spooler_resume():
+    tk, data = frames()
+    store = Spooler(tempfile.mkdtemp())
+    received = []
+    class sstream(transport.stream):
+        spool_store = store
+        def message_received(self, msg):
+            received.append(msg)
+
+    # a frame being spooled continues in another stream, as after a handover
+    cut = data.index(b'*TK,') + 5000
+    first, second = sstream(), sstream()
+    first.send(data[:cut])
+    state = json.loads(json.dumps(first.spool_state()))
+    second.resume_spool(state)
+    second.send(data[cut:])
+
+    loop = asyncio.new_event_loop()
+    loaded = loop.run_until_complete(store.load(received[1]))
+    loop.close()
+    assert loaded.raw == tk.raw
@@ -0,0 +1,47 @@
+import json
+import os
+import tempfile
+
+from proto import trace
+
+def test_collector_and_report():
+    path = os.path.join(tempfile.mkdtemp(), 'trace.jsonl')
+    tracer = trace.collector(path)
+    ctx = trace.context(100.)
+    tracer.span(ctx, 'parse', 100., 100.5, cmd='AL')
+    tracer.span(ctx, 'queue', 100.5, 101.)
+    tracer.span(ctx, 'sns', 101., 102.)
+    wrapped = tracer.wrap(ctx, 'telegram.alarm', lambda x: x * 2)
+    assert wrapped(21) == 42
+    tracer.span(trace.context(), 'parse', 200., 200.1, cmd='UD')
+    tracer.close()
+
+    with open(path) as f:
+        assert json.loads(f.readline()) == {'trace': ctx['trace'], 'name': 'parse', 'start': 100., 'end': 100.5, 'cmd': 'AL'}
+    traces = trace.load([path])
+    assert len(traces) == 2
+    spans = traces[ctx['trace']]
+    assert [s['name'] for s in spans] == ['parse', 'queue', 'sns', 'telegram.alarm']
+
+    stages = trace.stages(spans[:3])
+    assert stages == [('parse', .5), ('queue', .5), ('sns', 1.), ('total', 2.)]
+    stages = dict(trace.stages(spans))
+    assert stages['wait > telegram.alarm'] > 0 and stages['total'] == spans[-1]['end'] - 100.
+
+    lines = trace.report(traces, cmd='AL')
+    assert [l.split()[0] for l in lines[1:]] == ['parse', 'queue', 'sns', 'wait', 'telegram.alarm', 'total']
+    assert all(l.split()[-5] == '1' for l in lines[1:])
+
+def test_threaded_collector():
+    from gpstrack.tracing import ThreadedCollector
+
+    path = os.path.join(tempfile.mkdtemp(), 'trace.jsonl')
+    tracer = ThreadedCollector(path)
+    ctxs = [trace.context() for i in range(100)]
+    for i, ctx in enumerate(ctxs):
+        tracer.span(ctx, 'parse', i, i + .5)
+    tracer.close()
+    tracer.close()
+
+    traces = trace.load([path])
+    assert [traces[ctx['trace']][0]['start'] for ctx in ctxs] == list(range(100))
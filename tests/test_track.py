@@ -0,0 +1,51 @@
+import numpy
+
+from proto import track
+
+def metres(x, y, lat0=55.8, lon0=37.6):
+    '''lat/lon of points given in metres east/north of (lat0, lon0)'''
+    lat = lat0 + numpy.degrees(numpy.asarray(y, dtype=float) / track.EARTH_RADIUS)
+    lon = lon0 + numpy.degrees(numpy.asarray(x, dtype=float) / track.EARTH_RADIUS / numpy.cos(numpy.radians(lat0)))
+    return lat, lon
+
+def test_project():
+    lat, lon = metres([0, 300, 0], [0, 0, 400])
+    x, y = track.project(lat, lon)
+    assert numpy.allclose(x, [0, 300, 0], atol=0.5) and numpy.allclose(y, [0, 0, 400], atol=0.5)
+
+def test_douglas_peucker():
+    # a straight line with a 5 m wobble and one 100 m corner
+    x = numpy.arange(0, 2001, 50.)
+    y = numpy.where(x <= 1000, 0, x - 1000) + numpy.where(numpy.arange(len(x)) % 2, 5, 0)
+    keep = track.douglas_peucker(x, y, 10)
+    assert list(numpy.flatnonzero(keep)) == [0, 20, 40]
+    assert track.douglas_peucker(x, y, 0).all()
+    assert track.douglas_peucker(x, y, 3).sum() > 30 # below the wobble most points stay
+
+def test_douglas_peucker_loop():
+    # back where it started: the chord has no length
+    x = numpy.array([0., 100, 200, 100, 0])
+    y = numpy.array([0., 50, 0, -50, 0])
+    assert list(numpy.flatnonzero(track.douglas_peucker(x, y, 10))) == [0, 1, 2, 3, 4]
+
+def test_merge_stays():
+    # walk in, jitter around one place, walk out
+    x = numpy.array([-600., -300, 0, 10, -8, 5, 12, -3, 300, 600])
+    y = numpy.array([0., 0, 0, 5, -6, 10, 0, 4, 0, 0])
+    keep = track.merge_stays(x, y, 30)
+    assert list(numpy.flatnonzero(keep)) == [0, 1, 2, 7, 8, 9]
+    assert track.merge_stays(x, y, 0).all()
+
+def test_merge_stays_drift():
+    # slow steps that add up to more than the radius make several stays
+    x = numpy.arange(0, 100, 10.)
+    keep = track.merge_stays(x, numpy.zeros(len(x)), 25)
+    assert list(numpy.flatnonzero(keep)) == [0, 2, 4, 6, 8, 9]
+
+def test_simplify():
+    lat, lon = metres([-600, -300, 0, 10, -8, 5, 12, -3, 300, 600], [0, 0, 0, 5, -6, 10, 0, 4, 0, 0])
+    assert list(track.simplify(lat, lon)) == list(range(10))
+    assert list(track.simplify(lat, lon, stay=30)) == [0, 1, 2, 7, 8, 9]
+    assert list(track.simplify(lat, lon, tolerance=20, stay=30)) == [0, 9]
+    assert list(track.simplify([], [], tolerance=20, stay=30)) == []
+    assert list(track.simplify(lat[:1], lon[:1], tolerance=20, stay=30)) == [0]
@@ -0,0 +1,91 @@
+import asyncio
+import json
+
+from gpstrack import writebehind
+from proto import message, trace
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = []
+        self.published = []
+        self.unprocessed = 1
+
+    async def create_topic(self, Name):
+        return {'TopicArn': 'arn:%s' % Name}
+
+    async def batch_write_item(self, RequestItems):
+        items = RequestItems['gpswatch']
+        self.calls.append(('write', [r['PutRequest']['Item']['ts']['N'] for r in items]))
+        if self.unprocessed and len(items) > 1:
+            self.unprocessed -= 1
+            return {'UnprocessedItems': {'gpswatch': items[-1:]}}
+        return {}
+
+    async def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.calls.append(('publish', len(PublishBatchRequestEntries)))
+        self.published.extend(e['Message'] for e in PublishBatchRequestEntries)
+        return {'Successful': [], 'Failed': []}
+
+
+class FakePool:
+    def __init__(self):
+        self.dynamo = self.sns = FakeClient()
+
+
+def test_write_behind():
+    loop = asyncio.new_event_loop()
+    pool = FakePool()
+
+    async def run():
+        writer = writebehind.WriteBehind(pool, max_delay=0.01, shards=1)
+        await writer.start()
+        for i in range(30):
+            msg = message.message.from_command('3G', '6401623106', 'LK', None, ts=str(1486372772 + i), direction='watch')
+            await writer.put(msg)
+        await writer.close()
+        return writer
+
+    writer = loop.run_until_complete(run())
+    loop.close()
+
+    writes = [c[1] for c in pool.dynamo.calls if c[0] == 'write']
+    assert len(writes[0]) == writebehind.BATCH_WRITE_SIZE
+    assert writes[1] == writes[0][-1:] # unprocessed item retried before the next batch
+    stored = [ts for w in writes[:1] + writes[2:] for ts in w]
+    assert [ts.split('.')[0] for ts in stored] == [str(1486372772 + i) for i in range(30)]
+    assert [c[1] for c in pool.sns.calls if c[0] == 'publish'] == [10, 10, 5, 5]
+    assert writer.written == writer.published == 30
+    assert writer.retried == 1
+
+class Spans:
+    def __init__(self):
+        self.spans = []
+
+    def span(self, ctx, name, start, end=None, **attrs):
+        self.spans.append((ctx['trace'], name))
+
+def test_write_behind_trace():
+    loop = asyncio.new_event_loop()
+    pool = FakePool()
+    pool.dynamo.unprocessed = 0
+    tracer = Spans()
+
+    async def run():
+        writer = writebehind.WriteBehind(pool, max_delay=0.01, shards=1, tracer=tracer)
+        await writer.start()
+        for i, cmd in enumerate(('LK', 'AL')):
+            msg = message.message.from_command('3G', '6401623106', cmd, None, ts=str(1486372772 + i), direction='watch')
+            if cmd == 'AL':
+                msg.trace = trace.context()
+            await writer.put(msg)
+        await writer.close()
+        return msg.trace
+
+    ctx = loop.run_until_complete(run())
+    loop.close()
+
+    bodies = [json.loads(b) for b in pool.sns.published]
+    assert 'trace' not in bodies[0]
+    assert bodies[1]['trace'] == ctx and bodies[1]['cmd'] == 'AL'
+    assert tracer.spans == [(ctx['trace'], 'queue'), (ctx['trace'], 'dynamo'), (ctx['trace'], 'sns')]